@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+# Size and load time of the dataset as tester.py saves it: the
+# my_dataset.pkl pickle against the my_dataset.npz FeatureMatrix archive.
+# Loading counts until the tester's feature array is built: unpickling
+# plus featureFormat, against opening the archive plus format(), which
+# only reads the columns of the feature list.
+#
+# Usage: python bench_dataset_format.py [--people N ...] [--features K]
+
+# Standard imports
+import argparse
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+
+# My imports
+import numpy as np
+
+sys.path.append("tools/")
+from bench_feature_format import best_of, synthetic_data
+from feature_format import featureFormat
+from feature_matrix import FeatureMatrix
+
+# CONSTANTS
+
+SCALES = (146, 10000, 100000)
+FEATURES = 20
+USED = 5 # features in the list the tester formats, besides poi
+
+def bench(people, features, repeat, out_dir):
+	data_dict, features_list = synthetic_data(people, features)
+	feature_list = features_list[:USED + 1]
+	pickle_path = os.path.join(out_dir, "my_dataset.pkl")
+	binary_path = os.path.join(out_dir, "my_dataset.npz")
+
+	# As tester.dump_classifier_and_data writes them
+	with open(pickle_path, "w") as dataset_file:
+		pickle.dump(data_dict, dataset_file)
+	FeatureMatrix(data_dict).save(binary_path)
+	del data_dict
+
+	def from_pickle():
+		with open(pickle_path, "r") as dataset_file:
+			dataset = pickle.load(dataset_file)
+		return featureFormat(dataset, feature_list, sort_keys=True)
+
+	def from_binary():
+		return FeatureMatrix.load(binary_path).format(feature_list)
+
+	pickle_seconds, expected = best_of(repeat, from_pickle)
+	binary_seconds, data = best_of(repeat, from_binary)
+	if not np.array_equal(expected, data):
+		raise AssertionError("the archive formats differently at {} "
+							 "people".format(people))
+
+	print("{:>9,} people x {} features: pickle {:8.1f} KB {:7.3f}s, "
+		  "npz {:8.1f} KB {:7.3f}s".format(
+			  people, features,
+			  os.path.getsize(pickle_path) / 1e3, pickle_seconds,
+			  os.path.getsize(binary_path) / 1e3, binary_seconds))
+	sys.stdout.flush()
+
+def main():
+	parser = argparse.ArgumentParser(description="Compare the dataset "
+									 "pickle and archive")
+	parser.add_argument("--people", type=int, nargs="+", default=list(SCALES),
+						help="data_dict sizes to run")
+	parser.add_argument("--features", type=int, default=FEATURES,
+						help="features besides poi")
+	parser.add_argument("--repeat", type=int, default=3,
+						help="keep the best of this many runs")
+	args = parser.parse_args()
+
+	out_dir = tempfile.mkdtemp(prefix="enron_bench_")
+	try:
+		for people in args.people:
+			bench(people, args.features, args.repeat, out_dir)
+	finally:
+		shutil.rmtree(out_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+# Timing of featureFormat against the loop it replaced
+# (featureFormatLoop) on a synthetic data_dict shaped like the Enron one:
+# numeric features with about a third "NaN", the odd zero and a poi
+# flag, scaled to millions of people. Both results are checked equal.
+#
+# Usage: python bench_feature_format.py [--people N ...] [--features K]
+
+# Standard imports
+import argparse
+import sys
+
+# My imports
+from time import time
+
+import numpy as np
+
+sys.path.append("tools/")
+from feature_format import featureFormat, featureFormatLoop
+
+# CONSTANTS
+
+SCALES = (10000, 100000, 1000000)
+FEATURES = 10
+NAN_SHARE = 0.35
+ZERO_SHARE = 0.05
+
+def synthetic_data(people, features, seed=42):
+	"""(data_dict, features_list) of people with poi and features values"""
+
+	random = np.random.RandomState(seed)
+	names = ["feature_{}".format(i) for i in range(features)]
+	values = random.randint(1, 10 ** 6, size=(people, features)).tolist()
+	draws = random.random_sample((people, features))
+	pois = (random.random_sample(people) < 0.12).tolist()
+
+	data_dict = {}
+	for i in range(people):
+		person = {"poi": pois[i], "email_address": "nobody@enron.com"}
+		for j, name in enumerate(names):
+			if draws[i, j] < NAN_SHARE:
+				person[name] = "NaN"
+			elif draws[i, j] < NAN_SHARE + ZERO_SHARE:
+				person[name] = 0
+			else:
+				person[name] = values[i][j]
+		data_dict["PERSON {}".format(i)] = person
+	return data_dict, ["poi"] + names
+
+def best_of(repeat, run):
+	"""Smallest seconds (and the result) of repeat calls to run"""
+
+	best = None
+	for _ in range(repeat):
+		start = time()
+		result = run()
+		seconds = time() - start
+		if best is None or seconds < best[0]:
+			best = (seconds, result)
+	return best
+
+def bench(people, features, repeat=3):
+	data_dict, features_list = synthetic_data(people, features)
+	keys = sorted(data_dict.keys())
+
+	loop, expected = best_of(repeat, lambda: featureFormatLoop(
+		data_dict, features_list, keys=keys))
+	columnar, data = best_of(repeat, lambda: featureFormat(
+		data_dict, features_list, sort_keys=True))
+	if not np.array_equal(expected, data):
+		raise AssertionError("featureFormat differs from the loop at {} "
+							 "people".format(people))
+
+	print("{:>9,} people x {} features: loop {:7.2f}s, columnar {:7.2f}s, "
+		  "{:5.1f}x".format(people, len(features_list), loop, columnar,
+							loop / columnar))
+	sys.stdout.flush()
+
+def main():
+	parser = argparse.ArgumentParser(description="Time featureFormat against "
+									 "the per person loop")
+	parser.add_argument("--people", type=int, nargs="+", default=list(SCALES),
+						help="data_dict sizes to run")
+	parser.add_argument("--features", type=int, default=FEATURES,
+						help="features besides poi")
+	parser.add_argument("--repeat", type=int, default=3,
+						help="keep the best of this many runs")
+	args = parser.parse_args()
+
+	for people in args.people:
+		bench(people, args.features, args.repeat)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+# Outlier trimming for poi_id.py ("Remove outliers: Part 2"): score every
+# person once, then drop the highest scoring non-POI in one step until
+# only a share of the people is left. The scores are those of a scorer:
+#   residual   squared residual of a least squares fit of poi on the
+#              features (what poi_id.py has always used)
+#   robust     the same with a Huber fit, which large residuals pull on
+#              less
+#   isolation  IsolationForest anomaly score, which ignores the labels
+#
+# trim_mask() picks the same people as the loop it replaced, which
+# deleted the worst non-POI left, one at a time, and only got to POI
+# (the best fit first) once no non-POI were left.
+
+# My imports
+import numpy as np
+from sklearn.linear_model import HuberRegressor, LinearRegression
+
+# CONSTANTS
+
+KEEP = 0.5 # share of the people kept
+PROTECTED = 1 # label never trimmed while others are left
+
+def residual_scores(features, labels):
+	"""Squared residual of each person under a least squares fit"""
+
+	reg = LinearRegression()
+	reg.fit(features, labels)
+	return (reg.predict(features) - labels) ** 2
+
+def robust_scores(features, labels):
+	"""Squared residual of each person under a Huber fit"""
+
+	reg = HuberRegressor()
+	reg.fit(features, labels)
+	return (reg.predict(features) - labels) ** 2
+
+def isolation_scores(features, labels, random_state=42):
+	"""IsolationForest anomaly score of each person, higher for the
+	easier to isolate"""
+
+	# Only loaded when used: sklearn.ensemble is slow to import
+	from sklearn.ensemble import IsolationForest
+
+	forest = IsolationForest(random_state=random_state)
+	forest.fit(features)
+	return -forest.decision_function(features)
+
+SCORERS = {"residual": residual_scores,
+		   "robust": robust_scores,
+		   "isolation": isolation_scores}
+
+def trim_mask(scores, labels, keep=KEEP, protected=PROTECTED):
+	"""Boolean mask of the people kept: as many as fit in keep * len(labels),
+	the highest scoring of those not labelled protected trimmed first"""
+
+	scores = np.asarray(scores)
+	labels = np.asarray(labels)
+	n = len(labels)
+	trim = min(n, max(0, n - int(np.floor(n * keep))))
+
+	mask = np.ones(n, dtype=bool)
+	others = np.flatnonzero(labels != protected)
+	worst = min(trim, len(others))
+	if worst:
+		order = np.argpartition(-scores[others], worst - 1)[:worst]
+		mask[others[order]] = False
+	if trim > worst:
+		# Only protected people left: the lowest scoring go first
+		kept = np.flatnonzero(labels == protected)
+		mask[kept[np.argsort(scores[kept], kind="mergesort")[:trim - worst]]] \
+			= False
+	return mask
+
+def trim_outliers(features, labels, scorer="residual", keep=KEEP,
+				  protected=PROTECTED):
+	"""features and labels without their outliers under scorer, a name
+	in SCORERS or a function of (features, labels)"""
+
+	features = np.asarray(features)
+	labels = np.asarray(labels)
+	if not callable(scorer):
+		scorer = SCORERS[scorer]
+	mask = trim_mask(scorer(features, labels), labels, keep, protected)
+	return features[mask], labels[mask]
@@ -4,7 +4,8 @@ import sys
 import pickle
 sys.path.append("../tools/")
 
-from feature_format import featureFormat, targetFeatureSplit
+from feature_format import targetFeatureSplit
+from feature_matrix import FeatureMatrix
 from tester import dump_classifier_and_data
 
 # My import
@@ -96,7 +97,11 @@ print len(data_dict)
 print "Total Features:",
 print len(data_dict[data_dict.keys()[0]])
 
-init_data = featureFormat(data_dict, features_list, sort_keys = True)
+# Every stage below reads this one copy of the data, rather than
+# running featureFormat over data_dict again
+matrix = FeatureMatrix(data_dict)
+
+init_data = matrix.format(features_list)
 init_labels, init_features = targetFeatureSplit(init_data)
 print "POI Number: ", sum(init_labels)
 print "Init POI Ratio: " + str(sum(init_labels) / len(init_labels))
@@ -107,24 +112,18 @@ print "Init POI Ratio: " + str(sum(init_labels) / len(init_labels))
 
 ### Gather Data
 
-n = 0 # Missing partial information
-for key in data_dict.keys():
-	for feature in data_dict[key].keys():
-		if data_dict[key][feature] == "NaN":
-			n += 1
-			break
+n = matrix.missing().any(axis=1).sum() # Missing partial information
 
 print "People with incomplete info: ", n
 
-for key in data_dict.keys():
-	for feature in features_list:
-		if data_dict[key][feature] == "NaN":
-			data_dict.pop(key)
-			break
+incomplete = matrix.missing(features_list).any(axis=1)
+for key in matrix.people()[incomplete]:
+	data_dict.pop(key)
+matrix = matrix.filter(~incomplete)
 
 print "Stage 1 Population:", len(data_dict)
 
-temp = featureFormat(data_dict, features_list, sort_keys = True)
+temp = matrix.format(features_list)
 temp_labels, temp_features = targetFeatureSplit(temp)
 print "Part 1 POI Number: ", sum(temp_labels)
 print "Part 1 POI Ratio: " + str(sum(temp_labels) / len(init_labels))
@@ -137,12 +136,17 @@ print "Part 1 POI Ratio: " + str(sum(temp_labels) / len(init_labels))
 feature1 = "to_poi_email_percentage"
 feature2 = "from_poi_email_percentage"
 
-for key in data_dict.keys():
-	data_dict[key][feature1] = \
-		float(data_dict[key]["from_this_person_to_poi"])/data_dict[key]["from_messages"]
+matrix.derive(feature1, matrix.column("from_this_person_to_poi") /
+					  matrix.column("from_messages"))
+matrix.derive(feature2, matrix.column("from_poi_to_this_person") /
+					  matrix.column("to_messages"))
 
-	data_dict[key][feature2] = \
-		float(data_dict[key]["from_poi_to_this_person"])/data_dict[key]["to_messages"]
+# data_dict gets them too, for the export below
+for key, to_poi, from_poi in zip(matrix.people(),
+								 matrix.column(feature1).tolist(),
+								 matrix.column(feature2).tolist()):
+	data_dict[key][feature1] = to_poi
+	data_dict[key][feature2] = from_poi
 
 features_list.append(feature1)
 features_list.append(feature2)
@@ -157,44 +161,26 @@ my_dataset = data_dict
 
 # Change data_dict into usable form
 
-data = featureFormat(data_dict, features_list, sort_keys = True)
+data = matrix.format(features_list)
 labels, features = targetFeatureSplit(data)
 
 ### Task 2: Remove outliers: Part 2
 
-# Remove the hardest to classify
-
-from sklearn.linear_model import LinearRegression
+# Remove the hardest to classify: the worst fits of a linear regression
+# of poi on the features
 
-reg = LinearRegression()
-reg.fit(features, labels)
-pred = reg.predict(features)
+from outliers import trim_outliers
 
 # Assuming that non-POI are more uniform, I will remove outliers from
-# that population.
+# that population, until half the people are left.
 #
 # It will both remove outlier, and increase my POI ratio.
+#
+# outliers.py also scores by a robust regression ("robust") or by how
+# easily each person is isolated ("isolation").
 
-N = len(labels)
-TARGET = N * 0.5
-
-while (len(labels) > TARGET):
-	diff = (pred - labels) ** 2
-
-	ordered_diff = sorted(diff, reverse=True)
-
-	index = -1
-	for i in ordered_diff:
-		index = int(np.where(diff==i)[0])
-		if labels[index] == 1:
-			continue
-		else:
-			break
-
-	if index != -1:
-		pred = np.delete(pred, index)
-		labels = np.delete(labels, index)
-		features = np.delete(features, index, axis=0)
+features, labels = trim_outliers(features, labels, scorer = "residual",
+								 keep = 0.5)
 
 # I need to make sure that there are enough poi that remains. If there
 # are none or too few, it would be too easy to guess that none of the
@@ -234,6 +220,9 @@ clf = Pipeline(estimators)
 
 # Algorithm Tuning
 
+# Picked by hand; search.py scores these and the rest of its grid with
+# the tester's folds.
+
 clf.set_params(classifier__criterion = "entropy")
 clf.set_params(classifier__max_depth = 2)
 # clf.set_params(classifier__min_samples_split = 2)
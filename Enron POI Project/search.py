@@ -0,0 +1,279 @@
+#!/usr/bin/python
+
+# Hyperparameter search over the poi_id.py pipeline, scored exactly as
+# tester.py scores it: the same StratifiedShuffleSplit folds
+# (random_state = 42) and pooled counts, so a candidate's result here is
+# the result test_classifier prints for it.
+#
+# Candidates come from a grid or random samples of pipeline parameters
+# and run in a process pool. Successive halving scores every candidate
+# on the first few folds, keeps the best third, and gives the survivors
+# three times the folds, until the full 1000. The per fold counts of
+# every (candidate, feature list) are cached on disk, so a later search
+# only evaluates folds it has not seen. --step-cache also fits the
+# scaler once per fold rather than once per fold and candidate (see
+# stepcache.py).
+#
+# Usage: python search.py [--workers N] [--random N] [--metric f1|f2]
+#                         [--no-halving] [--step-cache [DIR]]
+# on the my_*.pkl files written by poi_id.py.
+
+# Standard imports
+import argparse
+import hashlib
+import os
+import pickle
+import sys
+from multiprocessing import Pool
+
+# My imports
+import numpy as np
+from sklearn.base import clone
+from sklearn.cross_validation import StratifiedShuffleSplit
+from sklearn.model_selection import ParameterGrid, ParameterSampler
+
+sys.path.append("../tools/")
+from feature_format import targetFeatureSplit
+from feature_matrix import formatDataset
+from stepcache import COUNTERS, StepCache, cached_pipeline
+from tester import evaluate_folds, load_classifier_and_data
+
+# CONSTANTS
+
+FOLDS = 1000 # as in tester.test_classifier
+MIN_FOLDS = 50 # folds of the first halving round
+ETA = 3 # 1 / share of candidates kept, and fold growth, per round
+CHUNK_FOLDS = 250 # most folds per pool task
+CACHE_FILENAME = "search_cache.pkl"
+
+# Parameters of the poi_id.py pipeline searched by default
+PARAM_GRID = {"classifier__criterion": ["gini", "entropy"],
+			  "classifier__max_depth": [None, 2, 3, 4, 6, 8],
+			  "classifier__min_samples_split": [2, 4, 8, 16],
+			  "classifier__class_weight": [None, "balanced"]}
+
+LEADERBOARD_FORMAT = "{:>4}  {:>7}  {:>7}  {:>9}  {:>7}  {:>8}  {:>5}  {}"
+
+# Candidates
+
+def grid(param_grid):
+	"""Every combination of a dict (or list of dicts) of parameter lists"""
+
+	return list(ParameterGrid(param_grid))
+
+def random_candidates(distributions, n, random_state=42):
+	"""n samples of a dict of parameter lists or scipy.stats distributions"""
+
+	return list(ParameterSampler(distributions, n, random_state=random_state))
+
+# Scores
+
+def scores(counts):
+	"""Pooled accuracy, precision, recall, F1 and F2 of per fold
+	evaluate_folds() rows, as tester.py computes them (0 if undefined)"""
+
+	tn, fn, fp, tp = [int(total) for total in counts[:, :4].sum(axis=0)]
+	total = tn + fn + fp + tp
+	precision = 1.0 * tp / (tp + fp) if tp + fp else 0.0
+	recall = 1.0 * tp / (tp + fn) if tp + fn else 0.0
+	return {"accuracy": 1.0 * (tp + tn) / total if total else 0.0,
+			"precision": precision,
+			"recall": recall,
+			"f1": 2.0 * tp / (2 * tp + fp + fn) if tp else 0.0,
+			"f2": (5.0 * precision * recall / (4 * precision + recall)
+				   if tp else 0.0)}
+
+# Cache
+
+def data_key(data, feature_list):
+	"""Part of a cache key fixing the dataset and the features used"""
+
+	return (tuple(feature_list), hashlib.sha1(data.tobytes()).hexdigest())
+
+def candidate_key(clf, params, data):
+	"""Cache key of one candidate: the full repr of the estimator with
+	its parameters set, and data_key()"""
+
+	return (repr(clone(clf).set_params(**params)),) + data
+
+def load_cache(path):
+	if path and os.path.exists(path):
+		with open(path, "rb") as cache_file:
+			return pickle.load(cache_file)
+	return {}
+
+def save_cache(cache, path):
+	if path:
+		with open(path, "wb") as cache_file:
+			pickle.dump(cache, cache_file, pickle.HIGHEST_PROTOCOL)
+
+# Workers
+
+# Set in each worker process by init_worker
+WORKER_DATA = {}
+
+def init_worker(clf, features, labels, folds):
+	WORKER_DATA["clf"] = clf
+	WORKER_DATA["features"] = features
+	WORKER_DATA["labels"] = labels
+	WORKER_DATA["folds"] = folds
+
+def evaluate_task(task):
+	"""Counts of one candidate on folds start to end, and what its fits
+	added to the counters of the step cache. Runs in a worker"""
+
+	params, start, end = task
+	clf = clone(WORKER_DATA["clf"]).set_params(**params)
+	cache = getattr(clf, "cache", None)
+	before = dict(cache.stats) if cache is not None else None
+	counts = evaluate_folds(clf, WORKER_DATA["features"],
+							WORKER_DATA["labels"],
+							WORKER_DATA["folds"][start:end])
+	if cache is None:
+		return counts, None
+	return counts, dict((name, cache.stats[name] - before[name])
+						for name in COUNTERS)
+
+def fold_tasks(params, start, end):
+	return [(params, i, min(i + CHUNK_FOLDS, end))
+			for i in range(start, end, CHUNK_FOLDS)]
+
+# Search
+
+def budgets(folds, min_folds, eta):
+	"""Folds of each successive halving round"""
+
+	rounds = []
+	n = min(min_folds, folds)
+	while n < folds:
+		rounds.append(n)
+		n *= eta
+	return rounds + [folds]
+
+def search(clf, dataset, feature_list, candidates, folds=FOLDS, workers=1,
+		   metric="f1", halving=True, min_folds=MIN_FOLDS, eta=ETA,
+		   cache_path=CACHE_FILENAME, step_cache=None):
+	"""Score clf with each dict of parameters in candidates on the
+	test_classifier folds. With halving, only the best 1 / eta of the
+	candidates by metric go on to each round of eta times more folds.
+	With a StepCache as step_cache, a Pipeline clf fits its transformers
+	through it, and its counters include the fits of every worker.
+	dataset is a data dictionary or a FeatureMatrix of one.
+
+	Returns the leaderboard: a list of dicts (params, folds, scores)
+	sorted by metric, the candidates that reached the most folds first.
+	"""
+
+	data = formatDataset(dataset, feature_list)
+	labels, features = targetFeatureSplit(data)
+	cv = list(StratifiedShuffleSplit(labels, folds, random_state=42))
+
+	cache = load_cache(cache_path)
+	data_part = data_key(data, feature_list)
+	keys = [candidate_key(clf, params, data_part) for params in candidates]
+	counts = [cache.get(key, np.zeros((0, 5), dtype=int)) for key in keys]
+
+	if step_cache is not None:
+		clf = cached_pipeline(clf, step_cache)
+	pool = None
+	if workers > 1:
+		pool = Pool(workers, initializer=init_worker,
+					initargs=(clf, features, labels, cv))
+	else:
+		init_worker(clf, features, labels, cv)
+
+	alive = list(range(len(candidates)))
+	reached = [0] * len(candidates)
+	try:
+		for n in (budgets(folds, min_folds, eta) if halving else [folds]):
+			# Only the folds not cached yet
+			tasks, owners = [], []
+			for i in alive:
+				for task in fold_tasks(candidates[i], len(counts[i]), n):
+					tasks.append(task)
+					owners.append(i)
+			if pool is not None:
+				results = pool.map(evaluate_task, tasks)
+			else:
+				# The step cache counts for itself in this process
+				results = [(evaluate_task(task)[0], None) for task in tasks]
+			for i, (result, stats) in zip(owners, results):
+				counts[i] = np.concatenate([counts[i], result])
+				if stats is not None:
+					step_cache.add_stats(stats)
+
+			for i in alive:
+				reached[i] = n
+				cache[keys[i]] = counts[i]
+			save_cache(cache, cache_path)
+			print("{} candidates on {} folds".format(len(alive), n))
+
+			if n < folds:
+				ranked = sorted(alive, reverse=True,
+								key=lambda i: scores(counts[i][:n])[metric])
+				alive = ranked[:max(1, -(-len(alive) // eta))]
+		if pool is not None:
+			pool.close()
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+
+	board = [{"params": candidates[i], "folds": reached[i],
+			  "scores": scores(counts[i][:reached[i]])}
+			 for i in range(len(candidates))]
+	board.sort(key=lambda result: (result["folds"], result["scores"][metric]),
+			   reverse=True)
+	return board
+
+def print_leaderboard(board, top=10):
+	print(LEADERBOARD_FORMAT.format("rank", "F1", "F2", "precision",
+									"recall", "accuracy", "folds", "params"))
+	for rank, result in enumerate(board[:top], 1):
+		s = result["scores"]
+		print(LEADERBOARD_FORMAT.format(
+			rank, "{:.5f}".format(s["f1"]), "{:.5f}".format(s["f2"]),
+			"{:.5f}".format(s["precision"]), "{:.5f}".format(s["recall"]),
+			"{:.5f}".format(s["accuracy"]), result["folds"],
+			", ".join("{}={!r}".format(name, value)
+					  for name, value in sorted(result["params"].items()))))
+
+def main():
+	parser = argparse.ArgumentParser(description="Search the parameters of "
+									 "the poi_id.py pipeline")
+	parser.add_argument("--workers", type=int, default=1,
+						help="evaluate candidates in a process pool")
+	parser.add_argument("--random", type=int, metavar="N",
+						help="N random samples of the grid instead of all of it")
+	parser.add_argument("--metric", choices=("f1", "f2"), default="f1",
+						help="rank candidates by F1 or F2")
+	parser.add_argument("--no-halving", action="store_true",
+						help="run every candidate on every fold")
+	parser.add_argument("--step-cache", nargs="?", const="", metavar="DIR",
+						help="reuse fitted transformers across candidates, "
+						"kept in DIR too if given")
+	parser.add_argument("--top", type=int, default=10,
+						help="leaderboard rows to print")
+	args = parser.parse_args()
+
+	clf, dataset, feature_list = load_classifier_and_data()
+	if args.random:
+		candidates = random_candidates(PARAM_GRID, args.random)
+	else:
+		candidates = grid(PARAM_GRID)
+
+	step_cache = None
+	if args.step_cache is not None:
+		step_cache = StepCache(args.step_cache or None)
+
+	board = search(clf, dataset, feature_list, candidates,
+				   workers=args.workers, metric=args.metric,
+				   halving=not args.no_halving, step_cache=step_cache)
+	print("")
+	print_leaderboard(board, args.top)
+	if step_cache is not None:
+		print("")
+		step_cache.report()
+
+if __name__ == '__main__':
+	main()
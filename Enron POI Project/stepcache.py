@@ -0,0 +1,176 @@
+#!/usr/bin/python
+
+# Memoized fitting of pipeline transformers. Scoring a pipeline on the
+# tester folds fits its MinMaxScaler once per fold, and every candidate
+# of a search fits the same scaler again on the same folds; only the
+# final step changes between candidates. CachedPipeline looks each
+# fitted transformer up by the parameters of its step (and of the steps
+# before it) and a hash of the training rows, so only the steps whose
+# parameters changed are refit.
+#
+# Entries live in an in-memory LRU, and optionally in a directory of
+# pickles shared by processes and later runs.
+
+# Standard imports
+import copy
+import hashlib
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+
+# My imports
+from time import time
+
+import numpy as np
+from sklearn.pipeline import Pipeline
+
+# CONSTANTS
+
+MAX_ENTRIES = 4096 # fitted steps kept in memory
+COUNTERS = ("hits", "disk_hits", "misses", "saved", "spent")
+
+def data_hash(X, y=None):
+	"""Hash of a training set: the rows, for the tester folds of one
+	dataset, are the fold's training index set"""
+
+	digest = hashlib.md5()
+	for array in (X, y):
+		if array is not None:
+			array = np.ascontiguousarray(array)
+			digest.update(repr((array.shape, array.dtype.str)).encode("ascii"))
+			digest.update(array)
+	return digest.hexdigest()
+
+def step_params(step):
+	"""Parameters of a step, read straight from its attributes: by sklearn
+	convention those are the constructor arguments, and fitted attributes
+	end in "_". get_params() would cost more than fitting a scaler."""
+
+	return sorted((name, value) for name, value in vars(step).items()
+				  if not name.endswith("_"))
+
+def step_key(upstream, step):
+	"""Key of a fitted step: its class and parameters, chained to the key
+	of what it was fit on"""
+
+	return hashlib.md5("{}|{}.{}|{!r}".format(
+		upstream, type(step).__module__, type(step).__name__,
+		step_params(step)).encode("utf-8")).hexdigest()
+
+class StepCache(object):
+	"""LRU of fitted transformers, and their transform of the training
+	rows, by step_key(); path names an optional directory of pickles.
+
+	hits, disk_hits and misses count lookups; saved is the fit seconds
+	the hits did not spend, spent the seconds the misses took. Copies of
+	the cache (as sklearn's clone makes) are the cache itself.
+	"""
+
+	def __init__(self, path=None, max_entries=MAX_ENTRIES):
+		self.path = path
+		self.max_entries = max_entries
+		self.entries = OrderedDict()
+		self.stats = dict((name, 0) for name in COUNTERS)
+		if path and not os.path.isdir(path):
+			os.makedirs(path)
+
+	def __deepcopy__(self, memo):
+		return self
+
+	def __getstate__(self):
+		# Other processes get the settings and the disk store only
+		return {"path": self.path, "max_entries": self.max_entries}
+
+	def __setstate__(self, state):
+		self.__init__(**state)
+
+	def file_name(self, key):
+		return os.path.join(self.path, key + ".pkl")
+
+	def get(self, key):
+		"""(fitted step, transformed rows, fit seconds), None if missing"""
+
+		entry = self.entries.pop(key, None)
+		if entry is None and self.path and os.path.exists(self.file_name(key)):
+			with open(self.file_name(key), "rb") as entry_file:
+				entry = pickle.load(entry_file)
+			self.stats["disk_hits"] += 1
+		if entry is not None:
+			self.entries[key] = entry
+			self.stats["hits"] += 1
+			self.stats["saved"] += entry[2]
+		return entry
+
+	def put(self, key, entry):
+		self.entries[key] = entry
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+		self.stats["misses"] += 1
+		self.stats["spent"] += entry[2]
+		if self.path:
+			# Written aside and renamed, so other processes never read
+			# half a file
+			fd, temp_name = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+			with os.fdopen(fd, "wb") as entry_file:
+				pickle.dump(entry, entry_file, pickle.HIGHEST_PROTOCOL)
+			try:
+				os.rename(temp_name, self.file_name(key))
+			except OSError:
+				# Already written by another process (on Windows)
+				os.remove(temp_name)
+
+	def add_stats(self, stats):
+		"""Add the counters of another process's copy"""
+
+		for name in COUNTERS:
+			self.stats[name] += stats[name]
+
+	def report(self):
+		stats = self.stats
+		lookups = stats["hits"] + stats["misses"]
+		print("Step cache: {} lookups, {} hits ({} from disk), {:.1%} hit "
+			  "rate".format(lookups, stats["hits"], stats["disk_hits"],
+							1.0 * stats["hits"] / lookups if lookups else 0))
+		print("Fitting saved {:.2f}s, spent {:.2f}s; {} steps in memory".format(
+			stats["saved"], stats["spent"], len(self.entries)))
+
+class CachedPipeline(Pipeline):
+	"""Pipeline whose transformers are fit through a StepCache; the final
+	step is always fit. Steps fit with fit parameters bypass the cache."""
+
+	def __init__(self, steps, memory=None, cache=None):
+		super(CachedPipeline, self).__init__(steps, memory)
+		self.cache = cache
+
+	def fit(self, X, y=None, **fit_params):
+		if self.cache is None or fit_params:
+			return super(CachedPipeline, self).fit(X, y, **fit_params)
+
+		self.steps = list(self.steps)
+		Xt = np.asarray(X)
+		key = data_hash(Xt, y)
+		for i, (name, transformer) in enumerate(self.steps[:-1]):
+			if transformer is None:
+				continue
+			key = step_key(key, transformer)
+			entry = self.cache.get(key)
+			if entry is None:
+				start = time()
+				Xt_next = transformer.fit_transform(Xt, y)
+				entry = (transformer, Xt_next, time() - start)
+				self.cache.put(key, entry)
+			# A copy, so set_params on this pipeline leaves the entry alone
+			self.steps[i] = (name, copy.copy(entry[0]))
+			Xt = entry[1]
+
+		if self._final_estimator is not None:
+			self._final_estimator.fit(Xt, y)
+		return self
+
+def cached_pipeline(clf, cache):
+	"""clf as a CachedPipeline using cache, if it is a Pipeline"""
+
+	if not isinstance(clf, Pipeline):
+		return clf
+	return CachedPipeline(clf.steps, clf.memory, cache)
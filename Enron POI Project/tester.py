@@ -10,11 +10,16 @@
     that process should happen at the end of poi_id.py
 """
 
+import os
 import pickle
 import sys
+import numpy as np
+from multiprocessing import Pool
+from sklearn.base import clone
 from sklearn.cross_validation import StratifiedShuffleSplit
 sys.path.append("../tools/")
-from feature_format import featureFormat, targetFeatureSplit
+from feature_format import targetFeatureSplit
+from feature_matrix import FeatureMatrix, formatDataset
 
 PERF_FORMAT_STRING = "\
 \tAccuracy: {:>0.{display_precision}f}\tPrecision: {:>0.{display_precision}f}\t\
@@ -22,43 +27,123 @@ Recall: {:>0.{display_precision}f}\tF1: {:>0.{display_precision}f}\tF2: {:>0.{di
 RESULTS_FORMAT_STRING = "\tTotal predictions: {:4d}\tTrue positives: {:4d}\tFalse positives: {:4d}\
 \tFalse negatives: {:4d}\tTrue negatives: {:4d}"
 
-def test_classifier(clf, dataset, feature_list, folds = 1000):
-    data = featureFormat(dataset, feature_list, sort_keys = True)
+FOLD_FORMAT_STRING = "\t{:<9}  mean: {:>0.{display_precision}f}  std: {:>0.{display_precision}f}\
+  p5: {:>0.{display_precision}f}  p25: {:>0.{display_precision}f}  median: {:>0.{display_precision}f}\
+  p75: {:>0.{display_precision}f}  p95: {:>0.{display_precision}f}  undefined: {:d}"
+
+# Fold chunks handed to each worker by test_classifier(workers > 1)
+CHUNKS_PER_WORKER = 4
+
+def evaluate_folds(clf, features, labels, folds):
+    """ fit clf on the training part of each (train_idx, test_idx) fold
+        and tally its predictions on the test part; features and labels
+        are arrays, indexed by the folds
+
+        returns an array of [true_negatives, false_negatives,
+        false_positives, true_positives, warning] rows, one per fold;
+        warning is 1 if the tally of the fold stopped at a prediction
+        (or label) other than 0 or 1
+    """
+    counts = []
+    for train_idx, test_idx in folds:
+        ### fit the classifier using training set, and test on test set
+        clf.fit(features[train_idx], labels[train_idx])
+        predictions = np.asarray(clf.predict(features[test_idx]))
+        truth = labels[test_idx]
+
+        valid = ((predictions == 0) | (predictions == 1)) & \
+            ((truth == 0) | (truth == 1))
+        warning = 0
+        if not valid.all():
+            first = np.argmin(valid)
+            predictions, truth = predictions[:first], truth[:first]
+            warning = 1
+
+        # cells: 0 true negative, 1 false positive, 2 false negative,
+        # 3 true positive
+        cells = np.bincount((2 * truth + predictions).astype(int),
+                            minlength = 4)
+        counts.append([cells[0], cells[2], cells[1], cells[3], warning])
+    return np.array(counts, dtype = int).reshape(-1, 5)
+
+# Set in each worker process by init_worker
+WORKER_DATA = {}
+
+def init_worker(clf, features, labels):
+    WORKER_DATA["clf"] = clf
+    WORKER_DATA["features"] = features
+    WORKER_DATA["labels"] = labels
+
+def evaluate_chunk(folds):
+    """ evaluate_folds on a clone of the worker's classifier """
+    return evaluate_folds(clone(WORKER_DATA["clf"]), WORKER_DATA["features"],
+                          WORKER_DATA["labels"], folds)
+
+def evaluate_parallel(clf, features, labels, folds, workers):
+    """ evaluate_folds with the folds split among a pool of workers, each
+        fitting its own clone of clf; the rows are the serial ones
+    """
+    size = max(1, -(-len(folds) // (workers * CHUNKS_PER_WORKER)))
+    chunks = [folds[i:i + size] for i in range(0, len(folds), size)]
+    pool = Pool(workers, initializer = init_worker,
+                initargs = (clf, features, labels))
+    try:
+        counts = np.concatenate(pool.map(evaluate_chunk, chunks))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    # Leave clf fitted on the last fold, as a serial run does
+    evaluate_folds(clf, features, labels, folds[-1:])
+    return counts
+
+def fold_metrics(counts):
+    """ per fold precision, recall and F1 of evaluate_folds() rows, NaN
+        where a fold leaves one undefined
+    """
+    true_positives = counts[:, 3].astype(float)
+    predicted = counts[:, 3] + counts[:, 2]
+    actual = counts[:, 3] + counts[:, 1]
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        return [("Precision", true_positives / predicted),
+                ("Recall", true_positives / actual),
+                ("F1", 2 * true_positives / (predicted + actual))]
+
+def print_fold_metrics(counts, display_precision = 5):
+    """ print the distribution over folds of each fold_metrics() metric """
+    print("Per fold ({:d} folds):".format(len(counts)))
+    for name, values in fold_metrics(counts):
+        defined = values[~np.isnan(values)]
+        undefined = len(values) - len(defined)
+        if not len(defined):
+            defined = np.zeros(1)
+        stats = [defined.mean(), defined.std()] + \
+            list(np.percentile(defined, [5, 25, 50, 75, 95]))
+        print(FOLD_FORMAT_STRING.format(name, *(stats + [undefined]),
+                                        display_precision = display_precision))
+
+def test_classifier(clf, dataset, feature_list, folds = 1000, workers = 1,
+                    per_fold = False):
+    """ print the performance of clf over folds stratified shuffle splits;
+        workers > 1 evaluates the folds in a process pool, with the same
+        output as a serial run, and per_fold = True adds the distribution
+        of precision, recall and F1 over the folds; dataset is a data
+        dictionary or a FeatureMatrix of one
+    """
+    data = formatDataset(dataset, feature_list)
     labels, features = targetFeatureSplit(data)
     cv = StratifiedShuffleSplit(labels, folds, random_state = 42)
-    true_negatives = 0
-    false_negatives = 0
-    true_positives = 0
-    false_positives = 0
-    for train_idx, test_idx in cv: 
-        features_train = []
-        features_test  = []
-        labels_train   = []
-        labels_test    = []
-        for ii in train_idx:
-            features_train.append( features[ii] )
-            labels_train.append( labels[ii] )
-        for jj in test_idx:
-            features_test.append( features[jj] )
-            labels_test.append( labels[jj] )
-        
-        ### fit the classifier using training set, and test on test set
-        clf.fit(features_train, labels_train)
-        predictions = clf.predict(features_test)
-        for prediction, truth in zip(predictions, labels_test):
-            if prediction == 0 and truth == 0:
-                true_negatives += 1
-            elif prediction == 0 and truth == 1:
-                false_negatives += 1
-            elif prediction == 1 and truth == 0:
-                false_positives += 1
-            elif prediction == 1 and truth == 1:
-                true_positives += 1
-            else:
-                print("Warning: Found a predicted label not == 0 or 1.")
-                print("All predictions should take value 0 or 1.")
-                print("Evaluating performance for processed predictions:")
-                break
+    if workers > 1:
+        counts = evaluate_parallel(clf, features, labels, list(cv), workers)
+    else:
+        counts = evaluate_folds(clf, features, labels, cv)
+    true_negatives, false_negatives, false_positives, true_positives, \
+        warnings = [int(total) for total in counts.sum(axis = 0)]
+    for _ in range(warnings):
+        print("Warning: Found a predicted label not == 0 or 1.")
+        print("All predictions should take value 0 or 1.")
+        print("Evaluating performance for processed predictions:")
     try:
         total_predictions = true_negatives + false_negatives + false_positives + true_positives
         accuracy = 1.0*(true_positives + true_negatives)/total_predictions
@@ -69,6 +154,8 @@ def test_classifier(clf, dataset, feature_list, folds = 1000):
         print(clf)
         print(PERF_FORMAT_STRING.format(accuracy, precision, recall, f1, f2, display_precision = 5))
         print(RESULTS_FORMAT_STRING.format(total_predictions, true_positives, false_positives, false_negatives, true_negatives))
+        if per_fold:
+            print_fold_metrics(counts)
         print("")
     except:
         print("Got a divide by zero when trying out:", clf)
@@ -77,29 +164,56 @@ def test_classifier(clf, dataset, feature_list, folds = 1000):
 CLF_PICKLE_FILENAME = "my_classifier.pkl"
 DATASET_PICKLE_FILENAME = "my_dataset.pkl"
 FEATURE_LIST_FILENAME = "my_feature_list.pkl"
+DATASET_BINARY_FILENAME = "my_dataset.npz"
 
 def dump_classifier_and_data(clf, dataset, feature_list):
+    """ pickle clf, dataset and feature_list; the dataset is also saved
+        as a FeatureMatrix archive, which load_classifier_and_data reads
+        instead of the pickle
+    """
     with open(CLF_PICKLE_FILENAME, "w") as clf_outfile:
         pickle.dump(clf, clf_outfile)
     with open(DATASET_PICKLE_FILENAME, "w") as dataset_outfile:
         pickle.dump(dataset, dataset_outfile)
     with open(FEATURE_LIST_FILENAME, "w") as featurelist_outfile:
         pickle.dump(feature_list, featurelist_outfile)
+    FeatureMatrix(dataset).save(DATASET_BINARY_FILENAME)
+
+def binary_dataset_current():
+    """ True if the dataset archive is there and not older than the
+        dataset pickle
+    """
+    if not os.path.exists(DATASET_BINARY_FILENAME):
+        return False
+    return not os.path.exists(DATASET_PICKLE_FILENAME) or \
+        os.path.getmtime(DATASET_BINARY_FILENAME) >= \
+        os.path.getmtime(DATASET_PICKLE_FILENAME)
 
-def load_classifier_and_data():
+def load_classifier_and_data(binary = True):
+    """ the classifier, dataset and feature list dumped by poi_id.py; with
+        binary = True the dataset is a FeatureMatrix opened from its
+        archive when that is current, read lazily by feature, and the
+        data dictionary from the pickle otherwise
+    """
     with open(CLF_PICKLE_FILENAME, "r") as clf_infile:
         clf = pickle.load(clf_infile)
-    with open(DATASET_PICKLE_FILENAME, "r") as dataset_infile:
-        dataset = pickle.load(dataset_infile)
+    if binary and binary_dataset_current():
+        dataset = FeatureMatrix.load(DATASET_BINARY_FILENAME)
+    else:
+        with open(DATASET_PICKLE_FILENAME, "r") as dataset_infile:
+            dataset = pickle.load(dataset_infile)
     with open(FEATURE_LIST_FILENAME, "r") as featurelist_infile:
         feature_list = pickle.load(featurelist_infile)
     return clf, dataset, feature_list
 
-def main():
+def main(workers = 1, per_fold = False):
     ### load up student's classifier, dataset, and feature_list
     clf, dataset, feature_list = load_classifier_and_data()
     ### Run testing script
-    test_classifier(clf, dataset, feature_list)
+    test_classifier(clf, dataset, feature_list, workers = workers,
+                    per_fold = per_fold)
 
 if __name__ == '__main__':
-    main()
+    ### usage: python tester.py [workers] [--per-fold]
+    args = [arg for arg in sys.argv[1:] if arg != "--per-fold"]
+    main(int(args[0]) if args else 1, "--per-fold" in sys.argv)
@@ -32,6 +32,10 @@
 
 
 import numpy as np
+from operator import itemgetter
+
+# rows copied at a time by targetFeatureSplit(memmap = ...)
+MEMMAP_BLOCK_ROWS = 1 << 16
 
 def featureFormat( dictionary, features, remove_NaN=True, remove_all_zeroes=True, remove_any_zeroes=False, sort_keys = False):
     """ convert dictionary to numpy array of features
@@ -46,21 +50,93 @@ def featureFormat( dictionary, features, remove_NaN=True, remove_all_zeroes=True
             should be left as False for the course mini-projects).
         NOTE: first feature is assumed to be 'poi' and is not checked for
             removal for zero or missing values.
+
+        Columnar version of featureFormatLoop, with the same result: the
+        values are gathered once into an (n x k) object matrix, converted
+        to floats in one step, and the data points are dropped with one
+        boolean mask. A missing feature or a value float() rejects
+        (which the loop skips, leaving a ragged row) falls back to the
+        loop, to report or build exactly what it does.
     """
 
+    keys = featureKeys(dictionary, sort_keys)
+    if not len(features):
+        return featureFormatLoop(dictionary, features, remove_NaN,
+                                 remove_all_zeroes, remove_any_zeroes, keys)
 
-    return_list = []
+    # One C-level call per person rather than a loop over every feature
+    getter = itemgetter(*features)
+    try:
+        if len(features) == 1:
+            values = [(getter(dictionary[key]),) for key in keys]
+        else:
+            values = [getter(dictionary[key]) for key in keys]
+    except KeyError:
+        return featureFormatLoop(dictionary, features, remove_NaN,
+                                 remove_all_zeroes, remove_any_zeroes, keys)
+
+    matrix = np.empty((len(values), len(features)), dtype=object)
+    if values:
+        matrix[:] = values
+    try:
+        data = matrix.astype(float)
+    except (TypeError, ValueError):
+        return featureFormatLoop(dictionary, features, remove_NaN,
+                                 remove_all_zeroes, remove_any_zeroes, keys)
+
+    # "NaN" and None both come out as nan, so only the nan cells need a
+    # look at the values: NumPy takes None where float() refuses it.
+    missing = np.isnan(data)
+    if missing.any():
+        missing_values = matrix[missing]
+        if np.equal(missing_values, None).any():
+            return featureFormatLoop(dictionary, features, remove_NaN,
+                                     remove_all_zeroes, remove_any_zeroes, keys)
+        if remove_NaN:
+            missing[missing] = missing_values == "NaN"
+            data[missing] = 0
+
+    # exclude 'poi' class as criteria.
+    if features[0] == 'poi':
+        test = data[:, 1:]
+    else:
+        test = data
+    keep = np.ones(len(data), dtype=bool)
+    ### NaN (kept with remove_NaN = False) is not zero
+    if remove_all_zeroes:
+        keep &= (test != 0).any(axis=1)
+    if remove_any_zeroes:
+        keep &= ~(test == 0).any(axis=1)
+
+    if not keep.any():
+        return np.array([])
+    return data[keep]
+
+
+def featureKeys( dictionary, sort_keys = False ):
+    """ keys of dictionary in the order featureFormat takes them """
 
     # Key order - first branch is for Python 3 compatibility on mini-projects,
     # second branch is for compatibility on final project.
     if isinstance(sort_keys, str):
         import pickle
-        keys = pickle.load(open(sort_keys, "rb"))
+        return pickle.load(open(sort_keys, "rb"))
     elif sort_keys:
-        keys = sorted(dictionary.keys())
+        return sorted(dictionary.keys())
     else:
+        return dictionary.keys()
+
+
+def featureFormatLoop( dictionary, features, remove_NaN=True, remove_all_zeroes=True, remove_any_zeroes=False, keys = None):
+    """ featureFormat one data point at a time, over keys (all of
+        dictionary's, unsorted, by default)
+    """
+
+    if keys is None:
         keys = dictionary.keys()
 
+    return_list = []
+
     for key in keys:
         tmp_list = []
         for feature in features:
@@ -106,23 +182,54 @@ def featureFormat( dictionary, features, remove_NaN=True, remove_all_zeroes=True
     return np.array(return_list)
 
 
-def targetFeatureSplit( data ):
+def targetFeatureSplit( data, memmap = None ):
     """ 
         given a numpy array like the one returned from
         featureFormat, separate out the first feature
-        and put it into its own list (this should be the 
+        and put it into its own array (this should be the 
         quantity you want to predict)
 
-        return targets and features as separate lists
+        return targets and features as views of data: a 1-D array
+        and a 2-D array, with no data copied (a list of rows is turned
+        into an array first)
+
+        memmap names a .npy file to copy data to, row block by row
+        block, and the views are then of that file mapped read-only:
+        for matrices that do not fit in memory (an np.memmap data
+        already gives views of its file)
 
         (sklearn can generally handle both lists and numpy arrays as 
         input formats when training/predicting)
     """
 
+    data = np.asarray(data)
+    if data.ndim != 2:
+        if len(data):
+            # rows of different lengths: split them one by one
+            return targetFeatureSplitLoop(data)
+        data = data.reshape(0, 1)
+
+    if memmap is not None:
+        stored = np.lib.format.open_memmap(memmap, mode = "w+",
+                                           dtype = data.dtype,
+                                           shape = data.shape)
+        for start in range(0, len(data), MEMMAP_BLOCK_ROWS):
+            stored[start:start + MEMMAP_BLOCK_ROWS] = \
+                data[start:start + MEMMAP_BLOCK_ROWS]
+        stored.flush()
+        del stored
+        data = np.load(memmap, mmap_mode = "r")
+
+    return data[:, 0], data[:, 1:]
+
+
+def targetFeatureSplitLoop( data ):
+    """ targetFeatureSplit one row at a time, as lists """
+
     target = []
     features = []
     for item in data:
         target.append( item[0] )
         features.append( item[1:] )
 
-    return target, features
\ No newline at end of file
+    return target, features
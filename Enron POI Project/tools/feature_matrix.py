@@ -0,0 +1,304 @@
+#!/usr/bin/python
+
+"""
+    A column store of the data dictionary, for scripts that turn the same
+    dictionary into feature arrays again and again (a different feature
+    list, fewer people, a new feature)
+
+    FeatureMatrix reads the dictionary once: every numeric feature becomes
+    one row of a shared (features x people) float buffer, with "NaN"
+    stored as nan and flagged in a missing mask, and people are kept in
+    sorted key order. Every other feature (email_address) only gets its
+    missing mask.
+
+    select(features_list) and filter(mask) return views of the same
+    buffer, and format() builds what featureFormat(..., sort_keys = True)
+    returns for the view:
+
+    matrix = FeatureMatrix(data_dictionary)
+    complete = matrix.filter(~matrix.missing(["salary"]).any(axis = 1))
+    data_array = complete.format(["poi", "salary", "bonus"])
+    label, features = targetFeatureSplit(data_array)
+
+    columns added with derive() are seen by every view of the matrix
+
+    save() writes the matrix to an uncompressed .npz archive: the keys,
+    one array per numeric feature and one missing bitmask per feature.
+    FeatureMatrix.load() opens it lazily, so formatting a feature list
+    only reads the columns of that list
+"""
+
+
+import numpy as np
+from feature_format import featureFormat
+
+
+class FeatureMatrix(object):
+    """ numeric features of a data dictionary as columns, by person key
+        and feature name
+    """
+
+    def __init__(self, dictionary = None, features = None):
+        """ ingest dictionary (all of its features, or only features)
+
+            a feature is numeric if every person has it and every value
+            float() takes (besides "NaN") is a number
+        """
+        self.rows = None
+        self.features = None
+        self.columns = {}
+        self.missing_masks = {}
+        self.buffer_index = {}
+        if dictionary is None:
+            self.keys = np.array([], dtype = object)
+            self.buffer = np.empty((0, 0))
+            return
+
+        keys = sorted(dictionary.keys())
+        self.keys = np.empty(len(keys), dtype = object)
+        self.keys[:] = keys
+        if features is None:
+            names = set()
+            for person in dictionary.values():
+                names.update(person.keys())
+            features = sorted(names)
+
+        numeric = []
+        for feature in features:
+            values = np.empty(len(keys), dtype = object)
+            try:
+                values[:] = [dictionary[key][feature] for key in keys]
+            except KeyError:
+                continue
+            missing = values == "NaN"
+            self.missing_masks[feature] = missing
+            column = numericColumn(values, missing)
+            if column is not None:
+                numeric.append((feature, column))
+
+        # one buffer, each feature a contiguous row of it
+        self.buffer = np.empty((len(numeric), len(keys)))
+        for i, (feature, column) in enumerate(numeric):
+            self.buffer[i] = column
+            self.columns[feature] = self.buffer[i]
+            self.buffer_index[feature] = i
+
+    @classmethod
+    def load(cls, path):
+        """ the FeatureMatrix saved to path; columns are read from the
+            archive the first time they are used
+        """
+        archive = np.load(path)
+        matrix = cls()
+        keys = archive["keys"].tolist()
+        matrix.keys = np.empty(len(keys), dtype = object)
+        matrix.keys[:] = keys
+        matrix.buffer = np.empty((0, len(keys)))
+        matrix.columns = ArchiveColumns(archive, "column/")
+        matrix.missing_masks = ArchiveColumns(archive, "missing/", len(keys))
+        return matrix
+
+    def save(self, path):
+        """ write this view's people, with every feature, to path (an
+            .npz archive)
+        """
+        arrays = {"keys": np.array(list(self.people()))}
+        for feature in self.missing_masks:
+            mask = self.missing_masks[feature]
+            if self.rows is not None:
+                mask = mask[self.rows]
+            arrays["missing/" + feature] = np.packbits(mask)
+            if feature in self.columns:
+                arrays["column/" + feature] = self.column(feature)
+        with open(path, "wb") as archive_file:
+            np.savez(archive_file, **arrays)
+
+    def view(self, rows = None, features = None):
+        """ a FeatureMatrix sharing this one's columns """
+        matrix = FeatureMatrix()
+        matrix.__dict__.update(self.__dict__)
+        matrix.rows = rows
+        matrix.features = features
+        return matrix
+
+    def select(self, features):
+        """ view of only features, in that order; no data is copied """
+        for feature in features:
+            if feature not in self.columns:
+                raise KeyError("no numeric feature {}".format(feature))
+        return self.view(self.rows, list(features))
+
+    def filter(self, mask):
+        """ view of the people of mask, a boolean array over this view's
+            people (or their positions in it)
+        """
+        positions = np.arange(len(self))[mask]
+        if self.rows is not None:
+            positions = self.rows[positions]
+        return self.view(positions, self.features)
+
+    def __len__(self):
+        if self.rows is None:
+            return len(self.keys)
+        return len(self.rows)
+
+    def people(self):
+        """ keys of this view's people, in order """
+        if self.rows is None:
+            return self.keys
+        return self.keys[self.rows]
+
+    def feature_names(self):
+        if self.features is not None:
+            return list(self.features)
+        return sorted(self.columns)
+
+    def column(self, feature):
+        """ values of feature for this view's people, nan where missing; a
+            view of the buffer unless rows are filtered
+        """
+        if feature not in self.columns:
+            raise KeyError("no numeric feature {}".format(feature))
+        if self.rows is None:
+            return self.columns[feature]
+        return self.columns[feature][self.rows]
+
+    def missing(self, features = None):
+        """ (people x features) mask of the "NaN" values """
+        if features is None:
+            features = sorted(self.missing_masks)
+        masks = np.empty((len(self), len(features)), dtype = bool)
+        for i, feature in enumerate(features):
+            mask = self.missing_masks[feature]
+            masks[:, i] = mask if self.rows is None else mask[self.rows]
+        return masks
+
+    def derive(self, feature, values):
+        """ add feature, values being this view's column of it; people
+            outside the view get "NaN"
+        """
+        values = np.asarray(values, dtype = float)
+        if values.shape != (len(self),):
+            raise ValueError("{} values for {} people".format(
+                len(values), len(self)))
+        if self.rows is None:
+            column = values.copy()
+            missing = np.zeros(len(self.keys), dtype = bool)
+        else:
+            column = np.full(len(self.keys), np.nan)
+            column[self.rows] = values
+            missing = np.ones(len(self.keys), dtype = bool)
+            missing[self.rows] = False
+        self.columns[feature] = column
+        self.missing_masks[feature] = missing
+
+    def array(self, features = None):
+        """ (people x features) float array, nan where missing; a view of
+            the buffer when the features are consecutive rows of it and no
+            people are filtered
+        """
+        if features is None:
+            features = self.feature_names()
+        positions = [self.buffer_index.get(feature) for feature in features]
+        if self.rows is None and len(positions) and None not in positions \
+                and positions == list(range(positions[0],
+                                            positions[0] + len(positions))):
+            return self.buffer[positions[0]:positions[-1] + 1].T
+        data = np.empty((len(self), len(features)))
+        for i, feature in enumerate(features):
+            data[:, i] = self.column(feature)
+        return data
+
+    def format(self, features = None, remove_NaN = True,
+               remove_all_zeroes = True, remove_any_zeroes = False):
+        """ featureFormat(dictionary, features, remove_NaN,
+            remove_all_zeroes, remove_any_zeroes, sort_keys = True) of
+            this view's people
+        """
+        if features is None:
+            features = self.feature_names()
+        if not len(self):
+            return np.array([])
+        data = self.array(features)
+        if remove_NaN:
+            missing = self.missing(features)
+            if missing.any():
+                data = np.where(missing, 0., data)
+
+        # exclude 'poi' class as criteria.
+        if len(features) and features[0] == 'poi':
+            test = data[:, 1:]
+        else:
+            test = data
+        keep = np.ones(len(data), dtype = bool)
+        if remove_all_zeroes:
+            keep &= (test != 0).any(axis = 1)
+        if remove_any_zeroes:
+            keep &= ~(test == 0).any(axis = 1)
+
+        if not keep.any():
+            return np.array([])
+        if keep.all():
+            # never hand out the buffer itself
+            if np.may_share_memory(data, self.buffer):
+                return data.copy()
+            return data
+        return data[keep]
+
+
+class ArchiveColumns(object):
+    """ the arrays of an .npz archive named prefix + feature, by feature,
+        each read on first use; size unpacks them as bitmasks of size
+        values
+    """
+
+    def __init__(self, archive, prefix, size = None):
+        self.archive = archive
+        self.prefix = prefix
+        self.size = size
+        self.names = set(name[len(prefix):] for name in archive.files
+                         if name.startswith(prefix))
+        self.loaded = {}
+
+    def __contains__(self, feature):
+        return feature in self.loaded or feature in self.names
+
+    def __iter__(self):
+        return iter(sorted(self.names | set(self.loaded)))
+
+    def __getitem__(self, feature):
+        if feature not in self.loaded:
+            if feature not in self.names:
+                raise KeyError(feature)
+            array = self.archive[self.prefix + feature]
+            if self.size is not None:
+                array = np.unpackbits(array)[:self.size].astype(bool)
+            self.loaded[feature] = array
+        return self.loaded[feature]
+
+    def __setitem__(self, feature, array):
+        self.loaded[feature] = array
+
+
+def numericColumn( values, missing ):
+    """ float array of an object array of values, nan where missing; None
+        if a value is not a number float() takes
+    """
+    present = values[~missing]
+    try:
+        if np.equal(present, None).any():
+            return None
+        column = np.full(len(values), np.nan)
+        column[~missing] = present.astype(float)
+    except (TypeError, ValueError):
+        return None
+    return column
+
+
+def formatDataset( dataset, features ):
+    """ featureFormat(dataset, features, sort_keys = True), for a data
+        dictionary or a FeatureMatrix
+    """
+    if isinstance(dataset, FeatureMatrix):
+        return dataset.format(features)
+    return featureFormat(dataset, features, sort_keys = True)
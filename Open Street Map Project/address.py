@@ -0,0 +1,153 @@
+# Standard imports
+import re
+
+# My imports
+from collections import Counter
+from functools import lru_cache
+
+# RE "CONSTANTS"
+
+# Whole addr values are classified in one pass: a zip+4 code is cut back
+# to five digits, and a value without "," or "-" (or made only of door
+# numbers split by them) is left alone, as in long_zip() / multi_door()
+ADDR_VALUE = re.compile(r'(?P<long_zip>\d{5}-.{4})|'
+						r'(?P<multi_door>[^,-]*|'
+						r'\s*\d+\s*(?:,\s*\d+\s*)+|'
+						r'\s*\d+\s*(?:-\s*\d+\s*)+)', re.DOTALL)
+MULTI_DOOR = re.compile(r'[^,-]*|\s*\d+\s*(?:,\s*\d+\s*)+|'
+						r'\s*\d+\s*(?:-\s*\d+\s*)+', re.DOTALL)
+DOOR_NUMBER = re.compile(r'\d+.?', re.DOTALL)
+
+# Cambridge Zip Code Include:
+# 02114, 02138, 02140, 02142, 02238, 02134, 02139, 02141, 02163
+POTENTIAL_ZIPS = frozenset(["2114", "2138", "2140", "2142", "2238", "2134",
+							"2139", "2141", "2163"])
+
+def good_word(word):
+	# Filter out words that are likely not needed to be checked manually
+	# Abbreviation longer than 3 letters are very rare
+	# No punctual
+	# Is in title form (istitle() returns true)
+	return len(word) > 3 and word.istitle() and word.isalpha() \
+		   and word.lower() != "pkwy"
+
+class AddressNormalizer(object):
+	"""Clean addr tag values with precompiled rule tables.
+
+	Every distinct raw value is analysed once and remembered in an LRU
+	memo; repeats only replay the recorded questionable word counts.
+	The legacy loop never wrote word_transforms back into the value, so
+	by default neither does this; pass apply_transforms=True to do so.
+	"""
+
+	def __init__(self, safe_words, word_transforms, questionable_words=None,
+				 addr_values=None, apply_transforms=False, cache_size=1 << 16):
+		self.safe_words = frozenset(safe_words)
+		self.word_transforms = dict(word_transforms)
+		self.apply_transforms = apply_transforms
+
+		if questionable_words is None:
+			questionable_words = Counter()
+		if addr_values is None:
+			addr_values = Counter()
+		self.questionable_words = questionable_words
+		self.addr_values = addr_values
+
+		self.analyze = lru_cache(maxsize=cache_size)(self._analyze)
+		self.check_word = lru_cache(maxsize=cache_size)(self._check_word)
+
+	def _check_word(self, word):
+		"""Return (questionable count, replacement) for one word"""
+
+		if word in self.safe_words:
+			return 0, word
+		if good_word(word) or (word[-1] == "," and good_word(word[:-1])):
+			return 0, word
+		if MULTI_DOOR.fullmatch(word):
+			return 0, word
+
+		if word in self.word_transforms:
+			replacement = self.word_transforms[word]
+		elif "," in word:
+			sub_words = word.split(",")
+			count = 0
+			for sub_word in sub_words:
+				if DOOR_NUMBER.fullmatch(sub_word):
+					continue
+				if sub_word not in self.word_transforms:
+					count += 1
+			# use Oxford comma
+			replacement = ", ".join(self.word_transforms.get(s, s)
+									for s in sub_words)
+			if count:
+				return count, word
+		else:
+			return 1, word
+
+		return 0, replacement if self.apply_transforms else word
+
+	def _analyze(self, value):
+		"""Return (new value, questionable word counts, addr_values count)"""
+
+		questionable = []
+		if value.isdigit():
+			# Bad zip are likely 4 digits (missing leading 0)
+			# or has more than 5 digit
+			if value not in POTENTIAL_ZIPS and len(value) <= 5:
+				return value, (), 0
+			questionable.append((value, 1))
+
+		match = ADDR_VALUE.fullmatch(value)
+		if match and match.lastgroup == "long_zip":
+			return value[:5], tuple(questionable), 0
+		if match:
+			return value, tuple(questionable), 0
+
+		words = value.split()
+		count = 0
+		for i, word in enumerate(words):
+			n, words[i] = self.check_word(word)
+			if n:
+				questionable.append((word, n))
+				count += n
+
+		return " ".join(words), tuple(questionable), count
+
+	def normalize(self, value):
+		"""Return the cleaned value, counting any questionable words"""
+
+		new_value, questionable, count = self.analyze(value)
+		for word, n in questionable:
+			self.questionable_words[word] += n
+		if count:
+			self.addr_values[value] += count
+		return new_value
+
+	def normalize_many(self, values):
+		"""Normalize a batch of raw values"""
+
+		return [self.normalize(value) for value in values]
+
+	def clean_tags(self, tags):
+		"""Correct addr information of shaped tag dicts in place"""
+
+		for e in tags:
+			if e["type"] == "addr":
+				e["value"] = self.normalize(e["value"])
+
+	def clean_rows(self, tags):
+		"""Correct addr information of (id, key, value, type) rows in place"""
+
+		for i, (id, key, value, type) in enumerate(tags):
+			if type == "addr":
+				tags[i] = (id, key, self.normalize(value), type)
+
+	def cache_info(self):
+		return self.analyze.cache_info()
+
+	def hit_rate(self):
+		"""Share of normalized values answered from the memo"""
+
+		info = self.analyze.cache_info()
+		total = info.hits + info.misses
+		return float(info.hits) / total if total else 0.0
@@ -0,0 +1,398 @@
+# Standard imports
+import base64
+import hashlib
+import heapq
+import math
+
+# My imports
+from array import array
+from collections import Counter
+from collections import OrderedDict
+
+# Named statistics for exploration.py. Every aggregator takes one streaming
+# pass of add() calls, merges with another of its kind (the counters of a
+# shard, or of an interrupted load) and round trips through JSON.
+#
+# Exact keeps a Counter. Sketch bounds the memory of a counter with
+# unbounded keys (users on a planet file) by combining:
+#   CountMin     per key counts, overestimated by at most ~e/width of the total
+#   HyperLogLog  distinct keys, within ~1.04/sqrt(2**p)
+#   SpaceSaving  the k heaviest keys
+# Hashes are stable across processes and runs, so sketches built by shard
+# workers or saved to disk still merge.
+
+MASK32 = (1 << 32) - 1
+
+def hash64(key):
+	return int.from_bytes(hashlib.blake2b(str(key).encode("utf-8"),
+										  digest_size=8).digest(), "little")
+
+def pack(values):
+	return base64.b64encode(values.tobytes()).decode("ascii")
+
+def unpack(typecode, text):
+	values = array(typecode)
+	values.frombytes(base64.b64decode(text))
+	return values
+
+class Total(object):
+	"""A running sum"""
+
+	KIND = "total"
+
+	def __init__(self, value=0):
+		self.value = value
+
+	def add(self, n):
+		self.value += n
+
+	def merge(self, other):
+		self.value += other.value
+
+	def to_json(self):
+		return {"kind": self.KIND, "value": self.value}
+
+	@classmethod
+	def from_json(cls, data):
+		return cls(data["value"])
+
+class Exact(object):
+	"""Exact counts per key, in a Counter"""
+
+	KIND = "exact"
+
+	def __init__(self, counts=None):
+		self.counter = Counter(counts or {})
+
+	def add(self, key, n=1):
+		self.counter[key] += n
+		# Negative updates come from incremental.py taking rows back out
+		if n < 0 and self.counter[key] <= 0:
+			del self.counter[key]
+
+	def count(self, key):
+		return self.counter[key]
+
+	def distinct(self):
+		return len(self.counter)
+
+	def top(self, k):
+		return self.counter.most_common(k)
+
+	def singles(self):
+		"""Keys counted exactly once"""
+
+		return sum(1 for n in self.counter.values() if n == 1)
+
+	def total(self):
+		return sum(self.counter.values())
+
+	def merge(self, other):
+		for key, n in other.counter.items():
+			self.counter[key] += n
+
+	def to_json(self):
+		return {"kind": self.KIND, "counts": dict(self.counter)}
+
+	@classmethod
+	def from_json(cls, data):
+		return cls(data["counts"])
+
+class CountMin(object):
+	"""Count-Min sketch: depth rows of width counters"""
+
+	KIND = "countmin"
+
+	def __init__(self, width=2048, depth=4):
+		self.width = width
+		self.depth = depth
+		self.rows = [array('q', [0]) * width for _ in range(depth)]
+
+	def cells(self, h):
+		# Double hashing: row i uses h1 + i * h2
+		h1, h2 = h & MASK32, h >> 32
+		return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+	def add_hash(self, h, n=1):
+		h1, h2 = h & MASK32, h >> 32
+		width = self.width
+		for i, row in enumerate(self.rows):
+			row[(h1 + i * h2) % width] += n
+
+	def add(self, key, n=1):
+		self.add_hash(hash64(key), n)
+
+	def count_hash(self, h):
+		return min(row[cell] for row, cell in zip(self.rows, self.cells(h)))
+
+	def count(self, key):
+		return self.count_hash(hash64(key))
+
+	def merge(self, other):
+		if (self.width, self.depth) != (other.width, other.depth):
+			raise ValueError("cannot merge Count-Min sketches of different sizes")
+		for row, other_row in zip(self.rows, other.rows):
+			for i, n in enumerate(other_row):
+				if n:
+					row[i] += n
+
+	def to_json(self):
+		return {"kind": self.KIND, "width": self.width, "depth": self.depth,
+				"rows": [pack(row) for row in self.rows]}
+
+	@classmethod
+	def from_json(cls, data):
+		sketch = cls(data["width"], data["depth"])
+		sketch.rows = [unpack('q', row) for row in data["rows"]]
+		return sketch
+
+class HyperLogLog(object):
+	"""HyperLogLog distinct counter with 2**p registers"""
+
+	KIND = "hll"
+
+	def __init__(self, p=14):
+		self.p = p
+		self.registers = bytearray(1 << p)
+
+	def add_hash(self, h):
+		index = h >> (64 - self.p)
+		rest = h & ((1 << (64 - self.p)) - 1)
+		rank = 64 - self.p - rest.bit_length() + 1
+		if rank > self.registers[index]:
+			self.registers[index] = rank
+
+	def add(self, key):
+		self.add_hash(hash64(key))
+
+	def distinct(self):
+		m = len(self.registers)
+		alpha = 0.7213 / (1 + 1.079 / m)
+		estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+		zeros = self.registers.count(0)
+		if estimate <= 2.5 * m and zeros:
+			# Small range correction: linear counting
+			estimate = m * math.log(float(m) / zeros)
+		return int(round(estimate))
+
+	def merge(self, other):
+		if self.p != other.p:
+			raise ValueError("cannot merge HyperLogLogs of different sizes")
+		self.registers = bytearray(max(a, b) for a, b in
+								   zip(self.registers, other.registers))
+
+	def to_json(self):
+		return {"kind": self.KIND, "p": self.p,
+				"registers": base64.b64encode(bytes(self.registers)).decode("ascii")}
+
+	@classmethod
+	def from_json(cls, data):
+		sketch = cls(data["p"])
+		sketch.registers = bytearray(base64.b64decode(data["registers"]))
+		return sketch
+
+class SpaceSaving(object):
+	"""Space-Saving summary of the k heaviest keys.
+
+	A key that is not tracked replaces the smallest one and inherits its
+	count, so counts are overestimated by at most errors[key].
+	"""
+
+	KIND = "topk"
+
+	def __init__(self, k=1000):
+		self.k = k
+		self.counts = {}
+		self.errors = {}
+		# (count, key) entries; counts only grow, so an entry whose count is
+		# out of date is refreshed when it reaches the top of the heap
+		self.heap = []
+
+	def pop_min(self):
+		while True:
+			count, key = heapq.heappop(self.heap)
+			if self.counts[key] == count:
+				return key
+			heapq.heappush(self.heap, (self.counts[key], key))
+
+	def min_count(self):
+		"""Smallest tracked count once full (what an untracked key may have
+		had), 0 before that"""
+
+		if len(self.counts) < self.k:
+			return 0
+		return min(self.counts.values())
+
+	def add(self, key, n=1):
+		counts = self.counts
+		if key in counts:
+			counts[key] += n
+			return
+		error = 0
+		if len(counts) >= self.k:
+			evicted = self.pop_min()
+			error = counts.pop(evicted)
+			del self.errors[evicted]
+		counts[key] = error + n
+		self.errors[key] = error
+		heapq.heappush(self.heap, (counts[key], key))
+
+	def top(self, k):
+		return sorted(self.counts.items(), key=lambda item: -item[1])[:k]
+
+	def merge(self, other):
+		"""Mergeable summaries: a key missing from one side may have had up
+		to that side's minimum count there"""
+
+		self_min, other_min = self.min_count(), other.min_count()
+		counts = {}
+		errors = {}
+		for key in set(self.counts) | set(other.counts):
+			counts[key] = (self.counts.get(key, self_min) +
+						   other.counts.get(key, other_min))
+			errors[key] = (self.errors.get(key, self_min) +
+						   other.errors.get(key, other_min))
+		keep = sorted(counts, key=lambda key: -counts[key])[:self.k]
+		self.counts = dict((key, counts[key]) for key in keep)
+		self.errors = dict((key, errors[key]) for key in keep)
+		self.heap = [(n, key) for key, n in self.counts.items()]
+		heapq.heapify(self.heap)
+
+	def to_json(self):
+		return {"kind": self.KIND, "k": self.k,
+				"counts": [[key, n, self.errors[key]]
+						   for key, n in self.counts.items()]}
+
+	@classmethod
+	def from_json(cls, data):
+		summary = cls(data["k"])
+		for key, n, error in data["counts"]:
+			summary.counts[key] = n
+			summary.errors[key] = error
+		summary.heap = [(n, key) for key, n in summary.counts.items()]
+		heapq.heapify(summary.heap)
+		return summary
+
+class Sketch(object):
+	"""Approximate stand-in for Exact in bounded memory: Count-Min for
+	counts, HyperLogLog for distinct keys and Space-Saving for the top.
+
+	Adds are summed in a small Counter first and go into the sketches as
+	one weighted add per key when it fills up (or before any read), so a
+	key that repeats is only hashed once per batch.
+	"""
+
+	KIND = "sketch"
+
+	def __init__(self, k=1000, width=2048, depth=4, p=14, batch=4096):
+		self.countmin = CountMin(width, depth)
+		self.hll = HyperLogLog(p)
+		self.heavy = SpaceSaving(k)
+		self.sum = 0
+		self.batch = batch
+		self.pending = Counter()
+
+	def add(self, key, n=1):
+		if n < 0:
+			raise ValueError("sketches only count up")
+		self.pending[key] += n
+		if len(self.pending) >= self.batch:
+			self.flush()
+
+	def flush(self):
+		for key, n in self.pending.items():
+			h = hash64(key)
+			self.countmin.add_hash(h, n)
+			self.hll.add_hash(h)
+			self.heavy.add(key, n)
+			self.sum += n
+		self.pending.clear()
+
+	def count(self, key):
+		self.flush()
+		return self.countmin.count(key)
+
+	def distinct(self):
+		self.flush()
+		return self.hll.distinct()
+
+	def top(self, k):
+		self.flush()
+		# Both overestimate, so the smaller of the two is closer
+		return sorted(((key, min(n, self.countmin.count(key)))
+					   for key, n in self.heavy.top(k)),
+					  key=lambda item: -item[1])
+
+	def singles(self):
+		"""Unknown: keys seen once cannot be told apart in a sketch"""
+
+		return None
+
+	def total(self):
+		self.flush()
+		return self.sum
+
+	def merge(self, other):
+		self.flush()
+		other.flush()
+		self.countmin.merge(other.countmin)
+		self.hll.merge(other.hll)
+		self.heavy.merge(other.heavy)
+		self.sum += other.sum
+
+	def to_json(self):
+		self.flush()
+		return {"kind": self.KIND, "countmin": self.countmin.to_json(),
+				"hll": self.hll.to_json(), "heavy": self.heavy.to_json(),
+				"sum": self.sum}
+
+	@classmethod
+	def from_json(cls, data):
+		sketch = cls()
+		sketch.countmin = CountMin.from_json(data["countmin"])
+		sketch.hll = HyperLogLog.from_json(data["hll"])
+		sketch.heavy = SpaceSaving.from_json(data["heavy"])
+		sketch.sum = data["sum"]
+		return sketch
+
+AGGREGATORS = dict((cls.KIND, cls) for cls in
+				   (Total, Exact, CountMin, HyperLogLog, SpaceSaving, Sketch))
+
+class Stats(object):
+	"""A set of named aggregators"""
+
+	def __init__(self, aggregators=()):
+		self.aggregators = OrderedDict(aggregators)
+
+	def __getitem__(self, name):
+		return self.aggregators[name]
+
+	def __contains__(self, name):
+		return name in self.aggregators
+
+	def items(self):
+		return self.aggregators.items()
+
+	def exact(self):
+		"""True if no aggregator is approximate"""
+
+		return all(isinstance(aggregator, (Exact, Total))
+				   for aggregator in self.aggregators.values())
+
+	def merge(self, other):
+		"""Add the aggregators of another (partial) run into these"""
+
+		for name, aggregator in other.items():
+			if name in self.aggregators:
+				self.aggregators[name].merge(aggregator)
+			else:
+				self.aggregators[name] = aggregator
+
+	def to_json(self):
+		return OrderedDict((name, aggregator.to_json())
+						   for name, aggregator in self.aggregators.items())
+
+	@classmethod
+	def from_json(cls, data):
+		return cls((name, AGGREGATORS[value["kind"]].from_json(value))
+				   for name, value in data.items())
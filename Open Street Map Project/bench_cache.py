@@ -0,0 +1,72 @@
+# Speedup of the row cache over parsing the XML, for the shaping stage
+# alone and for a whole conversion to CSV, on a synthetic extract.
+# Usage: python bench_cache.py [nodes]
+
+# Standard imports
+import os
+import shutil
+import sys
+import tempfile
+
+# My imports
+from contextlib import redirect_stdout
+from time import time
+
+import exploration
+from exploration import SECTIONS, convert, new_stats, read_records, row_cache
+from sinks import CsvSink
+from synthetic import generate_osm
+
+def time_records(file_name, cache):
+	"""Seconds to produce every shaped record"""
+
+	start = time()
+	for _ in read_records(file_name, cache):
+		pass
+	return time() - start
+
+def time_convert(file_name, cache, out_dir):
+	"""Seconds for a serial conversion to CSV files in out_dir"""
+
+	sections = [(section, os.path.join(out_dir, path), fields)
+				for section, path, fields in SECTIONS]
+	start = time()
+	with CsvSink(sections) as sink:
+		convert(read_records(file_name, cache), sink, new_stats())
+	return time() - start
+
+def main(nodes=200000):
+	out_dir = tempfile.mkdtemp(prefix="osm_cache_")
+	path = os.path.join(out_dir, "synthetic.osm")
+	try:
+		generate_osm(path, nodes=nodes)
+		rows = row_cache(path)
+
+		with open(os.devnull, "w") as null, redirect_stdout(null):
+			parse = time_records(path, False)
+			build = time_records(path, True)
+			read = time_records(path, True)
+			convert_parse = time_convert(path, False, out_dir)
+			convert_read = time_convert(path, True, out_dir)
+
+		print("XML: {:.1f} MB, cache: {:.1f} MB".format(
+			os.path.getsize(path) / 1e6, os.path.getsize(rows.path) / 1e6))
+		for name, seconds in (("parse + shape", parse),
+							  ("parse + shape + build cache", build),
+							  ("read cache", read),
+							  ("convert, parsing", convert_parse),
+							  ("convert, from cache", convert_read)):
+			print("{:<28} {:8.2f}s".format(name, seconds))
+		print("Shaping speedup: {:.1f}x, conversion speedup: {:.1f}x".format(
+			parse / read, convert_parse / convert_read))
+
+		# Any change to the file invalidates the cache
+		os.utime(path, ns=(0, 0))
+		print("Cache valid after touching the file: {}".format(
+			row_cache(path).valid()))
+	finally:
+		shutil.rmtree(out_dir, ignore_errors=True)
+		exploration.NORMALIZER.analyze.cache_clear()
+
+if __name__ == "__main__":
+	main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,70 @@
+# Elements per second and peak memory of each get_element() parser
+# backend on the same synthetic extract (with relations, which are not
+# kept). Every backend runs in a fresh process, so the peaks are its own.
+# Usage: python bench_parsers.py [nodes]
+
+# Standard imports
+import xml.etree.cElementTree as ET
+import multiprocessing
+import os
+import sys
+import tempfile
+
+# My imports
+from time import time
+
+from exploration import TAGS, get_element, shape_rows
+from instrument import peak_rss
+from parsers import PARSERS
+from synthetic import generate_osm
+
+def legacy_elements(file_name, tags):
+	"""get_element before the parser backends, which only cleared the root
+	after a wanted element, so skipped subtrees stayed in memory"""
+
+	context = ET.iterparse(file_name, events=('start', 'end'))
+	_, root = next(context)
+	for event, element in context:
+		if event == 'end' and element.tag in tags:
+			yield element
+			root.clear()
+
+def run_backend(args):
+	"""Parse and shape the whole file with one backend"""
+
+	backend, path = args
+	start = time()
+	if backend == "legacy":
+		elements = legacy_elements(path, TAGS)
+	else:
+		elements = get_element(path, parser=backend)
+	count = 0
+	for element in elements:
+		shape_rows(element)
+		count += 1
+	return count, time() - start, peak_rss()
+
+def main(nodes=200000):
+	fd, path = tempfile.mkstemp(suffix=".osm")
+	os.close(fd)
+	try:
+		generate_osm(path, nodes=nodes, relation_share=0.1,
+					 members_per_relation=(50, 200))
+		print("File: {:.1f} MB".format(os.path.getsize(path) / 1e6))
+
+		context = multiprocessing.get_context("spawn")
+		for backend in ["legacy"] + sorted(PARSERS):
+			pool = context.Pool(1)
+			try:
+				count, seconds, peak = pool.apply(run_backend, ((backend, path),))
+			finally:
+				pool.close()
+				pool.join()
+			print("{:<8} {:8d} elements {:10.0f} elements/s  peak RSS {}".format(
+				backend, count, count / seconds,
+				"{:.0f} MB".format(peak) if peak is not None else "n/a"))
+	finally:
+		os.remove(path)
+
+if __name__ == "__main__":
+	main(*[int(arg) for arg in sys.argv[1:]])
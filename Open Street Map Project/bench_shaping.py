@@ -0,0 +1,80 @@
+# Memory and throughput of dict shaping (shape_element + DictWriter)
+# against tuple shaping (shape_rows + csv.writer) on a synthetic extract.
+# Usage: python bench_shaping.py [nodes]
+
+# Standard imports
+import os
+import sys
+import tempfile
+import tracemalloc
+
+# My imports
+from csv import DictWriter, writer
+from time import time
+
+from exploration import SECTIONS, get_element, shape_element, shape_rows
+from synthetic import generate_osm
+
+def write_dicts(elements, out):
+	"""shape_element + one DictWriter per section"""
+
+	writers = dict((section, DictWriter(out, fields))
+				   for section, _, fields in SECTIONS)
+	for element in elements:
+		shaped = shape_element(element)
+		if element.tag == "node":
+			writers["node"].writerow(shaped["node"])
+			writers["node_tags"].writerows(shaped["node_tags"])
+		elif element.tag == "way":
+			writers["way"].writerow(shaped["way"])
+			writers["way_nodes"].writerows(shaped["way_nodes"])
+			writers["way_tags"].writerows(shaped["way_tags"])
+
+def write_rows(elements, out):
+	"""shape_rows + one csv.writer per section"""
+
+	writers = dict((section, writer(out)) for section, _, _ in SECTIONS)
+	for element in elements:
+		attribs, tags, way_nodes = shape_rows(element)
+		if element.tag == "node":
+			writers["node"].writerow(attribs)
+			writers["node_tags"].writerows(tags)
+		elif element.tag == "way":
+			writers["way"].writerow(attribs)
+			writers["way_nodes"].writerows(way_nodes)
+			writers["way_tags"].writerows(tags)
+
+def shaped_size(shape, elements):
+	"""Peak bytes allocated while holding every shaped element"""
+
+	tracemalloc.start()
+	shaped = [shape(element) for element in elements]
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	del shaped
+	return peak
+
+def main(nodes=50000):
+	fd, path = tempfile.mkstemp(suffix=".osm")
+	os.close(fd)
+	try:
+		generate_osm(path, nodes=nodes)
+		# Keep the parsed elements, so only shaping and writing are timed
+		elements = list(get_element(path))
+	finally:
+		os.remove(path)
+
+	print("Elements: {}".format(len(elements)))
+
+	with open(os.devnull, "w") as out:
+		for name, write, shape in (("dicts", write_dicts, shape_element),
+								   ("tuples", write_rows, shape_rows)):
+			start = time()
+			write(elements, out)
+			seconds = time() - start
+			print("{:<8} {:10.0f} elements/s {:8.1f} MB shaped".format(
+				name, len(elements) / seconds,
+				shaped_size(shape, elements) / 1e6))
+
+if __name__ == "__main__":
+	main(*[int(arg) for arg in sys.argv[1:]])
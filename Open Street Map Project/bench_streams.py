@@ -0,0 +1,71 @@
+# Elements per second of get_element() on the same synthetic extract,
+# plain and in every compressed format, with the multi-stream .bz2 (as
+# pbzip2 writes it) decompressed by 1 and by N workers.
+# Usage: python bench_streams.py [nodes] [workers]
+
+# Standard imports
+import bz2
+import gzip
+import lzma
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+
+# My imports
+from time import time
+
+from exploration import get_element
+from streams import multi_stream
+from synthetic import generate_osm
+
+# Uncompressed bytes per stream, pbzip2's default
+STREAM_SIZE = 900000
+
+def write_multi_stream(path, bz2_path):
+	"""Compress path into independent bzip2 streams, back to back"""
+
+	with open(path, 'rb') as xml_file, open(bz2_path, 'wb') as out:
+		for block in iter(lambda: xml_file.read(STREAM_SIZE), b''):
+			out.write(bz2.compress(block))
+
+def compress(path, out_path, opener):
+	with open(path, 'rb') as xml_file, opener(out_path, 'wb') as out:
+		shutil.copyfileobj(xml_file, out)
+
+def time_elements(path, workers=1):
+	start = time()
+	count = sum(1 for _ in get_element(path, workers=workers))
+	return count, time() - start
+
+def main(nodes=200000, workers=None):
+	workers = workers or multiprocessing.cpu_count()
+	out_dir = tempfile.mkdtemp(prefix="osm_streams_")
+	path = os.path.join(out_dir, "synthetic.osm")
+	try:
+		generate_osm(path, nodes=nodes)
+		files = [("plain", path, 1)]
+		for name, opener in (("gz", gzip.open), ("xz", lzma.open),
+							 ("bz2", bz2.open)):
+			compressed = "{}.{}".format(path, name)
+			compress(path, compressed, opener)
+			files.append((name, compressed, 1))
+		multi = os.path.join(out_dir, "multi.osm.bz2")
+		write_multi_stream(path, multi)
+		files.append(("bz2 multi-stream", multi, 1))
+		files.append(("bz2 multi-stream", multi, workers))
+		print("Multi-stream detected: single {}, multi {}".format(
+			multi_stream(path + ".bz2"), multi_stream(multi)))
+
+		for name, file_name, n in files:
+			count, seconds = time_elements(file_name, n)
+			print("{:<18} {:2d} worker(s) {:7.1f} MB {:8d} elements "
+				  "{:10.0f} elements/s".format(
+				name, n, os.path.getsize(file_name) / 1e6, count,
+				count / seconds))
+	finally:
+		shutil.rmtree(out_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+	main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,241 @@
+# Reproducible benchmarks of the converter at several scales of synthetic
+# extract: get_element, shape_element, the address normalizer and a whole
+# main() run, saved as JSON so two versions can be compared.
+#
+# Usage: python bench_suite.py [--nodes N ...] [--out results.json]
+#        python bench_suite.py --compare OLD.json NEW.json
+
+# Standard imports
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# My imports
+from contextlib import redirect_stdout
+from datetime import datetime
+from time import perf_counter
+
+import exploration
+from address import AddressNormalizer
+from synthetic import generate_osm
+
+# CONSTANTS
+
+SCALES = (10000, 50000, 200000)
+RESULTS_PATH = "bench_results.json"
+
+# A metric slower than this share of the old run is flagged by --compare
+TOLERANCE = 0.10
+
+# Generator settings: a Cambridge-like tag mix with messy street values
+EXTRACT = {"way_share": 0.2, "tag_share": 0.3, "addr_share": 0.5,
+		   "messy_share": 0.5, "relation_share": 0.01,
+		   "tags_per_element": [1, 3]}
+
+def best_of(repeat, run):
+	"""Smallest seconds (and the result) of repeat calls to run"""
+
+	best = None
+	for _ in range(repeat):
+		start = perf_counter()
+		result = run()
+		seconds = perf_counter() - start
+		if best is None or seconds < best[0]:
+			best = (seconds, result)
+	return best
+
+def rate(seconds, count):
+	return {"seconds": round(seconds, 4), "count": count,
+			"per_second": round(count / seconds, 1) if seconds else None}
+
+def bench_parse(path, repeat):
+	"""get_element alone"""
+
+	def run():
+		return sum(1 for _ in exploration.get_element(path))
+
+	seconds, count = best_of(repeat, run)
+	return rate(seconds, count)
+
+def bench_shape(path, repeat):
+	"""shape_element on every element, timed apart from parsing; also
+	returns the raw addr values seen"""
+
+	def run():
+		seconds = 0.0
+		count = 0
+		values = []
+		for element in exploration.get_element(path):
+			start = perf_counter()
+			shaped = exploration.shape_element(element)
+			seconds += perf_counter() - start
+			count += 1
+			for section in ("node_tags", "way_tags", "relation_tags"):
+				values.extend(tag["value"] for tag in shaped.get(section, ())
+							  if tag["type"] == "addr")
+		return seconds, count, values
+
+	best = None
+	for _ in range(repeat):
+		result = run()
+		if best is None or result[0] < best[0]:
+			best = result
+	seconds, count, values = best
+	return rate(seconds, count), values
+
+def bench_normalize(values, repeat):
+	"""A fresh normalizer over every addr value: cold, then with the memo
+	of the first pass"""
+
+	def cold():
+		normalizer = AddressNormalizer(exploration.safe_words,
+									   exploration.word_transforms)
+		normalizer.normalize_many(values)
+		return normalizer
+
+	seconds, normalizer = best_of(repeat, cold)
+	warm, _ = best_of(repeat, lambda: normalizer.normalize_many(values))
+	return {"cold": rate(seconds, len(values)),
+			"warm": rate(warm, len(values)),
+			"distinct": len(set(values))}
+
+def bench_main(path, out_dir, repeat, workers=1):
+	"""A whole exploration.main() run, CSV output in out_dir"""
+
+	base = exploration.settings()
+	paths = dict((name, os.path.join(out_dir, os.path.basename(base[name])))
+				 for name in base if name.endswith("_PATH"))
+	paths["XML_PATH"] = path
+
+	def run():
+		# Every run starts from an empty address memo
+		exploration.NORMALIZER.analyze.cache_clear()
+		exploration.NORMALIZER.check_word.cache_clear()
+		with open(os.devnull, "w") as null, redirect_stdout(null):
+			exploration.main(workers=workers)
+
+	exploration.configure(paths)
+	try:
+		seconds, _ = best_of(repeat, run)
+	finally:
+		exploration.configure(base)
+	return seconds
+
+def git_version():
+	"""Commit of the working tree, None outside a git checkout"""
+
+	try:
+		return subprocess.check_output(
+			["git", "describe", "--always", "--dirty"],
+			cwd=os.path.dirname(os.path.abspath(__file__)),
+			stderr=subprocess.DEVNULL).decode("ascii").strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def run_suite(scales=SCALES, repeat=3, workers=(1,)):
+	out_dir = tempfile.mkdtemp(prefix="osm_bench_")
+	results = []
+	try:
+		for nodes in scales:
+			path = os.path.join(out_dir, "synthetic_{}.osm".format(nodes))
+			generate_osm(path, nodes=nodes, **EXTRACT)
+
+			parse = bench_parse(path, repeat)
+			shape, values = bench_shape(path, repeat)
+			normalize = bench_normalize(values, repeat)
+			runs = {}
+			for n in workers:
+				seconds = bench_main(path, out_dir, repeat, n)
+				runs[str(n)] = rate(seconds, parse["count"])
+
+			result = {"nodes": nodes, "elements": parse["count"],
+					  "file_mb": round(os.path.getsize(path) / 1e6, 2),
+					  "get_element": parse, "shape_element": shape,
+					  "normalize": normalize, "main": runs}
+			results.append(result)
+			print_result(result)
+			os.remove(path)
+	finally:
+		shutil.rmtree(out_dir, ignore_errors=True)
+
+	return {"version": git_version(),
+			"date": datetime.now().isoformat(timespec="seconds"),
+			"python": platform.python_version(),
+			"platform": platform.platform(),
+			"cpus": os.cpu_count(), "repeat": repeat, "extract": EXTRACT,
+			"results": results}
+
+def metrics(result):
+	"""(name, elements or values per second) of one scale"""
+
+	yield "get_element", result["get_element"]["per_second"]
+	yield "shape_element", result["shape_element"]["per_second"]
+	yield "normalize cold", result["normalize"]["cold"]["per_second"]
+	yield "normalize warm", result["normalize"]["warm"]["per_second"]
+	for workers, run in sorted(result["main"].items()):
+		yield "main x{}".format(workers), run["per_second"]
+
+def print_result(result):
+	print("{:,} nodes, {:,} elements, {} MB:".format(
+		result["nodes"], result["elements"], result["file_mb"]))
+	for name, per_second in metrics(result):
+		print("  {:<16} {:12,.0f} /s".format(name, per_second or 0))
+	sys.stdout.flush()
+
+def compare(old, new, tolerance=TOLERANCE):
+	"""Print the change of every metric at the scales both runs share.
+	Returns the number of metrics slower by more than tolerance"""
+
+	print("{} -> {}".format(old.get("version"), new.get("version")))
+	old_results = dict((result["nodes"], result) for result in old["results"])
+	regressions = 0
+	for result in new["results"]:
+		before = old_results.get(result["nodes"])
+		if before is None:
+			continue
+		print("{:,} nodes:".format(result["nodes"]))
+		old_metrics = dict(metrics(before))
+		for name, per_second in metrics(result):
+			if not old_metrics.get(name) or not per_second:
+				continue
+			change = per_second / old_metrics[name] - 1
+			slower = change < -tolerance
+			regressions += slower
+			print("  {:<16} {:12,.0f} -> {:12,.0f} /s {:+7.1%}{}".format(
+				name, old_metrics[name], per_second, change,
+				"  SLOWER" if slower else ""))
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the OSM "
+									 "converter on synthetic extracts")
+	parser.add_argument("--nodes", type=int, nargs="+", default=list(SCALES),
+						help="extract sizes to run, in nodes")
+	parser.add_argument("--workers", type=int, nargs="+", default=[1],
+						help="worker counts for the main() runs")
+	parser.add_argument("--repeat", type=int, default=3,
+						help="keep the best of this many runs")
+	parser.add_argument("--out", default=RESULTS_PATH,
+						help="JSON file for the results")
+	parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+						help="compare two results files instead")
+	args = parser.parse_args()
+
+	if args.compare:
+		with open(args.compare[0]) as old, open(args.compare[1]) as new:
+			if compare(json.load(old), json.load(new)):
+				sys.exit(1)
+		return
+
+	suite = run_suite(args.nodes, args.repeat, args.workers)
+	with open(args.out, 'w') as results_file:
+		json.dump(suite, results_file, indent=2)
+	print("Results saved to {}".format(args.out))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,62 @@
+# Benchmark of the compiled validator against cerberus on a synthetic
+# extract.  Usage: python bench_validator.py [nodes]
+
+# Standard imports
+import os
+import sys
+import tempfile
+
+# My imports
+from time import time
+
+import schema
+from exploration import get_element, shape_element
+from synthetic import generate_osm
+from validator import Validator
+
+try:
+	import cerberus
+except ImportError:
+	cerberus = None
+
+def time_validator(validate, elements, every=1):
+	"""Seconds spent validating every Nth element"""
+
+	start = time()
+	for i, element in enumerate(elements, 1):
+		if i % every == 0 and validate(element) is not True:
+			raise ValueError("fixture element failed validation")
+	return time() - start
+
+def main(nodes=20000):
+	fd, path = tempfile.mkstemp(suffix=".osm")
+	os.close(fd)
+	try:
+		generate_osm(path, nodes=nodes)
+		elements = [shape_element(e) for e in get_element(path)]
+	finally:
+		os.remove(path)
+
+	print("Elements: {}".format(len(elements)))
+
+	compiled = Validator(schema.schema)
+	results = [("compiled, full", time_validator(compiled.validate, elements)),
+			   ("compiled, 1 in 100",
+				time_validator(compiled.validate, elements, every=100))]
+
+	if cerberus is not None:
+		validator = cerberus.Validator()
+		results.append(("cerberus, full", time_validator(
+			lambda e: validator.validate(e, schema.schema), elements)))
+	else:
+		print("cerberus is not installed, skipping it")
+
+	for name, seconds in results:
+		print("{:<20} {:8.3f}s {:10.2f} us/element".format(
+			name, seconds, seconds * 1e6 / len(elements)))
+
+	if cerberus is not None:
+		print("cerberus / compiled: {:.0f}x".format(results[2][1] / results[0][1]))
+
+if __name__ == "__main__":
+	main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,27 +1,47 @@
 # Standard imports
-import xml.etree.cElementTree as ET
 import re
 
 # For validation phase
-# import cerberus
-# import schema
+import schema
 
 # My imports
-from pprint import pprint
+import argparse
+import io
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+from pprint import pprint, pformat
 from collections import defaultdict
 from collections import Counter
 from time import time
-from csv import DictWriter
+from contextlib import redirect_stdout
+from csv import reader, writer
+from multiprocessing import Pool
 import string
 
+from address import AddressNormalizer
+from aggregators import Exact, Sketch, Stats, Total
+from instrument import Instruments
+from parsers import PARSERS
+from rowcache import RowCache
+from sinks import CsvSink, SqliteSink, table_name
+from streams import FORMATS, compression, open_counted, open_stream
+from validator import Validator, ValidationError
+
 # CONSTANTS
 
 MIN_LAT = 42.3409
 MAX_LAT = 42.4162
 MIN_LON = -71.1995
 MAX_LON = -71.0251
-TAGS =  ("node", "way") # 'relation' for added spiciness
-# SCHEMA = schema.schema # For validation phase
+TAGS =  ("node", "way", "relation")
+PARSER = "etree" # or "expat", see parsers.py
+SCHEMA = schema.schema
+BATCH_SIZE = 50000 # rows per insert, sink="sqlite"
+CHECKPOINT_EVERY = 500000 # elements per commit, sink="sqlite"
 
 # PATH CONSTANTS
 XML_PATH = "Data\\cambridge.xml"
@@ -30,6 +50,15 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+RELATIONS_PATH = "relations.csv"
+RELATION_MEMBERS_PATH = "relation_members.csv"
+RELATION_TAGS_PATH = "relation_tags.csv"
+RELATION_GEOMETRY_PATH = "relation_geometry.csv"
+WAY_GEOMETRY_PATH = "way_geometry.csv"
+BOXED_OUT_PATH = "boxed_out_nodes.csv"
+NODE_LOCATIONS_PATH = "node_locations.bin" # scratch, see spatial.py
+DB_PATH = "cambridge.db"
+STATS_PATH = "stats.json"
 
 # FIELD CONSTANTS
 NODE_FIELDS = ['id', 'lat', 'lon', 'user', 'uid',
@@ -38,6 +67,27 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_MEMBERS_FIELDS = ['id', 'member_id', 'member_type', 'role',
+						   'position']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+RELATION_GEOMETRY_FIELDS = ['id', 'member_id', 'role', 'position', 'nodes',
+							'missing', 'min_lat', 'max_lat', 'min_lon',
+							'max_lon', 'wkt']
+WAY_GEOMETRY_FIELDS = ['id', 'nodes', 'missing', 'length', 'min_lat',
+					   'max_lat', 'min_lon', 'max_lon', 'wkt']
+BOXED_OUT_FIELDS = ['id', 'version', 'timestamp']
+
+# Positions in the shape_rows() tuples
+NODE_LAT = NODE_FIELDS.index('lat')
+NODE_LON = NODE_FIELDS.index('lon')
+NODE_USER = NODE_FIELDS.index('user')
+NODE_VERSION = NODE_FIELDS.index('version')
+WAY_USER = WAY_FIELDS.index('user')
+WAY_VERSION = WAY_FIELDS.index('version')
+RELATION_USER = RELATION_FIELDS.index('user')
+RELATION_VERSION = RELATION_FIELDS.index('version')
+TIMESTAMP = -1 # last for both nodes and ways
 
 # RE "CONSTANTS"
 
@@ -87,115 +137,170 @@ word_transforms = {
 	"LEVEL" : "Level"
 }
 
-# Helper Functions
+NORMALIZER = AddressNormalizer(safe_words, word_transforms,
+							   questionable_words, addr_values)
 
-def get_element(file_name, tags=TAGS):
-	"""Yield element if it is the right type of tag"""
+# Helper Functions
 
-	context = ET.iterparse(file_name, events=('start', 'end'))
-	_, root = next(context)
-	for event, element in context:
-		if event == 'end' and element.tag in tags:
+def get_element(file_name, tags=TAGS, parser=PARSER, workers=1, meter=None):
+	"""Yield element if it is the right type of tag. Compressed files are
+	decompressed on the fly (see streams.py), by workers processes for a
+	multi-stream .bz2. With meter (see instrument.py) parsing is timed and
+	followed through the file for progress"""
+
+	if meter is not None:
+		if isinstance(file_name, str):
+			elements = parse_stream(file_name, tags, parser, workers, meter)
+		else:
+			elements = PARSERS[parser](file_name, tags)
+		return meter.timed("parse", elements)
+	if isinstance(file_name, str) and compression(file_name):
+		return parse_stream(file_name, tags, parser, workers)
+	return PARSERS[parser](file_name, tags)
+
+def parse_stream(file_name, tags, parser, workers, meter=None):
+	if meter is None:
+		xml_file = counter = open_stream(file_name, 'rb', workers)
+	else:
+		xml_file, counter = open_counted(file_name, workers)
+		meter.watch(lambda: counter.count, os.path.getsize(file_name))
+	try:
+		for element in PARSERS[parser](xml_file, tags):
 			yield element
-			root.clear()
+	finally:
+		xml_file.close()
+		counter.close()
+
+def shape_rows(element,
+			   problem_chars=PROBLEMCHARS,
+			   default_tag_type="regular",
+			   problem_keys=None):
+	"""Shape node, way or relation XML element to plain tuples in *_FIELDS
+	order.
+
+	Returns (attribs, tags, way_nodes) where tags and way_nodes are lists
+	of rows (for a relation, way_nodes holds its members); a csv.writer or
+	executemany takes them as they are, with no per-row dict to build and
+	look up again. Skipped tag keys are printed, and added to the
+	problem_keys list if one is given.
+	"""
+
+	attrib = element.attrib
+	id = attrib['id']
+	tags = []  # Handle secondary tags the same way for both node and way elements
+	way_nodes = []
+
+	if element.tag == 'node':
+		attribs = (id, attrib['lat'], attrib['lon'], attrib['user'],
+				   attrib['uid'], attrib['version'], attrib['changeset'],
+				   attrib['timestamp'])
+	elif element.tag in ('way', 'relation'):
+		attribs = (id, attrib['user'], attrib['uid'], attrib['version'],
+				   attrib['changeset'], attrib['timestamp'])
+	else:
+		return None
+
+	n = 0
+	position = 0
+	for i in element:
+		if i.tag == 'tag':
+			k = i.attrib['k']
+
+			if problem_chars.match(k):
+				print(k)
+				if problem_keys is not None:
+					problem_keys.append(k)
+				continue
+
+			if ':' in k:
+				# n is shared with the nd position below, as it always was
+				n = k.find(':')
+				tags.append((id, k[n+1:], i.attrib['v'], k[:n]))
+			else:
+				tags.append((id, k, i.attrib['v'], default_tag_type))
+
+		elif i.tag == 'nd' and element.tag == 'way':
+			way_nodes.append((id, i.attrib['ref'], n))
+			n += 1
+
+		elif i.tag == 'member' and element.tag == 'relation':
+			member = i.attrib
+			way_nodes.append((id, member['ref'], member['type'],
+							  member['role'], position))
+			position += 1
+
+	return attribs, tags, way_nodes
+
+def rows_to_dicts(type, attribs, tags, way_nodes):
+	"""Turn shape_rows() output back into the dict shape of shape_element"""
+
+	if type == 'node':
+		return {'node': dict(zip(NODE_FIELDS, attribs)),
+				'node_tags': [dict(zip(NODE_TAGS_FIELDS, t)) for t in tags]}
+
+	if type == 'relation':
+		return {'relation': dict(zip(RELATION_FIELDS, attribs)),
+				'relation_members': [dict(zip(RELATION_MEMBERS_FIELDS, m))
+									 for m in way_nodes],
+				'relation_tags': [dict(zip(RELATION_TAGS_FIELDS, t))
+								  for t in tags]}
+
+	return {'way': dict(zip(WAY_FIELDS, attribs)),
+			'way_nodes': [dict(zip(WAY_NODES_FIELDS, w)) for w in way_nodes],
+			'way_tags': [dict(zip(WAY_TAGS_FIELDS, t)) for t in tags]}
 
 def shape_element(element,
 				node_attr_fields=NODE_FIELDS,
 				way_attr_fields=WAY_FIELDS,
 				problem_chars=PROBLEMCHARS,
 				default_tag_type="regular"):
-	"""Clean and shape node or way XML element to Python dict"""
+	"""Clean and shape node, way or relation XML element to Python dict"""
 
-	node_attribs = {}
-	way_attribs = {}
-	way_nodes = []
-	tags = []  # Handle secondary tags the same way for both node and way elements
+	rows = shape_rows(element, problem_chars, default_tag_type)
+	if rows is not None:
+		return rows_to_dicts(element.tag, *rows)
 
-	# YOUR CODE HERE
-	if element.tag == 'node':
-		node_attribs['changeset'] = element.attrib['changeset']
-		node_attribs['id'] = element.attrib['id']
-		node_attribs['lat'] = element.attrib['lat']
-		node_attribs['lon'] = element.attrib['lon']
-		node_attribs['timestamp'] = element.attrib['timestamp']
-		node_attribs['uid'] = element.attrib['uid']
-		node_attribs['user'] = element.attrib['user']
-		node_attribs['version'] = element.attrib['version']
-
-		for i in element.iter():
-			if i.tag == 'tag':
-				tag_dict = {}
-				tag_dict["id"] = node_attribs['id']
-				tag_dict["value"] = i.attrib['v']
-
-				if problem_chars.match(i.attrib['k']):
-					print(i.attrib['k'])
-					continue
-
-				if ':' in i.attrib['k']:
-					n = i.attrib['k'].find(':')
-					tag_dict['type'] = i.attrib['k'][:n]
-					tag_dict['key'] = i.attrib['k'][n+1:]
-
-				else:
-					tag_dict['key'] = i.attrib['k']
-					tag_dict['type'] = default_tag_type
-
-				tags.append(tag_dict)
-
-		return ({'node': node_attribs, 'node_tags': tags})
-
-	elif element.tag == 'way':
-		way_attribs['changeset'] = element.attrib['changeset']
-		way_attribs['id'] = element.attrib['id']
-		way_attribs['timestamp'] = element.attrib['timestamp']
-		way_attribs['uid'] = element.attrib['uid']
-		way_attribs['user'] = element.attrib['user']
-		way_attribs['version'] = element.attrib['version']
-
-		n = 0
-		for i in element.iter():
-			if i.tag == 'tag':
-				tag_dict = {}
-				tag_dict["id"] = way_attribs['id']
-				tag_dict["value"] = i.attrib['v']
-
-				if problem_chars.match(i.attrib['k']):
-					print(i.attrib['k'])
-					continue
-
-				if ':' in i.attrib['k']:
-					n = i.attrib['k'].find(':')
-					tag_dict['type'] = i.attrib['k'][:n]
-					tag_dict['key'] = i.attrib['k'][n+1:]
-				else:
-					tag_dict['key'] = i.attrib['k']
-					tag_dict['type'] = default_tag_type
-
-				tags.append(tag_dict)
-
-			elif i.tag == 'nd':
-				node_dict = {}
-				node_dict['id'] = element.attrib['id']
-				node_dict['node_id'] = i.attrib['ref']
-				node_dict['position'] = n
-
-				n += 1
-
-				way_nodes.append(node_dict)
-
-		return ({'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags})
-
-"""Validation Phase
-def validate_element(element, validator, schema=SCHEMA):
-	# Raise ValidationError if element does not match schema
-	if validator.validate(element, schema) is not True:
-		field, errors = next(validator.errors.iteritems())
+def shape_elements(elements):
+	"""Yield (type, rows, problem keys) records for a stream of elements"""
+
+	for element in elements:
+		problem_keys = []
+		rows = shape_rows(element, problem_keys=problem_keys)
+		yield element.tag, rows, problem_keys
+
+def row_cache(file_name):
+	"""Row cache of file_name, keyed on the shaping settings as well"""
+
+	return RowCache(file_name, (TAGS, PROBLEMCHARS.pattern))
+
+def read_records(file_name, cache=False, parser=PARSER, workers=1,
+				 meter=None):
+	"""Shaped records of file_name. With cache they are read from the row
+	cache kept next to the file, which is (re)built while parsing whenever
+	it is missing or out of date"""
+
+	if not cache:
+		return shape_elements(get_element(file_name, parser=parser,
+										  workers=workers, meter=meter))
+
+	rows = row_cache(file_name)
+	if rows.valid():
+		return rows.records()
+	return rows.build(shape_elements(get_element(file_name, parser=parser,
+												 workers=workers,
+												 meter=meter)))
+
+# Validation Phase
+
+def validate_element(element, validator):
+	"""Raise ValidationError if element does not match schema"""
+
+	if validator.validate(element) is not True:
+		field, errors = next(iter(validator.errors.items()))
 		message_string = "\nElement of type '{0}' has the following errors:\n{1}"
-		error_string = pprint.pformat(errors)
+		error_string = pformat(errors)
 
-		raise Exception(message_string.format(field, error_string))
-"""
+		raise ValidationError(message_string.format(field, error_string))
 
 # Exploration Tests // Filters
 
@@ -203,271 +308,594 @@ def in_box(lat, lon):
 	return lat <= MAX_LAT and lat >= MIN_LAT and \
 		lon <= MAX_LON and lon >= MIN_LON
 
-def bad_zip(num_str):
-	# Bad zip are likely 4 digits (missing leading 0) 
-	# or has more than 5 digit
+def boxed_out_row(attribs):
+	"""What is kept of a node outside the box: enough for incremental.py
+	to take it back out of the counters"""
+
+	return (attribs[0], attribs[NODE_VERSION], attribs[TIMESTAMP])
 
-	# Cambridge Zip Code Include: 
-	# 02114, 02138, 02140, 02142, 02238, 02134, 02139, 02141, 02163
-	potential_zips = ["2114", "2138", "2140", "2142", "2238", "2134", 
-					  "2139", "2141", "2163"]
+# Output Helpers
 
-	if num_str in potential_zips:
-		return True
+def build_sections():
+	"""(section, path, fields) of every output, from the path constants"""
 
-	return len(num_str) > 5
+	return (("node", NODES_PATH, NODE_FIELDS),
+			("node_tags", NODE_TAGS_PATH, NODE_TAGS_FIELDS),
+			("way", WAYS_PATH, WAY_FIELDS),
+			("way_nodes", WAY_NODES_PATH, WAY_NODES_FIELDS),
+			("way_tags", WAY_TAGS_PATH, WAY_TAGS_FIELDS),
+			("relation", RELATIONS_PATH, RELATION_FIELDS),
+			("relation_members", RELATION_MEMBERS_PATH, RELATION_MEMBERS_FIELDS),
+			("relation_tags", RELATION_TAGS_PATH, RELATION_TAGS_FIELDS),
+			("boxed_out", BOXED_OUT_PATH, BOXED_OUT_FIELDS))
 
-def good_word(word):
-	# Filter out words that are likely not needed to be checked manually
-	# Abbreviation longer than 3 letters are very rare
-	# No punctual
-	# Is in title form (istitle() returns true)
-	return len(word) > 3 and word.istitle() and word.isalpha() \
-		   and word.lower() != "pkwy"
+SECTIONS = build_sections()
 
-def long_zip(zip):
-	return len(zip) == 10 and zip[:5].isdigit() and zip[6:].isdigit \
-		   and zip[5] == '-'
+def output_sections(compress=None, way_geometry=False):
+	"""SECTIONS (and the way geometry), with the CSV paths ending in .gz,
+	.bz2, ... for compress"""
 
-def door_number(word):
-	return word.isdigit() or word[:-1].isdigit()
+	sections = SECTIONS
+	if way_geometry:
+		sections += (("way_geometry", WAY_GEOMETRY_PATH, WAY_GEOMETRY_FIELDS),)
+	if not compress:
+		return sections
+	return tuple((section, "{}.{}".format(path, compress), fields)
+				 for section, path, fields in sections)
 
-def multi_door(word):
-	nums = ""
-	if "," in word:
-		nums = [x.strip() for x in word.split(",")]
+def new_stats(approximate=False):
+	"""Aggregators for keeping track of useful information in the data.
 
-	elif "-" in word:
-		nums = [x.strip() for x in word.split("-")]
+	The per user counters grow with the number of contributors; with
+	approximate they are bounded size sketches instead (see aggregators.py).
+	"""
 
-	for num in nums:
-		if not num.isdigit():
-			return False
-	return True
+	users = Sketch if approximate else Exact
+
+	return Stats([
+		("node_type", Exact()),
+		("node_users", users()),
+		("way_users", users()),
+		("relation_users", users()),
+		("key_cntr", Exact()),
+		("boxed_out", Exact()),
+		("years", Exact()),
+		("node_tags", Exact()),
+		("node_tag_types", Exact()),
+		("way_tags", Exact()),
+		("way_tag_types", Exact()),
+		("total_node_edits", Total()),
+		("total_way_edits", Total()),
+		("total_relation_edits", Total()),
+		("addr_cache_hits", Total()),
+		("addr_cache_misses", Total())
+	])
+
+def save_stats(stats, path=None):
+	"""Keep the counters of a run, for incremental.py to update"""
+
+	with open(path or STATS_PATH, 'w') as stats_file:
+		json.dump(stats.to_json(), stats_file)
+
+def load_stats(path=None):
+	with open(path or STATS_PATH) as stats_file:
+		return Stats.from_json(json.load(stats_file))
+
+def convert(records, sink, stats, done=0, validator=None, nodes=None,
+			meter=None, geometry=None):
+	"""Process a stream of shaped records into sink, skipping the first
+	done (already loaded by an interrupted run of a resumable sink).
+	The coordinates of all nodes are added to the nodes store if given,
+	ways are resolved by geometry (a spatial.WayGeometry) if given, and
+	the stages are timed by meter if given."""
+
+	info = NORMALIZER.cache_info()
+	every = sink.checkpoint_every
+	process, writers, checkpoint = process_rows, sink.writers, sink.checkpoint
+	if meter is not None:
+		records = meter.records(records)
+		process = meter.timer("process", process_rows)
+		writers = meter.writers(writers)
+		checkpoint = meter.timer("commit", checkpoint)
+		meter.patch(NORMALIZER, "clean_rows", "clean")
+
+	n = done
+	try:
+		for n, (type, rows, _) in enumerate(records, 1):
+			if n <= done:
+				if type == "node":
+					attribs = rows[0]
+					lat = float(attribs[NODE_LAT])
+					lon = float(attribs[NODE_LON])
+					if nodes is not None:
+						nodes.add(attribs[0], lat, lon)
+					if geometry is not None:
+						geometry.add_node(attribs[0], lat, lon)
+				continue
+			process(type, rows, writers, stats, validator, nodes, geometry)
+			if every and n % every == 0:
+				if geometry is not None:
+					geometry.flush()
+				info = count_cache(stats, info)
+				checkpoint(n, stats.to_json())
+		if geometry is not None:
+			geometry.flush()
+		count_cache(stats, info)
+		# The counters a finished load keeps
+		checkpoint(n, stats.to_json(), final=True)
+	finally:
+		if meter is not None:
+			meter.unpatch()
+
+def count_cache(stats, info):
+	"""Add the address memo lookups made since info to stats"""
+
+	now = NORMALIZER.cache_info()
+	stats["addr_cache_hits"].add(now.hits - info.hits)
+	stats["addr_cache_misses"].add(now.misses - info.misses)
+	return now
+
+def process_rows(type, rows, writers, stats, validator=None, nodes=None,
+				 geometry=None):
+	"""Clean, (validate,) count and write out the shaped rows of a single
+	node or way element"""
+
+	attribs, tags, way_nodes = rows
+
+	# both node and way information
+	stats["years"].add(attribs[TIMESTAMP][0:4])
+
+	# Correct addr information
+	NORMALIZER.clean_rows(tags)
+
+	if validator is not None and validator.due():
+		validate_element(rows_to_dicts(type, attribs, tags, way_nodes),
+						 validator)
+
+	# node information
+	if type == "node":
+		lat, lon = float(attribs[NODE_LAT]), float(attribs[NODE_LON])
+		if nodes is not None:
+			nodes.add(attribs[0], lat, lon)
+		if geometry is not None:
+			geometry.add_node(attribs[0], lat, lon)
+
+		if not in_box(lat, lon):
+			stats["boxed_out"].add("node")
+			writers["boxed_out"].writerow(boxed_out_row(attribs))
+			return
+
+		stats["node_type"].add(type)
+		stats["node_users"].add(attribs[NODE_USER])
+		stats["total_node_edits"].add(int(attribs[NODE_VERSION]))
+
+		""" # Analyze node tag information
+		for e in tags:
+			for key, value in zip(NODE_TAGS_FIELDS, e):
+				# id, value, key, type
+
+				# id = numerical id
+				# value = description of item
+				# key = summary of item, type
+				# type - regular, addr, various other types
+				stats["node_tags"].add(key)
+
+				if key == "type":
+					stats["node_tag_types"].add(value)
+		"""
+
+		# Write to CSV
+		try:
+			writers["node"].writerow(attribs)
+			writers["node_tags"].writerows(tags)
+		except:
+			pass
+
+	# way information
+	if type == "way":
+
+		stats["node_type"].add(type)
+		stats["way_users"].add(attribs[WAY_USER])
+		stats["total_way_edits"].add(int(attribs[WAY_VERSION]))
+
+		""" # Analyze way tag information
+		# 'way_tags'
+		for e in tags:
+			for key, value in zip(WAY_TAGS_FIELDS, e):
+				# id, value, key, type
+
+				# id = numeric id
+				# value = Descriptions, or ways to find more info
+				# key = type information
+				# type = type information - regular, massgis, addr
+				stats["way_tags"].add(key)
+
+				if key == "type":
+					stats["way_tag_types"].add(value)
+		"""
+
+		try:
+			writers["way"].writerow(attribs)
+			writers["way_nodes"].writerows(way_nodes)
+			writers["way_tags"].writerows(tags)
+		except:
+			pass
+
+		if geometry is not None:
+			geometry.add_way(attribs[0], [nd[1] for nd in way_nodes])
+
+	# relation information
+	if type == "relation":
+
+		stats["node_type"].add(type)
+		stats["relation_users"].add(attribs[RELATION_USER])
+		stats["total_relation_edits"].add(int(attribs[RELATION_VERSION]))
+
+		try:
+			writers["relation"].writerow(attribs)
+			writers["relation_members"].writerows(way_nodes)
+			writers["relation_tags"].writerows(tags)
+		except:
+			pass
+
+# Parallel Conversion
+
+SHARDS_PER_WORKER = 4
+ELEMENT_START = re.compile(br'<(?:node|way|relation)[\s/>]')
+
+def next_element(xml_file, offset, limit, chunk_size=1 << 16):
+	"""Byte offset of the first top level element tag at or after offset"""
+
+	while offset < limit:
+		xml_file.seek(offset)
+		# Overlap the chunks so a tag split between two reads is still found
+		match = ELEMENT_START.search(xml_file.read(chunk_size + 16))
+		if match:
+			return min(offset + match.start(), limit)
+		offset += chunk_size
+	return limit
+
+def find_shards(file_name, count):
+	"""Split the body of an OSM file into (start, end) byte ranges that
+	each begin on a <node>, <way> or <relation> tag"""
+
+	size = os.path.getsize(file_name)
+	with open(file_name, 'rb') as xml_file:
+		xml_file.seek(max(size - 4096, 0))
+		tail = xml_file.read()
+		end = tail.rfind(b'</osm>')
+		end = size if end == -1 else size - len(tail) + end
+
+		bounds = [next_element(xml_file, 0, end)]
+		for i in range(1, count):
+			target = bounds[0] + (end - bounds[0]) * i // count
+			offset = next_element(xml_file, target, end)
+			if offset > bounds[-1]:
+				bounds.append(offset)
+		if end > bounds[-1]:
+			bounds.append(end)
+
+	return list(zip(bounds[:-1], bounds[1:]))
+
+class ShardReader(object):
+	"""File-like view of one byte range of an OSM file, wrapped in an
+	<osm> root so iterparse sees a complete document"""
+
+	def __init__(self, file_name, start, end):
+		self.xml_file = open(file_name, 'rb')
+		self.xml_file.seek(start)
+		self.remaining = end - start
+		self.head = b'<osm>'
+		self.tail = b'</osm>'
+
+	def read(self, size=-1):
+		if self.head:
+			data, self.head = self.head, b''
+			return data
+		if self.remaining > 0:
+			if size < 0 or size > self.remaining:
+				size = self.remaining
+			data = self.xml_file.read(size)
+			self.remaining -= len(data)
+			if data:
+				return data
+			self.remaining = 0
+		self.close()
+		data, self.tail = self.tail, b''
+		return data
+
+	def close(self):
+		self.xml_file.close()
+
+def convert_shard(task):
+	"""Convert one shard into headerless CSV parts. Runs in a worker
+	process, so the counters (and timers) and anything printed go back to
+	the parent"""
+
+	(file_name, start, end, out_dir, index, validate, collect_nodes, skip,
+	 parser, approximate, timed) = task
+
+	stats = new_stats(approximate)
+	nodes = None
+	if collect_nodes:
+		from spatial import NodeStore
+		nodes = NodeStore()
+	meter = Instruments() if timed and not skip else None
+	elements = get_element(ShardReader(file_name, start, end), parser=parser,
+						   meter=meter)
+
+	# Shard already loaded by an interrupted run: only its nodes are needed
+	if skip:
+		for element in elements:
+			if element.tag == "node":
+				nodes.add(element.attrib["id"], float(element.attrib["lat"]),
+						  float(element.attrib["lon"]))
+		return {}, stats, Counter(), Counter(), "", nodes.buffers(), None
+
+	questionable_words.clear()
+	addr_values.clear()
+
+	sections = []
+	for section, _, fields in SECTIONS:
+		path = os.path.join(out_dir, "{}.{}.csv".format(section, index))
+		sections.append((section, path, fields))
+
+	output = io.StringIO()
+	with CsvSink(sections, header=False) as sink, redirect_stdout(output):
+		validator = Validator(SCHEMA, every=validate) if validate else None
+		convert(shape_elements(elements), sink, stats, validator=validator,
+				nodes=nodes, meter=meter)
+
+	paths = dict((section, path) for section, path, _ in sections)
+
+	return (paths, stats, Counter(questionable_words), Counter(addr_values),
+			output.getvalue(), nodes.buffers() if nodes is not None else None,
+			(dict(meter.times), meter.elements) if meter is not None else None)
+
+def convert_parallel(file_name, sink, stats, workers, validate=0,
+					 nodes=None, parser=PARSER, meter=None, geometry=None):
+	"""Convert file_name with a pool of workers, merging the shards back
+	in file order so the result matches a serial run. Returns the shards
+	loaded, or -1 if the sink already held them all.
+
+	With geometry the workers send back their nodes, and the ways of each
+	shard are resolved from its way_nodes part as it is merged, so they
+	see the nodes of every shard before them."""
+
+	shards = find_shards(file_name, workers * SHARDS_PER_WORKER)
+	done = resume(sink, file_name, "shards/{}".format(len(shards)), stats)
+	if done < 0:
+		return done
+	loaded = done
+
+	collect_nodes = nodes is not None or geometry is not None
+	out_dir = tempfile.mkdtemp(prefix="osm_shards_")
+	tasks = [(file_name, start, end, out_dir, i, validate, collect_nodes,
+			  i < loaded, parser, not stats.exact(), meter is not None)
+			 for i, (start, end) in enumerate(shards)]
+	if not collect_nodes:
+		tasks = tasks[loaded:]
+
+	copy_part, checkpoint = sink.copy_part, sink.checkpoint
+	if meter is not None:
+		# Progress goes by the end of the last shard merged
+		position = [0]
+		meter.watch(lambda: position[0], os.path.getsize(file_name))
+		copy_part = meter.timer("merge", copy_part)
+		checkpoint = meter.timer("commit", checkpoint)
+
+	# Workers started by spawn rather than fork import the module afresh
+	pool = Pool(workers, initializer=configure, initargs=(settings(),))
+	try:
+		for task, (paths, shard_stats, words, values, output, node_buffers,
+				   timers) in zip(tasks, pool.imap(convert_shard, tasks)):
+			if nodes is not None:
+				nodes.extend(node_buffers)
+			if geometry is not None:
+				geometry.locations.extend(node_buffers)
+			if not paths:
+				continue
+
+			sys.stdout.write(output)
+			stats.merge(shard_stats)
+			questionable_words.update(words)
+			addr_values.update(values)
+
+			if geometry is not None:
+				for way, refs in part_ways(paths["way"],
+												 paths["way_nodes"]):
+					geometry.add_way(way, refs)
+				geometry.flush()
+
+			for section, path in paths.items():
+				copy_part(section, path)
+				os.remove(path)
+			done += 1
+			checkpoint(done, stats.to_json())
+
+			if meter is not None:
+				meter.add(*timers)
+				position[0] = task[2]
+				if meter.progress:
+					meter.tick()
+		checkpoint(done, stats.to_json(), final=True)
+		pool.close()
+	finally:
+		pool.terminate()
+		shutil.rmtree(out_dir, ignore_errors=True)
+
+	return done
+
+def part_ways(ways_path, way_nodes_path):
+	"""(way id, node refs) of every way in the way and way_nodes parts of
+	a shard, in order"""
+
+	with open(ways_path, newline='') as ways, \
+			open(way_nodes_path, newline='') as way_nodes:
+		nds = reader(way_nodes)
+		nd = next(nds, None)
+		for row in reader(ways):
+			refs = []
+			while nd is not None and nd[0] == row[0]:
+				refs.append(nd[1])
+				nd = next(nds, None)
+			yield row[0], refs
+
+# Relation Geometry
+
+def read_section(sink, section, compress=None):
+	"""Stream the rows of one section back out of the finished output"""
+
+	path, fields = [(p, f) for s, p, f in output_sections(compress)
+					if s == section][0]
+	if sink == "sqlite":
+		db = sqlite3.connect(DB_PATH)
+		try:
+			for row in db.execute("SELECT {} FROM {} ORDER BY rowid".format(
+					", ".join(fields), table_name(path))):
+				yield row
+		finally:
+			db.close()
+	else:
+		with open_stream(path, 'rt', newline='') as csv_file:
+			rows = reader(csv_file)
+			next(rows)
+			for row in rows:
+				yield row
+
+def write_relation_geometry(sink, node_store, compress=None):
+	"""Write the line geometry of every way member of a relation to
+	RELATION_GEOMETRY_PATH, looking nodes up in the memory-mapped store"""
+
+	from spatial import NodeStore, member_geometry
+
+	path = RELATION_GEOMETRY_PATH
+	if compress and sink != "sqlite":
+		path = "{}.{}".format(path, compress)
+
+	store = NodeStore.load(node_store, mmap_mode='r')
+	with open_stream(path, 'wt') as csv_file:
+		out = writer(csv_file)
+		out.writerow(RELATION_GEOMETRY_FIELDS)
+		out.writerows(member_geometry(
+			store, lambda: read_section(sink, "relation_members", compress),
+			lambda: read_section(sink, "way_nodes", compress)))
+
+# Run Profiles
+
+# Module constants a run profile may set (see profiles.py)
+SETTINGS = ("XML_PATH", "NODES_PATH", "NODE_TAGS_PATH", "WAYS_PATH",
+			"WAY_NODES_PATH", "WAY_TAGS_PATH", "RELATIONS_PATH",
+			"RELATION_MEMBERS_PATH", "RELATION_TAGS_PATH",
+			"RELATION_GEOMETRY_PATH", "WAY_GEOMETRY_PATH", "BOXED_OUT_PATH",
+			"NODE_LOCATIONS_PATH", "DB_PATH", "STATS_PATH", "MIN_LAT",
+			"MAX_LAT", "MIN_LON", "MAX_LON", "safe_words", "word_transforms",
+			"BATCH_SIZE", "CHECKPOINT_EVERY", "SHARDS_PER_WORKER")
+
+def settings():
+	"""Current values of SETTINGS, by name"""
+
+	return dict((name, globals()[name]) for name in SETTINGS)
+
+def configure(values):
+	"""Set SETTINGS by name for the next run. The compiled address rules,
+	and their memo of cleaned values, are only rebuilt if the rule tables
+	change"""
+
+	global SECTIONS, NORMALIZER
+
+	unknown = set(values) - set(SETTINGS)
+	if unknown:
+		raise ValueError("unknown settings: {}".format(
+			", ".join(sorted(unknown))))
+
+	rules = (safe_words, word_transforms)
+	globals().update(values)
+	SECTIONS = build_sections()
+	if (safe_words, word_transforms) != rules:
+		NORMALIZER = AddressNormalizer(safe_words, word_transforms,
+									   questionable_words, addr_values)
 
 # Main
 
-def main():
-	"""
-	Validation phase is removed due to shape_element pass validation for
-	the whole dataset passed into it. It's removed thereafter to improve
-	performance and simply code.
-	"""
+def resume(sink, file_name, unit, stats):
+	"""Pick up the counters of an interrupted load and return how many
+	units to skip, or -1 if the sink already holds the complete load"""
+
+	done, saved = sink.resume(file_name, unit)
+	if saved:
+		stats.merge(Stats.from_json(saved))
+	if done:
+		print("Resuming {} after {} {}".format(file_name, done, unit)
+			  if done > 0 else "{} is already loaded".format(file_name))
+	return done
 
-	# Counters for keeping track of useful information in the data
-	node_type = Counter()
-	node_users = Counter()
-	way_users = Counter()
-	key_cntr = Counter()
-	boxed_out = defaultdict(int)
-	years = Counter()
-	node_tags = Counter()
-	node_tag_types = Counter()
-	way_tags = Counter()
-	way_tag_types = Counter()
-	total_node_edits = 0
-	total_way_edits = 0
-
-	# Initiate csv writers for creating csv files for different data
-	with open(NODES_PATH, 'w') as nodes_file, \
-		open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-		open(WAYS_PATH, 'w') as ways_file, \
-		open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-		open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-		nodes_writer = DictWriter(nodes_file, NODE_FIELDS)
-		node_tags_writer = DictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-		ways_writer = DictWriter(ways_file, WAY_FIELDS)
-		way_nodes_writer = DictWriter(way_nodes_file, WAY_NODES_FIELDS)
-		way_tags_writer = DictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-		nodes_writer.writeheader()
-		node_tags_writer.writeheader()
-		ways_writer.writeheader()
-		way_nodes_writer.writeheader()
-		way_tags_writer.writeheader()
-
-		for element in get_element(XML_PATH):
-			type = element.tag
-
-			element = shape_element(element)
-
-			# both node and way information
-			years[element[type]["timestamp"][0:4]] += 1
-
-			# Correct addr information
-			for e in element[type+"_tags"]:
-				if e["type"] == "addr":
-					if e["value"].isdigit():
-						if not bad_zip(e["value"]):
-							continue
-						else:
-							questionable_words[e["value"]] += 1
-
-					if long_zip(e["value"]):
-						e["value"] = e["value"][:5]
-						continue
-
-					if multi_door(e["value"]):
-						continue
-
-					words = e["value"].split()
-
-					for word in words:
-						if word not in safe_words:
-							if good_word(word) or \
-								(word[-1] == "," and good_word(word[:-1])):
-								continue
-							if multi_door(word):
-								continue
-
-							if word in word_transforms.keys():
-								word = word_transforms[word]
-							elif "," in word:
-								sub_words = word.split(",")
-								for sub_word in sub_words:
-									sub_word.strip()
-
-									if door_number(sub_word):
-										continue
-
-									if sub_word in word_transforms.keys():
-										sub_word = word_transforms[sub_word]
-									else:
-										questionable_words[word] += 1
-										addr_values[e["value"]] += 1
-								# use Oxford comma
-								word = ", ".join(sub_words) 
-							else:
-								questionable_words[word] += 1
-								addr_values[e["value"]] += 1
-
-					e["value"] = " ".join(words)
-
-			# node information
-			if type == "node":
-				if not in_box(float(element[type]["lat"]),
-							  float(element[type]["lon"])):
-					boxed_out["node"] += 1
-					continue
-
-				node_type[type] += 1
-				node_users[element[type]["user"]] += 1
-				total_node_edits += int(element[type]["version"])
-
-				""" # Analyze node tag information
-				for e in element["node_tags"]:
-					for key in e.keys():
-						# id, value, key, type
-
-						# id = numerical id
-						# value = description of item
-						# key = summary of item, type
-						# type - regular, addr, various other types
-						node_tags[key] += 1
-
-						if key == "type":
-							node_tag_types[e[key]] += 1
-				"""
-
-				# Write to CSV
-				try:
-					nodes_writer.writerow(element['node'])
-					node_tags_writer.writerows(element['node_tags'])
-				except:
-					pass
-
-			# way information
-			if type == "way":
-
-				node_type[type] += 1
-				way_users[element[type]["user"]] += 1
-				total_way_edits += int(element[type]["version"])
-
-				""" # Analyze way tag information
-				# 'way_tags'
-				for e in element["way_tags"]:
-					for key in e.keys():
-						# id, value, key, type
-
-						# id = numeric id
-						# value = Descriptions, or ways to find more info
-						# key = type information
-						# type = type information - regular, massgis, addr
-						way_tags[key] += 1
-
-						if key == "type":
-							way_tag_types[e[key]] += 1
-				"""
-
-				try:
-					ways_writer.writerow(element['way'])
-					way_nodes_writer.writerows(element['way_nodes'])
-					way_tags_writer.writerows(element['way_tags'])
-				except:
-					pass
-
-	# Printing Information about the data
-	print("Total Number of Nodes: {}".format(node_type["node"] + node_type["way"]))
+def report_users(name, users, edits):
+	"""Top ten, number of users and single edit users of one element type.
+	Counts from a sketch are estimates, and single edits are unknown"""
+
+	print("{} Users:".format(name))
+	pprint(users.top(10))
+	print(users.distinct())
+
+	singles = users.singles()
+	print("Only One Edit: {}".format(singles if singles is not None else "n/a"))
+	print("Total {} Edits: {}".format(name, edits.value))
+
+	print()
+
+def report(stats):
+	"""Printing Information about the data, rendered from the aggregators"""
+
+	node_type = stats["node_type"]
+
+	print("Total Number of Nodes: {}".format(node_type.count("node") +
+											 node_type.count("way")))
 	print("Individual Node Types and Quantity:")
-	pprint(node_type)
+	pprint(node_type.counter)
 
 	print()
 
 	print("Number of nodes outside of map box:")
-	pprint(boxed_out)
+	pprint(defaultdict(int, stats["boxed_out"].counter))
 
 	print()
 
 	print("Changes made to information in Year:")
+	years = stats["years"].counter
 	for key in sorted(years.keys()):
 		print("{}: {}".format(key, years[key]))
 
 	print()
 
 	print("Node tags:")
-	pprint(node_tags)
-	pprint(node_tag_types)
+	pprint(stats["node_tags"].counter)
+	pprint(stats["node_tag_types"].counter)
 
 	print()
 
 	print("Way tags:")
-	pprint(way_tags)
-	pprint(way_tag_types)
+	pprint(stats["way_tags"].counter)
+	pprint(stats["way_tag_types"].counter)
 
 	print()
 
-	print("Node Users:")
-	pprint(node_users.most_common(10))
-	print(len(node_users.keys()))
-
-	node_singles = 0
-	node_edits = 0
-	for key in node_users.keys():
-		n = node_users[key]
-		node_edits += n
-		if n == 1:
-			node_singles += 1
+	report_users("Node", stats["node_users"], stats["total_node_edits"])
+	report_users("Way", stats["way_users"], stats["total_way_edits"])
 
-	print("Only One Edit: {}".format(node_singles))	
-	print("Total Node Edits: {}".format(total_node_edits))
+	relation_users = stats["relation_users"]
+	print("Relation Users:")
+	pprint(relation_users.top(10))
+	print(relation_users.distinct())
+	print("Total Relation Edits: {}".format(stats["total_relation_edits"].value))
 
 	print()
 
-	print("Way Users:")
-	pprint(way_users.most_common(10))
-	print(len(way_users.keys()))
-
-	way_singles = 0
-	way_edits = 0
-	for key in way_users.keys():
-		n = way_users[key]
-		way_edits += n
-		if n == 1:
-			way_singles += 1
-
-	print("Only One Edit: {}".format(way_singles))	
-	print("Total Way Edits: {}".format(total_way_edits))
+	hits = stats["addr_cache_hits"].value
+	lookups = hits + stats["addr_cache_misses"].value
+	print("Address values cleaned: {}".format(lookups))
+	if lookups:
+		print("Address cache hit rate: {:.1%}".format(float(hits) / lookups))
 
 	print()
 
@@ -479,7 +907,176 @@ def main():
 	# pprint(addr_values)
 	# print(len(addr_values))
 
+def main(workers=1, sink="csv", validate=0, node_store=None, cache=False,
+		 parser=PARSER, relation_geometry=False, approximate_stats=False,
+		 compress=None, instrument=None, way_geometry=False):
+	"""
+	Validation phase is removed due to shape_element pass validation for
+	the whole dataset passed into it. It's removed thereafter to improve
+	performance and simply code.
+
+	validate=N turns it back on with the compiled validator, checking
+	every Nth element (1 checks them all).
+
+	With workers > 1 the file is split into shards that are converted in
+	a process pool; the output and counters are identical to a serial run,
+	except the address cache hit rate: every worker fills a memo of its
+	own, so fewer lookups hit it than in one serial pass.
+
+	sink="sqlite" loads the rows straight into DB_PATH instead of writing
+	CSV files; an interrupted load resumes from its last checkpoint.
+
+	node_store=PATH also collects every node's coordinates while parsing
+	and saves them for spatial.py queries (PATH ending in .npz saves one
+	file, anything else a directory that can be memory-mapped).
+
+	relation_geometry=True then resolves the way members of relations
+	through that store into RELATION_GEOMETRY_PATH.
+
+	way_geometry=True writes the node count, length (meters), bounds and
+	WKT line of every way to WAY_GEOMETRY_PATH (or a way_geometry table)
+	in the same pass: node coordinates go into a sparse file indexed by
+	id at NODE_LOCATIONS_PATH, memory-mapped, and the ways that follow
+	them are looked up there in batches. The file is removed at the end.
+
+	cache=True keeps the shaped rows of the file in a cache next to it;
+	later runs over the unchanged file read that instead of parsing the
+	XML. It is built by serial runs, but used with any number of workers.
+
+	parser picks the XML parser backend (see parsers.PARSERS).
+
+	approximate_stats=True counts users with fixed size sketches rather
+	than exact counters, for extracts with too many contributors to hold.
+
+	XML_PATH may be compressed (.gz, .bz2, .xz, .zst) and is then
+	decompressed while parsing. Shards need offsets into the XML, so such a
+	file is converted serially; workers > 1 decompress a multi-stream .bz2
+	instead. compress="gz" (or "bz2", ...) compresses the CSV files.
+
+	instrument=Instruments(...) times the stages of the run, prints
+	progress and reports on stderr at the end (see instrument.py).
+
+	The counters are saved to STATS_PATH, and the id, version and
+	timestamp of every node outside the box to BOXED_OUT_PATH, so
+	incremental.py can apply change files to the output without another
+	full run.
+	"""
+
+	if relation_geometry and not node_store:
+		raise ValueError("relation_geometry needs a node_store")
+
+	# Left over from an earlier run in this process (see profiles.py)
+	questionable_words.clear()
+	addr_values.clear()
+
+	geometry = None
+	if instrument is not None:
+		instrument.start()
+	try:
+		stats = new_stats(approximate_stats)
+		nodes = None
+		if node_store:
+			from spatial import NodeStore
+			nodes = NodeStore()
+
+		if sink == "sqlite":
+			output = SqliteSink(DB_PATH, output_sections(None, way_geometry),
+								SCHEMA, BATCH_SIZE, CHECKPOINT_EVERY)
+		else:
+			# Initiate csv writers for creating csv files for different data
+			output = CsvSink(output_sections(compress, way_geometry))
+
+		if way_geometry:
+			from spatial import NodeLocations, WayGeometry
+			geometry = WayGeometry(NodeLocations(NODE_LOCATIONS_PATH),
+								   output.writers["way_geometry"])
+
+		# Reading the cache is faster than parsing with any number of workers
+		decompress_workers = 1
+		if cache and row_cache(XML_PATH).valid():
+			workers = 1
+		elif compression(XML_PATH):
+			workers, decompress_workers = 1, workers
+
+		with output:
+			if workers > 1:
+				done = convert_parallel(XML_PATH, output, stats, workers,
+										validate, nodes, parser, instrument,
+										geometry)
+			else:
+				validator = Validator(SCHEMA, every=validate) if validate else None
+				done = resume(output, XML_PATH, "elements", stats)
+				if done >= 0:
+					convert(read_records(XML_PATH, cache, parser,
+										 decompress_workers, instrument),
+							output, stats, done, validator, nodes, instrument,
+							geometry)
+
+		if nodes is not None:
+			nodes.finish().save(node_store)
+			# The geometry pass maps the saved copy instead
+			nodes = None
+
+		if relation_geometry:
+			write_relation_geometry(sink, node_store, compress)
+
+		# A load found complete brings back the counters it finished with
+		save_stats(stats)
+
+		report(stats)
+	finally:
+		if geometry is not None:
+			geometry.locations.close()
+		if instrument is not None:
+			instrument.finish()
+
 
 # Start Execution
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	parser = argparse.ArgumentParser(description="Clean and convert an OSM "
+									 "extract into CSV files")
+	parser.add_argument("--workers", type=int, default=1,
+						help="convert shards of the file in parallel")
+	parser.add_argument("--sink", choices=("csv", "sqlite"), default="csv",
+						help="write CSV files or load an SQLite database")
+	parser.add_argument("--validate", type=int, default=0, metavar="N",
+						help="validate every Nth element against the schema")
+	parser.add_argument("--node-store", metavar="PATH",
+						help="save node coordinates for spatial queries")
+	parser.add_argument("--cache", action="store_true",
+						help="read (or build) a cache of the parsed rows")
+	parser.add_argument("--parser", choices=sorted(PARSERS), default=PARSER,
+						help="XML parser backend")
+	parser.add_argument("--relation-geometry", action="store_true",
+						help="resolve relation member ways through the node "
+						"store")
+	parser.add_argument("--way-geometry", action="store_true",
+						help="write the length, bounds and WKT of every way")
+	parser.add_argument("--approximate-stats", action="store_true",
+						help="count users with bounded memory sketches")
+	parser.add_argument("--compress", choices=FORMATS,
+						help="compress the CSV files")
+	parser.add_argument("--timings", action="store_true",
+						help="report stage timings, throughput and peak "
+						"memory on stderr")
+	parser.add_argument("--progress", type=float, default=0,
+						metavar="SECONDS",
+						help="print progress with an ETA every SECONDS")
+	parser.add_argument("--profile", metavar="PATH",
+						help="save cProfile stats of the run to PATH")
+	parser.add_argument("--trace-memory", action="store_true",
+						help="report the lines that allocated most")
+	args = parser.parse_args()
+	if args.relation_geometry and not args.node_store:
+		parser.error("--relation-geometry needs --node-store")
+
+	instrument = None
+	if args.timings or args.progress or args.profile or args.trace_memory:
+		instrument = Instruments(args.progress, args.profile,
+								 args.trace_memory)
+
+	main(workers=args.workers, sink=args.sink, validate=args.validate,
+		 node_store=args.node_store, cache=args.cache, parser=args.parser,
+		 relation_geometry=args.relation_geometry,
+		 approximate_stats=args.approximate_stats, compress=args.compress,
+		 instrument=instrument, way_geometry=args.way_geometry)
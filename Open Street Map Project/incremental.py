@@ -0,0 +1,354 @@
+# Apply an osmChange (.osc) diff to the output of an earlier exploration.py
+# run, instead of converting the whole extract again.
+#
+# Usage: python incremental.py CHANGES.osc[.gz] [--sink csv|sqlite] [--force]
+#                              [--compress gz|bz2|xz|zst]
+
+# Standard imports
+import xml.etree.cElementTree as ET
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+
+# My imports
+from collections import Counter
+from csv import reader
+from csv import writer
+from time import time
+
+from exploration import (BOXED_OUT_FIELDS, DB_PATH, NODE_LAT, NODE_LON,
+						 NODE_USER, NODE_VERSION, NORMALIZER,
+						 RELATION_GEOMETRY_PATH, RELATION_USER,
+						 RELATION_VERSION, SECTIONS, TAGS, TIMESTAMP,
+						 WAY_GEOMETRY_PATH, WAY_USER, WAY_VERSION,
+						 boxed_out_row, in_box, load_stats, output_sections,
+						 report, save_stats, shape_rows)
+from sinks import insert_sql, table_name
+from streams import FORMATS, open_stream, temp_path
+
+# CONSTANTS
+
+ACTIONS = ("create", "modify", "delete")
+
+# Digests of the change files applied so far
+APPLIED_PATH = "applied_changes.json"
+
+# Output sections holding the rows of each element type (a node is in
+# nodes and its tags, or only in boxed_out if outside the box)
+TYPE_SECTIONS = {"node": ("node", "node_tags", "boxed_out"),
+				 "way": ("way", "way_nodes", "way_tags"),
+				 "relation": ("relation", "relation_members", "relation_tags")}
+SECTION_TYPES = dict((section, type) for type, sections in TYPE_SECTIONS.items()
+					 for section in sections)
+
+# Version field of the rows of each element section
+VERSIONS = {"node": NODE_VERSION, "way": WAY_VERSION,
+			"relation": RELATION_VERSION,
+			"boxed_out": BOXED_OUT_FIELDS.index("version")}
+USERS = {"node": NODE_USER, "way": WAY_USER, "relation": RELATION_USER}
+
+def read_changes(file_name):
+	"""Map (type, id) to (action, version, rows) for the elements of an
+	osmChange file.
+
+	rows is the shape_rows() output with cleaned addr values (None for a
+	delete). An element changed more than once keeps its highest version.
+	The file may be compressed (.osc.gz, as the replication diffs are).
+	"""
+
+	changes = {}
+	action = None
+	with open_stream(file_name, 'rb') as change_file:
+		context = ET.iterparse(change_file, events=('start', 'end'))
+		_, root = next(context)
+		for event, element in context:
+			if event == 'start':
+				if element.tag in ACTIONS:
+					action = element.tag
+				continue
+
+			if element.tag in ACTIONS:
+				root.clear()
+			if element.tag not in TAGS:
+				continue
+
+			key = (element.tag, int(element.attrib['id']))
+			version = int(element.attrib['version'])
+			if key not in changes or changes[key][1] < version:
+				rows = None
+				if action != "delete":
+					rows = shape_rows(element)
+					NORMALIZER.clean_rows(rows[1])
+				changes[key] = (action, version, rows)
+			element.clear()
+
+	return changes
+
+def element_rows(type, rows):
+	"""Rows of one shaped element by output section"""
+
+	attribs, tags, way_nodes = rows
+	if type == "node":
+		return {"node": [attribs], "node_tags": tags}
+	if type == "relation":
+		return {"relation": [attribs], "relation_members": way_nodes,
+				"relation_tags": tags}
+	return {"way": [attribs], "way_nodes": way_nodes, "way_tags": tags}
+
+def count_old(stats, type, section, old):
+	"""Take an element row (of section) the outputs no longer hold out of
+	the counters"""
+
+	stats["years"].add(old[TIMESTAMP][0:4], -1)
+	if section == "boxed_out":
+		stats["boxed_out"].add("node", -1)
+		return
+	stats["node_type"].add(type, -1)
+	stats[type + "_users"].add(old[USERS[type]], -1)
+	stats["total_" + type + "_edits"].add(-int(old[VERSIONS[type]]))
+
+def count_new(stats, type, attribs):
+	"""Count a new element row as process_rows does; returns False for
+	a node outside the map box, which only gets a boxed_out row"""
+
+	stats["years"].add(attribs[TIMESTAMP][0:4])
+
+	if type == "node" and not in_box(float(attribs[NODE_LAT]),
+									 float(attribs[NODE_LON])):
+		stats["boxed_out"].add("node")
+		return False
+
+	stats["node_type"].add(type)
+	stats[type + "_users"].add(attribs[USERS[type]])
+	stats["total_" + type + "_edits"].add(int(attribs[VERSIONS[type]]))
+	return True
+
+def plan_changes(changes, old_row, stats):
+	"""Work out what every change does to the outputs, in id order, and
+	update the counters to match.
+
+	old_row(type, id) returns (section, element row) the outputs hold, or
+	None; nodes outside the box are found in boxed_out. A change no newer
+	than that row is stale and skipped, so overlapping diffs are
+	harmless, and the counters come out as a full run over the changed
+	extract would leave them.
+
+	Returns ({type: ids whose rows are removed}, {section: rows to add},
+	Counter of what was done).
+	"""
+
+	remove = dict((type, set()) for type in TYPE_SECTIONS)
+	add = dict((section, []) for section, _, _ in SECTIONS)
+	done = Counter()
+
+	for (type, id), (action, version, rows) in sorted(changes.items()):
+		old = old_row(type, id)
+		if old is not None:
+			section, row = old
+			if int(row[VERSIONS[section]]) >= version:
+				done["stale"] += 1
+				continue
+			count_old(stats, type, section, row)
+			remove[type].add(id)
+		elif action == "delete":
+			done["not found"] += 1
+			continue
+
+		done[action] += 1
+		if action == "delete":
+			continue
+		if count_new(stats, type, rows[0]):
+			for section, section_rows in element_rows(type, rows).items():
+				add[section].extend(section_rows)
+		else:
+			add["boxed_out"].append(boxed_out_row(rows[0]))
+
+	return remove, add, done
+
+def apply_sqlite(db_path, changes, stats):
+	"""Apply changes to a database loaded with --sink sqlite, in a single
+	transaction. Element rows are looked up by primary key and tag / nd
+	rows through the id indexes the load built."""
+
+	db = sqlite3.connect(db_path)
+	try:
+		progress = db.execute("SELECT complete FROM load_progress").fetchone()
+		if progress is None or not progress[0]:
+			raise ValueError("{} does not hold a complete load".format(db_path))
+
+		tables = dict((section, table_name(path)) for section, path, _ in SECTIONS)
+		existing = set(name for name, in db.execute(
+			"SELECT name FROM sqlite_master WHERE type = 'table'"))
+		if tables["boxed_out"] not in existing:
+			raise ValueError("{} has no {} table, loaded before nodes outside "
+							 "the box were kept; load it again".format(
+								 db_path, tables["boxed_out"]))
+		if "way_geometry" in existing:
+			raise ValueError("changes would leave the way_geometry table of "
+							 "{} stale; load the extract again "
+							 "instead".format(db_path))
+
+		def old_row(type, id):
+			for section in (type, "boxed_out") if type == "node" else (type,):
+				row = db.execute("SELECT * FROM {} WHERE id = ?".format(
+					tables[section]), (id,)).fetchone()
+				if row is not None:
+					return section, row
+			return None
+
+		remove, add, done = plan_changes(changes, old_row, stats)
+
+		for section, _, fields in SECTIONS:
+			ids = remove[SECTION_TYPES[section]]
+			db.executemany("DELETE FROM {} WHERE id = ?".format(tables[section]),
+						   [(id,) for id in ids])
+			db.executemany(insert_sql(tables[section], fields), add[section])
+		db.commit()
+	finally:
+		db.close()
+
+	return done
+
+def read_rows(path, ids):
+	"""Rows of a CSV file whose id is in ids, by id"""
+
+	found = {}
+	with open_stream(path, 'rt', newline='') as csv_file:
+		rows = reader(csv_file)
+		next(rows)
+		for row in rows:
+			if int(row[0]) in ids:
+				found[int(row[0])] = row
+	return found
+
+def rewrite(path, remove, add):
+	"""Rewrite a CSV file without the rows of the ids in remove and with
+	the rows in add appended"""
+
+	new_path = temp_path(path)
+	with open_stream(path, 'rt', newline='') as old_file, \
+			open_stream(new_path, 'wt') as new_file:
+		rows = reader(old_file)
+		out = writer(new_file)
+		out.writerow(next(rows))
+		out.writerows(row for row in rows if int(row[0]) not in remove)
+		out.writerows(add)
+	os.replace(new_path, path)
+
+def apply_csv(changes, stats, compress=None):
+	"""Apply changes to the CSV files: one read of nodes.csv and ways.csv
+	for the old versions, then one streaming rewrite of each file that
+	changes. Changed elements are moved to the end of their files."""
+
+	sections = output_sections(compress)
+	paths = dict((section, path) for section, path, _ in sections)
+	if not os.path.exists(paths["boxed_out"]):
+		raise ValueError("no {}: the CSV files were written before nodes "
+						 "outside the box were kept; convert the extract "
+						 "again".format(paths["boxed_out"]))
+
+	old = {}
+	for type in TYPE_SECTIONS:
+		ids = set(id for t, id in changes if t == type)
+		old[type] = read_rows(paths[type], ids) if ids else {}
+	ids = set(id for t, id in changes if t == "node")
+	old["boxed_out"] = read_rows(paths["boxed_out"], ids) if ids else {}
+
+	def old_row(type, id):
+		for section in (type, "boxed_out") if type == "node" else (type,):
+			if id in old[section]:
+				return section, old[section][id]
+		return None
+
+	remove, add, done = plan_changes(changes, old_row, stats)
+
+	for section, path, _ in sections:
+		ids = remove[SECTION_TYPES[section]]
+		if ids or add[section]:
+			rewrite(path, ids, add[section])
+
+	return done
+
+def file_digest(file_name):
+	digest = hashlib.sha1()
+	with open(file_name, 'rb') as change_file:
+		for block in iter(lambda: change_file.read(1 << 20), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+def stale_outputs(sink, compress=None):
+	"""Geometry outputs the changes would leave out of date"""
+
+	paths = [RELATION_GEOMETRY_PATH]
+	if sink != "sqlite":
+		paths.append(WAY_GEOMETRY_PATH)
+		if compress:
+			paths = ["{}.{}".format(path, compress) for path in paths]
+	return [path for path in paths if os.path.exists(path)]
+
+def main(file_name, sink="csv", force=False, compress=None):
+	"""Apply one change file and update the counters saved by the run that
+	wrote the outputs (with compress as given to exploration.main).
+
+	Element rows carry their version (and so do the rows kept for nodes
+	outside the box), so changes the outputs already hold are skipped; a
+	file that was applied before is not even read again unless force is
+	set. Way and relation geometry cannot be updated from a change file,
+	so outputs that include them are refused.
+	"""
+
+	start = time()
+
+	stale = stale_outputs(sink, compress)
+	if stale:
+		raise ValueError("changes would leave {} stale; convert the extract "
+						 "again instead".format(", ".join(stale)))
+
+	applied = []
+	if os.path.exists(APPLIED_PATH):
+		with open(APPLIED_PATH) as applied_file:
+			applied = json.load(applied_file)
+	digest = file_digest(file_name)
+	if digest in applied and not force:
+		print("{} was already applied".format(file_name))
+		return
+
+	stats = load_stats()
+	if not stats.exact():
+		raise ValueError("changes can only be applied to exact counters, "
+						 "sketches cannot take counts back out")
+	changes = read_changes(file_name)
+
+	if sink == "sqlite":
+		done = apply_sqlite(DB_PATH, changes, stats)
+	else:
+		done = apply_csv(changes, stats, compress)
+
+	save_stats(stats)
+	applied.append(digest)
+	with open(APPLIED_PATH, 'w') as applied_file:
+		json.dump(applied, applied_file)
+
+	report(stats)
+
+	print("Applied {} changes from {} in {:.2f}s:".format(
+		len(changes), file_name, time() - start))
+	for action in ACTIONS + ("not found", "stale"):
+		print("{}: {}".format(action, done[action]))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Apply an osmChange file to "
+									 "the output of exploration.py")
+	parser.add_argument("changes", help="osmChange (.osc or .osc.gz) file")
+	parser.add_argument("--sink", choices=("csv", "sqlite"), default="csv",
+						help="update the CSV files or the SQLite database")
+	parser.add_argument("--force", action="store_true",
+						help="apply a change file again")
+	parser.add_argument("--compress", choices=FORMATS,
+						help="the CSV files were written compressed")
+	args = parser.parse_args()
+
+	main(args.changes, sink=args.sink, force=args.force,
+		 compress=args.compress)
@@ -0,0 +1,247 @@
+# Standard imports
+import cProfile
+import pstats
+import sys
+import tracemalloc
+
+# My imports
+from collections import Counter
+from time import perf_counter
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+# Timing and progress for exploration.py runs. A run only touches any of
+# this when it is given an Instruments: the parser, the record stream, the
+# writers and the address cleaning are wrapped with timers at the start of
+# the run, so without one the hot path is exactly as it was.
+#
+# Stages are measured inclusively and reported exclusively:
+#   parse    the XML parser, decompression included
+#   shape    shape_rows() (or reading the row cache), net of parse
+#   clean    the addr value normalizer
+#   write    the CSV writers / SQLite batches
+#   count    the rest of process_rows(): counters, box check, validation
+#   commit   SQLite checkpoints
+#   merge    copying shard parts into the output (parallel runs)
+
+STAGES = ("parse", "shape", "clean", "write", "count", "commit", "merge")
+
+# Elements between checks of the clock for a progress line
+CHECK_EVERY = 1024
+
+def peak_rss(children=False):
+	"""Peak resident set size of this process (or the largest of its
+	finished children) in MB, None if unknown"""
+
+	if resource is None:
+		return None
+	who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+	peak = resource.getrusage(who).ru_maxrss
+	# Kilobytes on Linux, bytes on macOS
+	return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+def format_seconds(seconds):
+	minutes, seconds = divmod(int(seconds), 60)
+	hours, minutes = divmod(minutes, 60)
+	return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+class Instruments(object):
+	"""Stage timers, throughput, progress and peak memory of one run.
+
+	progress is the seconds between progress lines (0 for none); profile
+	names a file for cProfile stats of the run, and trace_memory lists the
+	lines that allocated most. Everything is reported on out, so the
+	report of the data itself on stdout is unchanged.
+	"""
+
+	def __init__(self, progress=0, profile=None, trace_memory=False,
+				 out=None):
+		self.progress = progress
+		self.profile = profile
+		self.trace_memory = trace_memory
+		self.out = out or sys.stderr
+
+		self.times = Counter()
+		self.elements = 0
+		self.workers = 0
+		self.position = None
+		self.size = None
+		self.patched = []
+		self.profiler = None
+		self.start_time = self.last = None
+
+	# Hooks
+
+	def timer(self, stage, func):
+		"""func, adding the time of every call to stage"""
+
+		times = self.times
+
+		def timed(*args, **kwargs):
+			start = perf_counter()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				times[stage] += perf_counter() - start
+
+		return timed
+
+	def timed(self, stage, iterable):
+		"""Iterate, adding the time spent producing each item to stage"""
+
+		times = self.times
+		iterator = iter(iterable)
+		try:
+			while True:
+				start = perf_counter()
+				try:
+					item = next(iterator)
+				except StopIteration:
+					return
+				finally:
+					times[stage] += perf_counter() - start
+				yield item
+		finally:
+			close = getattr(iterator, "close", None)
+			if close is not None:
+				close()
+
+	def records(self, records):
+		"""Time the shaped records of a run, counting them for throughput
+		and progress"""
+
+		for record in self.timed("records", records):
+			self.elements += 1
+			if self.progress and self.elements % CHECK_EVERY == 0:
+				self.tick()
+			yield record
+
+	def writers(self, writers):
+		"""Writers of a sink with timed writerow/writerows"""
+
+		return dict((section, TimedWriter(self, writer))
+					for section, writer in writers.items())
+
+	def patch(self, obj, name, stage):
+		"""Time calls to obj.name until unpatch()"""
+
+		self.patched.append((obj, name, name in vars(obj), getattr(obj, name)))
+		setattr(obj, name, self.timer(stage, getattr(obj, name)))
+
+	def unpatch(self):
+		while self.patched:
+			obj, name, own, original = self.patched.pop()
+			if own:
+				setattr(obj, name, original)
+			else:
+				delattr(obj, name)
+
+	def watch(self, position, size):
+		"""Base progress on position(), the bytes of size read so far"""
+
+		self.position = position
+		self.size = size
+
+	def add(self, times, elements):
+		"""Add the timers of a shard converted by a worker"""
+
+		self.times.update(times)
+		self.elements += elements
+		self.workers += 1
+
+	# Run
+
+	def start(self):
+		self.start_time = self.last = perf_counter()
+		if self.trace_memory:
+			tracemalloc.start()
+		if self.profile:
+			self.profiler = cProfile.Profile()
+			self.profiler.enable()
+
+	def tick(self, force=False):
+		"""Print a progress line, at most every progress seconds"""
+
+		now = perf_counter()
+		if not force and now - self.last < self.progress:
+			return
+		self.last = now
+		elapsed = now - self.start_time
+
+		line = "{:,} elements, {:,.0f} elements/s".format(
+			self.elements, self.elements / elapsed if elapsed else 0)
+		position = self.position() if self.position else 0
+		if self.size and position:
+			done = float(position) / self.size
+			line += ", {:.1%} of the file, ETA {}".format(
+				done, format_seconds(elapsed * (1 - done) / done))
+		peak = peak_rss()
+		if peak is not None:
+			line += ", peak {:.0f} MB".format(peak)
+		print(line, file=self.out)
+		self.out.flush()
+
+	def stages(self):
+		"""Exclusive seconds per stage"""
+
+		times = self.times
+		exclusive = dict(times)
+		exclusive["shape"] = times["records"] - times["parse"]
+		exclusive["count"] = times["process"] - times["clean"] - times["write"]
+		return [(stage, max(exclusive.get(stage, 0.0), 0.0))
+				for stage in STAGES]
+
+	def finish(self):
+		"""Stop the profilers and print the report"""
+
+		total = perf_counter() - self.start_time
+		if self.profiler is not None:
+			self.profiler.disable()
+		out = self.out
+
+		print("Stage timings{}:".format(
+			" (summed over {} shards)".format(self.workers)
+			if self.workers else ""), file=out)
+		stages = self.stages()
+		measured = sum(seconds for _, seconds in stages)
+		for stage, seconds in stages:
+			if seconds:
+				print("  {:<8} {:9.2f}s {:6.1%}".format(
+					stage, seconds, seconds / measured), file=out)
+		print("  {:<8} {:9.2f}s wall".format("total", total), file=out)
+		print("Throughput: {:,} elements, {:,.0f} elements/s".format(
+			self.elements, self.elements / total if total else 0), file=out)
+
+		peak = peak_rss()
+		if peak is not None:
+			print("Peak memory: {:.0f} MB{}".format(
+				peak, ", largest worker {:.0f} MB".format(
+					peak_rss(children=True)) if self.workers else ""),
+				file=out)
+
+		if self.trace_memory:
+			snapshot = tracemalloc.take_snapshot()
+			current, traced_peak = tracemalloc.get_traced_memory()
+			tracemalloc.stop()
+			print("Traced memory: {:.1f} MB now, {:.1f} MB peak; top "
+				  "allocations:".format(current / 1e6, traced_peak / 1e6),
+				  file=out)
+			for stat in snapshot.statistics("lineno")[:10]:
+				print("  {}".format(stat), file=out)
+
+		if self.profiler is not None:
+			self.profiler.dump_stats(self.profile)
+			print("Profile saved to {}; top functions:".format(self.profile),
+				  file=out)
+			pstats.Stats(self.profile, stream=out).sort_stats(
+				"cumulative").print_stats(15)
+
+class TimedWriter(object):
+	"""csv.writer look-alike timing another one"""
+
+	def __init__(self, instruments, writer):
+		self.writerow = instruments.timer("write", writer.writerow)
+		self.writerows = instruments.timer("write", writer.writerows)
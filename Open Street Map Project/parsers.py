@@ -0,0 +1,89 @@
+# Standard imports
+import xml.etree.cElementTree as ET
+from xml.parsers import expat
+
+# Parser backends for get_element(). Each one takes a file name (or a
+# binary file object) and the top level tags wanted, and yields those
+# elements in file order with their <tag>, <nd> and <member> children.
+# Nothing else is kept: every other top level element (<bounds>,
+# <relation> when not wanted, ...) is released as soon as it ends.
+
+# Elements only ever found inside a top level element
+CHILD_TAGS = frozenset(["tag", "nd", "member"])
+
+READ_SIZE = 1 << 16
+
+def iter_etree(file_name, tags):
+	"""ET.iterparse, clearing the root after every top level element"""
+
+	context = ET.iterparse(file_name, events=('start', 'end'))
+	_, root = next(context)
+	for event, element in context:
+		if event == 'end':
+			if element.tag in tags:
+				yield element
+				root.clear()
+			elif element.tag not in CHILD_TAGS:
+				root.clear()
+
+class LightElement(object):
+	"""The part of an ElementTree element that shape_rows() uses: tag,
+	attrib and iteration over the children"""
+
+	__slots__ = ("tag", "attrib", "children")
+
+	def __init__(self, tag, attrib):
+		self.tag = tag
+		self.attrib = attrib
+		self.children = []
+
+	def __iter__(self):
+		return iter(self.children)
+
+	def __len__(self):
+		return len(self.children)
+
+	def get(self, key, default=None):
+		return self.attrib.get(key, default)
+
+def iter_expat(file_name, tags):
+	"""Expat callbacks building LightElements for the wanted tags only.
+	Text, and every element outside those, is never materialized.
+
+	Only start tags are handled (which halves the callbacks): an element is
+	complete once the next top level element starts, or the input ends.
+	"""
+
+	parsed = []
+	current = [None]
+
+	def start(name, attrib):
+		if name in CHILD_TAGS:
+			if current[0] is not None:
+				current[0].children.append(LightElement(name, attrib))
+			return
+		if current[0] is not None:
+			parsed.append(current[0])
+		current[0] = LightElement(name, attrib) if name in tags else None
+
+	parser = expat.ParserCreate()
+	parser.StartElementHandler = start
+
+	opened = isinstance(file_name, str)
+	xml_file = open(file_name, 'rb') if opened else file_name
+	try:
+		while True:
+			data = xml_file.read(READ_SIZE)
+			parser.Parse(data, not data)
+			if not data and current[0] is not None:
+				parsed.append(current[0])
+			for element in parsed:
+				yield element
+			del parsed[:]
+			if not data:
+				break
+	finally:
+		if opened:
+			xml_file.close()
+
+PARSERS = {"etree": iter_etree, "expat": iter_expat}
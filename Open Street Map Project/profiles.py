@@ -0,0 +1,156 @@
+# Run exploration.py over a queue of extracts, each described by a profile
+# in a JSON config file, back to back in one process. The compiled regexes
+# are only built once, and so are the address rules (with their memo of
+# cleaned values) for as long as consecutive profiles share rule tables.
+#
+# Usage: python profiles.py CONFIG.json [PROFILE ...]
+#
+# The config holds "profiles" by name, "defaults" that every profile starts
+# from, and the "queue" of profile names run when none are given:
+#
+#   {"defaults": {"workers": 4, "sink": "sqlite"},
+#    "profiles": {"cambridge": {"xml": "Data/cambridge.xml.bz2",
+#                               "box": [42.3409, 42.4162, -71.1995, -71.0251],
+#                               "output_dir": "out/cambridge"}},
+#    "queue": ["cambridge"]}
+#
+# Profile keys:
+#   xml                  extract to convert (XML_PATH)
+#   box                  [min lat, max lat, min lon, max lon]
+#   output_dir           directory for every output file (and node_store)
+#   safe_words           street words never questioned
+#   word_transforms      abbreviation -> replacement
+#   batch_size           rows per SQLite insert
+#   checkpoint_every     elements per SQLite commit
+#   shards_per_worker    shards per parallel worker
+#   settings             any other exploration.SETTINGS by name
+#   instrument           Instruments arguments, e.g. {"progress": 30}
+# and the keyword arguments of exploration.main(): workers, sink, validate,
+# node_store, cache, parser, relation_geometry, approximate_stats, compress,
+# way_geometry.
+
+# Standard imports
+import argparse
+import json
+import os
+import sys
+import traceback
+
+# My imports
+from time import time
+
+import exploration
+from instrument import Instruments
+
+# CONSTANTS
+
+# Profile keys setting a module constant of exploration.py
+SETTING_KEYS = {"xml": "XML_PATH", "safe_words": "safe_words",
+				"word_transforms": "word_transforms",
+				"batch_size": "BATCH_SIZE",
+				"checkpoint_every": "CHECKPOINT_EVERY",
+				"shards_per_worker": "SHARDS_PER_WORKER"}
+RUN_KEYS = ("workers", "sink", "validate", "node_store", "cache", "parser",
+			"relation_geometry", "approximate_stats", "compress",
+			"way_geometry")
+PROFILE_KEYS = (set(SETTING_KEYS) | set(RUN_KEYS) |
+				set(["box", "output_dir", "settings", "instrument"]))
+
+# Output files moved into output_dir
+OUTPUT_SETTINGS = tuple(name for name in exploration.SETTINGS
+						if name.endswith("_PATH") and name != "XML_PATH")
+
+# Settings as exploration.py defines them, which every profile starts from
+BASE = exploration.settings()
+
+def load_config(path):
+	with open(path) as config_file:
+		return json.load(config_file)
+
+def profile(config, name):
+	"""The defaults of config updated with the profile called name"""
+
+	profiles = config.get("profiles", {})
+	if name not in profiles:
+		raise ValueError("no profile {} in the config (have {})".format(
+			name, ", ".join(sorted(profiles))))
+	values = dict(config.get("defaults", {}))
+	values.update(profiles[name])
+
+	unknown = set(values) - PROFILE_KEYS
+	if unknown:
+		raise ValueError("unknown keys in profile {}: {}".format(
+			name, ", ".join(sorted(unknown))))
+	return values
+
+def resolve(values):
+	"""Split a profile into (exploration settings, main() arguments)"""
+
+	settings = dict(BASE)
+	run = dict((key, values[key]) for key in RUN_KEYS if key in values)
+
+	for key, name in SETTING_KEYS.items():
+		if key in values:
+			settings[name] = values[key]
+	if "box" in values:
+		(settings["MIN_LAT"], settings["MAX_LAT"], settings["MIN_LON"],
+		 settings["MAX_LON"]) = values["box"]
+
+	output_dir = values.get("output_dir")
+	if output_dir:
+		for name in OUTPUT_SETTINGS:
+			settings[name] = os.path.join(output_dir,
+										  os.path.basename(BASE[name]))
+		if run.get("node_store") and not os.path.isabs(run["node_store"]):
+			run["node_store"] = os.path.join(output_dir, run["node_store"])
+	if "instrument" in values:
+		run["instrument"] = Instruments(**values["instrument"])
+
+	settings.update(values.get("settings", {}))
+	return settings, run
+
+def run_profile(config, name):
+	"""Configure exploration.py for one profile and convert its extract"""
+
+	settings, run = resolve(profile(config, name))
+	for setting in OUTPUT_SETTINGS:
+		directory = os.path.dirname(settings[setting])
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+
+	exploration.configure(settings)
+	exploration.main(**run)
+
+def main(config_path, names=None):
+	"""Run the named profiles, or the queue of the config, in order. A
+	profile that fails is reported and the queue carries on"""
+
+	config = load_config(config_path)
+	names = names or config.get("queue", [])
+
+	results = []
+	for name in names:
+		print("== {} ==".format(name))
+		start = time()
+		try:
+			run_profile(config, name)
+			results.append((name, "done", time() - start))
+		except Exception:
+			traceback.print_exc()
+			results.append((name, "failed", time() - start))
+
+	print("== Queue ==")
+	for name, result, seconds in results:
+		print("{:<20} {:<7} {:8.1f}s".format(name, result, seconds))
+	return all(result == "done" for _, result, _ in results)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Convert a queue of OSM "
+									 "extracts described by config profiles")
+	parser.add_argument("config", help="JSON config file")
+	parser.add_argument("profiles", nargs="*",
+						help="profiles to run (default: the config's queue)")
+	args = parser.parse_args()
+
+	if not main(args.config, args.profiles):
+		sys.exit(1)
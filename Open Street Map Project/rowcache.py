@@ -0,0 +1,135 @@
+# Standard imports
+import gc
+import hashlib
+import json
+import marshal
+import os
+import struct
+
+# On-disk cache of the shape_rows() output of an OSM file, so repeated runs
+# of the cleaning and counting stages skip ET.iterparse entirely.
+#
+# Layout: MAGIC, a length-prefixed JSON key, then length-prefixed chunks,
+# each one marshalled list of (type, attribs, tags, way_nodes, problem keys)
+# records in file order.
+
+MAGIC = b"OSMROWS\x01"
+LENGTH = struct.Struct("<I")
+CHUNK_RECORDS = 2000
+
+# Bytes read from each end of the file for its fingerprint
+SAMPLE_SIZE = 1 << 20
+
+def fingerprint(file_name):
+	"""Size, mtime and a hash of both ends of a file: cheap next to a parse,
+	and it changes whenever the file is replaced or edited"""
+
+	st = os.stat(file_name)
+	digest = hashlib.sha1()
+	with open(file_name, 'rb') as xml_file:
+		digest.update(xml_file.read(SAMPLE_SIZE))
+		if st.st_size > SAMPLE_SIZE:
+			xml_file.seek(max(st.st_size - SAMPLE_SIZE, SAMPLE_SIZE))
+			digest.update(xml_file.read())
+	return {"size": st.st_size, "mtime": st.st_mtime_ns,
+			"sha1": digest.hexdigest()}
+
+class RowCache(object):
+	"""Shaped rows of one OSM file, kept next to it in file_name + ".rows".
+
+	params names anything else the rows depend on (the element tags and the
+	problem characters pattern); the cache is rebuilt when it, the file or
+	the format changes.
+	"""
+
+	def __init__(self, file_name, params=(), path=None):
+		self.file_name = file_name
+		self.path = path or file_name + ".rows"
+		self.key = dict(fingerprint(file_name), params=list(params),
+						format=MAGIC.decode("latin-1"))
+		# Round trip through JSON, so tuples compare equal to saved lists
+		self.key = json.loads(json.dumps(self.key))
+
+	def read_key(self, cache_file):
+		if cache_file.read(len(MAGIC)) != MAGIC:
+			return None
+		size = LENGTH.unpack(cache_file.read(LENGTH.size))[0]
+		return json.loads(cache_file.read(size).decode("utf-8"))
+
+	def valid(self):
+		"""True if the cache file holds the rows of the file as it is now"""
+
+		try:
+			with open(self.path, 'rb') as cache_file:
+				return self.read_key(cache_file) == self.key
+		except (OSError, ValueError, struct.error):
+			return False
+
+	def records(self):
+		"""Yield the cached (type, rows, problem keys) records, printing the
+		problem keys as shape_rows() did while parsing"""
+
+		with open(self.path, 'rb') as cache_file:
+			if self.read_key(cache_file) != self.key:
+				raise ValueError("{} is stale for {}".format(self.path,
+															  self.file_name))
+			while True:
+				prefix = cache_file.read(LENGTH.size)
+				if not prefix:
+					break
+				chunk = self.load_chunk(cache_file.read(LENGTH.unpack(prefix)[0]))
+				for type, attribs, tags, way_nodes, problem_keys in chunk:
+					for key in problem_keys:
+						print(key)
+					yield type, (attribs, tags, way_nodes), problem_keys
+
+	def build(self, records):
+		"""Pass (type, rows, problem keys) records through while saving
+		them. The cache file is only replaced once records are exhausted,
+		so an interrupted run never leaves a partial cache behind"""
+
+		temp_path = self.path + ".tmp"
+		complete = False
+		try:
+			with open(temp_path, 'wb') as cache_file:
+				key = json.dumps(self.key).encode("utf-8")
+				cache_file.write(MAGIC + LENGTH.pack(len(key)) + key)
+
+				chunk = []
+				for type, rows, problem_keys in records:
+					attribs, tags, way_nodes = rows
+					# Copy tags, the cleaning stage edits the list in place
+					chunk.append((type, attribs, list(tags), way_nodes,
+								  problem_keys))
+					if len(chunk) >= CHUNK_RECORDS:
+						self.write_chunk(cache_file, chunk)
+						chunk = []
+					yield type, rows, problem_keys
+				if chunk:
+					self.write_chunk(cache_file, chunk)
+			os.replace(temp_path, self.path)
+			complete = True
+		finally:
+			if not complete and os.path.exists(temp_path):
+				os.remove(temp_path)
+
+	@staticmethod
+	def load_chunk(data):
+		# A chunk is only tuples of strings, but its many allocations set
+		# off the cycle collector over and over; that tripled load times
+		enabled = gc.isenabled()
+		gc.disable()
+		try:
+			return marshal.loads(data)
+		finally:
+			if enabled:
+				gc.enable()
+
+	@staticmethod
+	def write_chunk(cache_file, chunk):
+		data = marshal.dumps(chunk)
+		cache_file.write(LENGTH.pack(len(data)) + data)
+
+	def clear(self):
+		if os.path.exists(self.path):
+			os.remove(self.path)
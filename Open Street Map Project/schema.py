@@ -61,5 +61,63 @@ schema = {
                 'type': {'required': True, 'type': 'string'}
             }
         }
+    },
+    'relation': {
+        'type': 'dict',
+        'schema': {
+            'id': {'required': True, 'type': 'integer', 'coerce': int},
+            'user': {'required': True, 'type': 'string'},
+            'uid': {'required': True, 'type': 'integer', 'coerce': int},
+            'version': {'required': True, 'type': 'string'},
+            'changeset': {'required': True, 'type': 'integer', 'coerce': int},
+            'timestamp': {'required': True, 'type': 'string'}
+        }
+    },
+    'relation_members': {
+        'type': 'list',
+        'schema': {
+            'type': 'dict',
+            'schema': {
+                'id': {'required': True, 'type': 'integer', 'coerce': int},
+                'member_id': {'required': True, 'type': 'integer', 'coerce': int},
+                'member_type': {'required': True, 'type': 'string'},
+                'role': {'required': True, 'type': 'string'},
+                'position': {'required': True, 'type': 'integer', 'coerce': int}
+            }
+        }
+    },
+    'relation_tags': {
+        'type': 'list',
+        'schema': {
+            'type': 'dict',
+            'schema': {
+                'id': {'required': True, 'type': 'integer', 'coerce': int},
+                'key': {'required': True, 'type': 'string'},
+                'value': {'required': True, 'type': 'string'},
+                'type': {'required': True, 'type': 'string'}
+            }
+        }
+    },
+    'way_geometry': {
+        'type': 'dict',
+        'schema': {
+            'id': {'required': True, 'type': 'integer', 'coerce': int},
+            'nodes': {'required': True, 'type': 'integer', 'coerce': int},
+            'missing': {'required': True, 'type': 'integer', 'coerce': int},
+            'length': {'type': 'float', 'coerce': float},
+            'min_lat': {'type': 'float', 'coerce': float},
+            'max_lat': {'type': 'float', 'coerce': float},
+            'min_lon': {'type': 'float', 'coerce': float},
+            'max_lon': {'type': 'float', 'coerce': float},
+            'wkt': {'required': True, 'type': 'string'}
+        }
+    },
+    'boxed_out': {
+        'type': 'dict',
+        'schema': {
+            'id': {'required': True, 'type': 'integer', 'coerce': int},
+            'version': {'required': True, 'type': 'string'},
+            'timestamp': {'required': True, 'type': 'string'}
+        }
     }
-}
\ No newline at end of file
+}
@@ -0,0 +1,267 @@
+# Standard imports
+import json
+import os
+import shutil
+import sqlite3
+import sys
+
+# My imports
+from contextlib import ExitStack
+from csv import reader
+from csv import writer
+from itertools import islice
+
+from streams import open_stream
+
+# SQLITE CONSTANTS
+
+SQL_TYPES = {"integer": "INTEGER", "float": "REAL", "string": "TEXT"}
+
+# Bulk load settings: WAL with synchronous off survives a crash of this
+# process (which is all the resume logic needs) without fsync per commit
+BULK_PRAGMAS = ("PRAGMA journal_mode = WAL",
+				"PRAGMA synchronous = OFF",
+				"PRAGMA locking_mode = EXCLUSIVE",
+				"PRAGMA temp_store = MEMORY",
+				"PRAGMA cache_size = -262144")
+
+# Indexes are only built once the load has finished
+INDEXES = (("ways_nodes", ("node_id",)),
+		   ("ways_nodes", ("id",)),
+		   ("nodes_tags", ("id",)),
+		   ("nodes_tags", ("key", "type")),
+		   ("ways_tags", ("id",)),
+		   ("ways_tags", ("key", "type")),
+		   ("relation_members", ("id",)),
+		   ("relation_members", ("member_id",)),
+		   ("relation_tags", ("id",)),
+		   ("relation_tags", ("key", "type")))
+
+def table_name(path):
+	"""SQLite table of a section, named after its CSV file"""
+
+	return os.path.basename(path).split(".")[0]
+
+def insert_sql(table, fields):
+	return "INSERT INTO {} ({}) VALUES ({})".format(
+		table, ", ".join(fields), ", ".join("?" * len(fields)))
+
+class CsvSink(object):
+	"""Write every section (rows are tuples in field order) to its own CSV
+	file, compressed if its path ends in .gz, .bz2, ..."""
+
+	checkpoint_every = None
+
+	def __init__(self, sections, header=True):
+		self.stack = ExitStack()
+		self.files = {}
+		self.writers = {}
+		for section, path, fields in sections:
+			self.files[section] = self.stack.enter_context(open_stream(path, 'wt'))
+			self.writers[section] = writer(self.files[section])
+			if header:
+				self.writers[section].writerow(fields)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.stack.close()
+
+	def copy_part(self, section, path):
+		"""Append a headerless CSV part written by a shard worker"""
+
+		# Copy raw bytes so line endings match the serial writers
+		self.files[section].flush()
+		with open(path, 'rb') as part:
+			shutil.copyfileobj(part, self.files[section].buffer)
+
+	def resume(self, source, unit):
+		"""CSV output is always rewritten from scratch"""
+
+		return 0, None
+
+	def checkpoint(self, done, stats, final=False):
+		pass
+
+class TableWriter(object):
+	"""csv.writer look-alike that buffers rows for executemany"""
+
+	def __init__(self, sink, table, fields):
+		self.sink = sink
+		self.rows = []
+		self.sql = insert_sql(table, fields)
+
+	def writerow(self, row):
+		self.rows.append(row)
+		if len(self.rows) >= self.sink.batch_size:
+			self.flush()
+
+	def writerows(self, rows):
+		self.rows.extend(rows)
+		if len(self.rows) >= self.sink.batch_size:
+			self.flush()
+
+	def flush(self):
+		if self.rows:
+			# Cleared first: a batch that fails is not retried on every
+			# later write
+			rows, self.rows = self.rows, []
+			self.insert(rows)
+
+	def insert(self, rows):
+		"""Insert rows in one executemany; if one breaks a constraint (a
+		duplicate id, ...) the batch is undone and inserted row by row,
+		skipping and reporting the rows that fail"""
+
+		db = self.sink.db
+		# Inside the load's transaction, so RELEASE does not commit
+		if not db.in_transaction:
+			db.execute("BEGIN")
+		db.execute("SAVEPOINT batch")
+		try:
+			db.executemany(self.sql, rows)
+		except sqlite3.IntegrityError:
+			db.execute("ROLLBACK TO batch")
+			for row in rows:
+				try:
+					db.execute(self.sql, row)
+				except sqlite3.IntegrityError as error:
+					print("Skipped {}: {}".format(list(row), error),
+						  file=sys.stderr)
+		finally:
+			db.execute("RELEASE batch")
+
+class SqliteSink(object):
+	"""Bulk load every section into a table of one SQLite database.
+
+	Tables are named after the CSV files and typed from schema.py.  Rows
+	are inserted with batched executemany calls inside large transactions;
+	each commit also records how far the load got (and the counters so
+	far), so an interrupted load resumes from its last checkpoint.
+	"""
+
+	def __init__(self, db_path, sections, schema, batch_size=50000,
+				 checkpoint_every=500000):
+		self.batch_size = batch_size
+		self.checkpoint_every = checkpoint_every
+		self.source = None
+		self.unit = None
+
+		self.db_path = db_path
+		self.db = sqlite3.connect(db_path)
+		for pragma in BULK_PRAGMAS:
+			self.db.execute(pragma)
+
+		self.db.execute("CREATE TABLE IF NOT EXISTS load_progress ("
+						"source TEXT PRIMARY KEY, unit TEXT, done INTEGER, "
+						"complete INTEGER, stats TEXT)")
+
+		self.tables = {}
+		self.writers = {}
+		for section, path, fields in sections:
+			table = table_name(path)
+			self.tables[section] = table
+			self.db.execute(self.table_sql(table, fields, schema[section]))
+			self.writers[section] = TableWriter(self, table, fields)
+		self.db.commit()
+
+	@staticmethod
+	def table_sql(table, fields, rules):
+		"""CREATE TABLE statement for one section of the schema"""
+
+		# Elements (dicts) are keyed by id, their tags and nds (lists) are not
+		keyed = rules['type'] == 'dict'
+		if not keyed:
+			rules = rules['schema']
+		columns = []
+		for field in fields:
+			rule = rules['schema'][field]
+			column = "{} {}".format(field, SQL_TYPES[rule['type']])
+			if keyed and field == 'id':
+				column += " PRIMARY KEY"
+			elif rule.get('required'):
+				column += " NOT NULL"
+			columns.append(column)
+		return "CREATE TABLE IF NOT EXISTS {} ({})".format(
+			table, ", ".join(columns))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.finish()
+		else:
+			# Keep the last checkpoint, drop the half written batch
+			self.db.rollback()
+		self.db.close()
+
+	def resume(self, source, unit):
+		"""Return (units already loaded, counters at that point) for source.
+
+		source identifies the input by path, size and mtime; a database
+		holding a load of anything else is refused rather than mixed in.
+		"""
+
+		st = os.stat(source)
+		self.source = "{}|{}|{}".format(os.path.abspath(source),
+										st.st_size, int(st.st_mtime))
+		self.unit = unit
+
+		row = self.db.execute("SELECT source, unit, done, complete, stats "
+							  "FROM load_progress").fetchone()
+		if row is None:
+			self.db.execute("INSERT INTO load_progress VALUES (?, ?, 0, 0, ?)",
+							(self.source, unit, json.dumps({})))
+			self.db.commit()
+			return 0, None
+
+		if row[0] != self.source or row[1] != unit:
+			raise ValueError("{} already holds a load of {} ({}); remove it "
+							 "to start over".format(self.db_path, row[0],
+													row[1]))
+		if row[3]:
+			return -1, json.loads(row[4])
+		return row[2], json.loads(row[4])
+
+	def flush(self):
+		for table_writer in self.writers.values():
+			table_writer.flush()
+
+	def checkpoint(self, done, stats, final=False):
+		"""Commit everything written so far as the first done units. The
+		final checkpoint (all units, final counters) is left for finish()
+		to commit along with the completion of the load"""
+
+		self.flush()
+		self.db.execute("UPDATE load_progress SET done = ?, stats = ? "
+						"WHERE source = ?",
+						(done, json.dumps(stats), self.source))
+		if not final:
+			self.db.commit()
+
+	def copy_part(self, section, path):
+		"""Load a headerless CSV part written by a shard worker"""
+
+		table_writer = self.writers[section]
+		table_writer.flush()
+		with open(path, newline='') as part:
+			rows = reader(part)
+			batch = list(islice(rows, self.batch_size))
+			while batch:
+				table_writer.insert(batch)
+				batch = list(islice(rows, self.batch_size))
+
+	def finish(self):
+		"""Flush, build the indexes and mark the load complete, in the
+		transaction of the final checkpoint"""
+
+		self.flush()
+		for table, columns in INDEXES:
+			self.db.execute("CREATE INDEX IF NOT EXISTS {}_{} ON {} ({})".format(
+				table, "_".join(columns), table, ", ".join(columns)))
+		if self.source is not None:
+			self.db.execute("UPDATE load_progress SET complete = 1 "
+							"WHERE source = ?", (self.source,))
+		self.db.commit()
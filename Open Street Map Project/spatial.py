@@ -0,0 +1,542 @@
+# Node coordinate store and spatial index for converted extracts.
+#
+# Usage: python spatial.py NODES --box MIN_LAT MAX_LAT MIN_LON MAX_LON
+#                          [--ways ways_nodes.csv]
+#        python spatial.py NODES --radius LAT LON METERS
+#
+# NODES is a store saved by exploration.py: an .npz file, or a directory of
+# .npy arrays that is memory-mapped instead of read into RAM.
+#
+# NodeLocations and WayGeometry are the way geometry stage of
+# exploration.py: node coordinates go into a file indexed by node id while
+# the nodes are parsed, and the ways after them are resolved through it.
+
+# Standard imports
+import argparse
+import math
+import os
+from array import array
+
+# My imports
+from time import time
+
+import numpy as np
+
+# CONSTANTS
+
+EARTH_RADIUS = 6371008.8 # meters
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+# NodeLocations: coordinates are kept as OSM does, in int32 units of 1e-7
+# degrees. Latitudes are shifted up so that 0 (an unwritten entry) means no
+# node, and (0, 0) is still a location.
+COORDINATE_SCALE = 10 ** 7
+LAT_OFFSET = 90 * COORDINATE_SCALE + 1
+FLUSH_SIZE = 1 << 16 # nodes buffered between writes to the file
+GROW_SIZE = 1 << 20 # node ids the file grows by, at least
+
+# Ways resolved per batch by WayGeometry
+WAY_BATCH = 4096
+
+class NodeStore(object):
+	"""Node ids and coordinates as parallel NumPy arrays.
+
+	Filled one node at a time while parsing (into compact array.array
+	buffers), then frozen with finish() into id-sorted int64/float64
+	arrays for vectorized queries.
+	"""
+
+	def __init__(self):
+		self.id_buffer = array('q')
+		self.lat_buffer = array('d')
+		self.lon_buffer = array('d')
+		self.ids = self.lat = self.lon = None
+
+	def add(self, id, lat, lon):
+		self.id_buffer.append(int(id))
+		self.lat_buffer.append(lat)
+		self.lon_buffer.append(lon)
+
+	def extend(self, buffers):
+		"""Append the buffers() of another store, e.g. of a shard worker"""
+
+		ids, lats, lons = buffers
+		self.id_buffer.extend(ids)
+		self.lat_buffer.extend(lats)
+		self.lon_buffer.extend(lons)
+
+	def buffers(self):
+		return self.id_buffer, self.lat_buffer, self.lon_buffer
+
+	def finish(self):
+		"""Freeze the buffers (no more add() after this) into arrays
+		sorted by node id"""
+
+		self.ids = np.frombuffer(self.id_buffer, dtype=np.int64)
+		self.lat = np.frombuffer(self.lat_buffer, dtype=np.float64)
+		self.lon = np.frombuffer(self.lon_buffer, dtype=np.float64)
+
+		# Extracts are normally sorted by id already
+		if len(self.ids) and np.any(self.ids[1:] < self.ids[:-1]):
+			order = np.argsort(self.ids, kind='stable')
+			self.ids, self.lat, self.lon = \
+				self.ids[order], self.lat[order], self.lon[order]
+		return self
+
+	def __len__(self):
+		return len(self.ids) if self.ids is not None else len(self.id_buffer)
+
+	def save(self, path):
+		"""Save to an .npz file, or else to a directory of .npy arrays"""
+
+		if path.endswith(".npz"):
+			np.savez(path, ids=self.ids, lat=self.lat, lon=self.lon)
+			return
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		for name in ("ids", "lat", "lon"):
+			np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+
+	@classmethod
+	def load(cls, path, mmap_mode=None):
+		"""Load a saved store; mmap_mode='r' maps a directory store so only
+		the pages a query touches are read"""
+
+		store = cls()
+		if path.endswith(".npz"):
+			with np.load(path) as data:
+				store.ids, store.lat, store.lon = \
+					data['ids'], data['lat'], data['lon']
+		else:
+			store.ids, store.lat, store.lon = [
+				np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+				for name in ("ids", "lat", "lon")]
+		return store
+
+	def lookup(self, node_ids):
+		"""Positions of node_ids in the store, -1 where a node is missing"""
+
+		node_ids = np.asarray(node_ids, dtype=np.int64)
+		if not len(self.ids):
+			return np.full(len(node_ids), -1, dtype=np.int64)
+
+		pos = np.searchsorted(self.ids, node_ids)
+		pos[pos == len(self.ids)] = 0
+		pos[self.ids[pos] != node_ids] = -1
+		return pos
+
+	def in_box(self, min_lat, max_lat, min_lon, max_lon):
+		"""Boolean mask of the nodes inside one box"""
+
+		return (self.lat >= min_lat) & (self.lat <= max_lat) & \
+			(self.lon >= min_lon) & (self.lon <= max_lon)
+
+	def in_boxes(self, boxes):
+		"""Boolean (boxes, nodes) mask for an array of
+		(min_lat, max_lat, min_lon, max_lon) rows"""
+
+		boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+		lat = self.lat[np.newaxis, :]
+		lon = self.lon[np.newaxis, :]
+		return (lat >= boxes[:, 0:1]) & (lat <= boxes[:, 1:2]) & \
+			(lon >= boxes[:, 2:3]) & (lon <= boxes[:, 3:4])
+
+	def box_of(self, boxes):
+		"""Index of the first box holding each node, -1 for none"""
+
+		mask = self.in_boxes(boxes)
+		first = np.argmax(mask, axis=0)
+		first[~mask.any(axis=0)] = -1
+		return first
+
+class NodeLocations(object):
+	"""Node coordinates in a file indexed by node id.
+
+	Entry id of the memory-mapped array is the (lat, lon) of node id, so a
+	lookup is one fancy index with no id table, sorting or search. The
+	file covers ids up to the largest seen and is sparse: the ranges of
+	ids that an extract skips take no disk space and are never read. Nodes
+	are buffered and written in vectorized batches. Node ids must not be
+	negative.
+	"""
+
+	def __init__(self, path, flush_size=FLUSH_SIZE):
+		self.path = path
+		self.flush_size = flush_size
+		self.capacity = 0
+		self.array = None
+		open(path, 'wb').close()
+		self.new_buffers()
+
+	def new_buffers(self):
+		self.id_buffer = array('q')
+		self.lat_buffer = array('d')
+		self.lon_buffer = array('d')
+
+	def add(self, id, lat, lon):
+		self.id_buffer.append(int(id))
+		self.lat_buffer.append(lat)
+		self.lon_buffer.append(lon)
+		if len(self.id_buffer) >= self.flush_size:
+			self.flush()
+
+	def extend(self, buffers):
+		"""Add the buffers() of a NodeStore, e.g. of a shard worker"""
+
+		ids, lats, lons = buffers
+		self.id_buffer.extend(ids)
+		self.lat_buffer.extend(lats)
+		self.lon_buffer.extend(lons)
+		if len(self.id_buffer) >= self.flush_size:
+			self.flush()
+
+	def flush(self):
+		"""Write the buffered nodes to the file"""
+
+		if not self.id_buffer:
+			return
+		ids = np.frombuffer(self.id_buffer, dtype=np.int64)
+		if ids.min() < 0:
+			raise ValueError("node id {} can't be stored; ids must not be "
+							 "negative".format(ids.min()))
+		self.reserve(int(ids.max()) + 1)
+
+		lat = np.frombuffer(self.lat_buffer, dtype=np.float64)
+		lon = np.frombuffer(self.lon_buffer, dtype=np.float64)
+		pairs = np.empty((len(ids), 2), dtype=np.int32)
+		pairs[:, 0] = np.rint(lat * COORDINATE_SCALE) + LAT_OFFSET
+		pairs[:, 1] = np.rint(lon * COORDINATE_SCALE)
+		self.array[ids] = pairs
+		self.new_buffers()
+
+	def reserve(self, size):
+		"""Grow the file to hold ids below size"""
+
+		if size <= self.capacity:
+			return
+		capacity = max(size, 2 * self.capacity)
+		capacity = -(-capacity // GROW_SIZE) * GROW_SIZE
+		if self.array is not None:
+			self.array.flush()
+			self.array = None
+		with open(self.path, 'r+b') as locations_file:
+			locations_file.truncate(capacity * 8)
+		self.array = np.memmap(self.path, dtype=np.int32, mode='r+',
+							   shape=(capacity, 2))
+		self.capacity = capacity
+
+	def lookup(self, node_ids):
+		"""(lat, lon, found) arrays for node_ids; the coordinates of nodes
+		not found are meaningless"""
+
+		self.flush()
+		node_ids = np.asarray(node_ids, dtype=np.int64)
+		pairs = np.zeros((len(node_ids), 2), dtype=np.int32)
+		inside = (node_ids >= 0) & (node_ids < self.capacity)
+		if inside.any():
+			pairs[inside] = self.array[node_ids[inside]]
+
+		found = pairs[:, 0] != 0
+		lat = (pairs[:, 0].astype(np.int64) - LAT_OFFSET) / COORDINATE_SCALE
+		lon = pairs[:, 1] / COORDINATE_SCALE
+		return lat, lon, found
+
+	def close(self, remove=True):
+		"""Unmap the file, and remove it unless remove=False"""
+
+		self.array = None
+		self.capacity = 0
+		if remove and os.path.exists(self.path):
+			os.remove(self.path)
+
+class WayGeometry(object):
+	"""Resolve ways through a NodeLocations store as they are parsed.
+
+	Nodes go into the store with add_node(); ways are buffered by
+	add_way() and resolved a batch at a time (see way_geometry()), their
+	rows written to out, a csv.writer or sink writer. A way only sees the
+	nodes added before it is resolved, which is every node of the file
+	when it is sorted nodes first, as OSM extracts are.
+	"""
+
+	def __init__(self, locations, out, batch=WAY_BATCH):
+		self.locations = locations
+		self.out = out
+		self.batch = batch
+		self.new_buffers()
+
+	def new_buffers(self):
+		self.ids = array('q')
+		self.refs = array('q')
+		self.ends = array('q')
+
+	def add_node(self, id, lat, lon):
+		self.locations.add(id, lat, lon)
+
+	def add_way(self, id, refs):
+		self.ids.append(int(id))
+		self.refs.extend(int(ref) for ref in refs)
+		self.ends.append(len(self.refs))
+		if len(self.ids) >= self.batch:
+			self.flush()
+
+	def flush(self):
+		"""Resolve and write out the buffered ways"""
+
+		if not self.ids:
+			return
+		self.out.writerows(way_geometry(self.locations, self.ids, self.refs,
+										self.ends))
+		self.new_buffers()
+
+	def close(self, remove=True):
+		self.flush()
+		self.locations.close(remove)
+
+class GridIndex(object):
+	"""Uniform grid over a NodeStore.
+
+	Node positions are sorted by cell (row-major), so the nodes of a run of
+	cells in one grid row are one contiguous slice; a box query visits one
+	slice per row it covers and filters those candidates exactly.
+	"""
+
+	def __init__(self, store, cell_size=0.005):
+		self.store = store
+		self.cell_size = cell_size
+		if len(store):
+			self.min_lat = store.lat.min()
+			self.min_lon = store.lon.min()
+			self.rows = int((store.lat.max() - self.min_lat) // cell_size) + 1
+			self.cols = int((store.lon.max() - self.min_lon) // cell_size) + 1
+		else:
+			self.min_lat = self.min_lon = 0.0
+			self.rows = self.cols = 1
+
+		cells = self.row(store.lat) * self.cols + self.col(store.lon)
+		self.order = np.argsort(cells, kind='stable')
+		self.cells = cells[self.order]
+
+	def row(self, lat):
+		rows = np.floor((np.asarray(lat) - self.min_lat) / self.cell_size)
+		return np.clip(rows, 0, self.rows - 1).astype(np.int64)
+
+	def col(self, lon):
+		cols = np.floor((np.asarray(lon) - self.min_lon) / self.cell_size)
+		return np.clip(cols, 0, self.cols - 1).astype(np.int64)
+
+	def query_box(self, min_lat, max_lat, min_lon, max_lon):
+		"""Store positions of the nodes inside the box"""
+
+		store = self.store
+		rows = np.arange(self.row(min_lat), self.row(max_lat) + 1)
+		if min_lat > max_lat or min_lon > max_lon or not len(store):
+			return np.empty(0, dtype=np.int64)
+
+		first = np.searchsorted(self.cells, rows * self.cols + self.col(min_lon))
+		last = np.searchsorted(self.cells, rows * self.cols + self.col(max_lon),
+							   side='right')
+		candidates = np.concatenate([self.order[a:b] for a, b in zip(first, last)])
+		lat, lon = store.lat[candidates], store.lon[candidates]
+		inside = (lat >= min_lat) & (lat <= max_lat) & \
+			(lon >= min_lon) & (lon <= max_lon)
+		return np.sort(candidates[inside])
+
+	def query_radius(self, lat, lon, meters):
+		"""Store positions of the nodes within meters of (lat, lon)"""
+
+		dlat = meters / METERS_PER_DEGREE
+		dlon = dlat / max(math.cos(math.radians(lat)), 1e-12)
+		candidates = self.query_box(lat - dlat, lat + dlat, lon - dlon, lon + dlon)
+		distance = haversine(lat, lon, self.store.lat[candidates],
+							 self.store.lon[candidates])
+		return candidates[distance <= meters]
+
+	def box_mask(self, min_lat, max_lat, min_lon, max_lon):
+		"""Boolean mask over the store of the nodes inside the box"""
+
+		mask = np.zeros(len(self.store), dtype=bool)
+		mask[self.query_box(min_lat, max_lat, min_lon, max_lon)] = True
+		return mask
+
+def haversine(lat1, lon1, lat2, lon2):
+	"""Great circle distance in meters, vectorized over NumPy arrays"""
+
+	lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+	a = np.sin((lat2 - lat1) / 2) ** 2 + \
+		np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+	return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+def read_way_nodes(path):
+	"""(way ids, node ids) columns of a ways_nodes.csv file"""
+
+	data = np.loadtxt(path, delimiter=',', skiprows=1, usecols=(0, 1),
+					  dtype=np.int64, ndmin=2)
+	return data[:, 0], data[:, 1]
+
+def clip_ways(index, way_ids, node_ids, box, require_all=False):
+	"""Clip ways to a box by checking their way_nodes refs.
+
+	Returns (ids of the ways with any node inside the box, or all of them
+	with require_all, and a mask of the way_nodes rows inside the box).
+	Nodes missing from the store count as outside.
+	"""
+
+	inside_nodes = index.box_mask(*box)
+	pos = index.store.lookup(node_ids)
+	inside = np.zeros(len(node_ids), dtype=bool)
+	found = pos >= 0
+	inside[found] = inside_nodes[pos[found]]
+
+	ways, way_pos = np.unique(way_ids, return_inverse=True)
+	inside_count = np.bincount(way_pos, weights=inside, minlength=len(ways))
+	if require_all:
+		keep = inside_count == np.bincount(way_pos, minlength=len(ways))
+	else:
+		keep = inside_count > 0
+	return ways[keep], inside
+
+def linestring_wkt(lat, lon):
+	"""WKT of a line through the points, x being the longitude"""
+
+	if len(lat) < 2:
+		return ""
+	return "LINESTRING ({})".format(", ".join(
+		"{:.7f} {:.7f}".format(x, y) for x, y in zip(lon, lat)))
+
+def way_geometry(locations, way_ids, refs, ends):
+	"""Geometry of a batch of ways with one lookup of all their nodes.
+
+	The node refs of every way are concatenated in refs, way i ending
+	before ends[i]. Yields (way id, nodes, nodes missing, length in
+	meters, min_lat, max_lat, min_lon, max_lon, WKT) per way; the line
+	runs through the nodes found, and the bounds and length are None if
+	no node of the way is in the store.
+	"""
+
+	way_ids = np.frombuffer(way_ids, dtype=np.int64)
+	ends = np.frombuffer(ends, dtype=np.int64)
+	counts = np.diff(ends, prepend=0)
+	lat, lon, found = locations.lookup(np.frombuffer(refs, dtype=np.int64))
+
+	# Keep the nodes found, each labelled with its way
+	way_of = np.repeat(np.arange(len(way_ids)), counts)[found]
+	lat, lon = lat[found], lon[found]
+	found_counts = np.bincount(way_of, minlength=len(way_ids))
+	found_ends = np.cumsum(found_counts)
+	found_starts = found_ends - found_counts
+
+	# Segments between consecutive nodes of the same way
+	segments = haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+	same = way_of[:-1] == way_of[1:]
+	length = np.bincount(way_of[:-1][same], weights=segments[same],
+						 minlength=len(way_ids))
+
+	# Bounds of the ways with nodes: their slices are back to back
+	bounds = np.zeros((len(way_ids), 4))
+	some = found_counts > 0
+	if some.any():
+		starts = found_starts[some]
+		bounds[some, 0] = np.minimum.reduceat(lat, starts)
+		bounds[some, 1] = np.maximum.reduceat(lat, starts)
+		bounds[some, 2] = np.minimum.reduceat(lon, starts)
+		bounds[some, 3] = np.maximum.reduceat(lon, starts)
+
+	# Plain lists from here on: floats format faster than NumPy scalars
+	lat, lon = lat.tolist(), lon.tolist()
+	rows = zip(way_ids.tolist(), counts.tolist(), found_starts.tolist(),
+			   found_ends.tolist(), np.round(length, 2).tolist(),
+			   bounds.tolist())
+	for way, nodes, start, end, meters, way_bounds in rows:
+		if start == end:
+			yield (way, nodes, nodes, None, None, None, None, None, "")
+			continue
+		yield ((way, nodes, nodes - (end - start), meters) +
+			   tuple(way_bounds) +
+			   (linestring_wkt(lat[start:end], lon[start:end]),))
+
+def member_geometry(store, members, way_nodes):
+	"""Resolve the way members of relations into line geometry.
+
+	members() and way_nodes() return fresh iterables over the rows of the
+	relation_members and way_nodes sections. Only the node refs of member
+	ways are kept in memory, and node coordinates are looked up in store
+	(memory-mapped, ideally), so neither file is loaded whole.
+
+	Yields (relation id, way id, role, position, nodes, nodes missing,
+	min_lat, max_lat, min_lon, max_lon, WKT) for every way member; the
+	bounds and WKT are empty if no node of the way is in the store.
+	"""
+
+	wanted = set(int(row[1]) for row in members() if row[2] == "way")
+
+	# The nds of a way are contiguous: keep the refs of wanted ways in one
+	# flat array, with each way's slice of it
+	refs = array('q')
+	slices = {}
+	for row in way_nodes():
+		way = int(row[0])
+		if way in wanted:
+			start = slices[way][0] if way in slices else len(refs)
+			refs.append(int(row[1]))
+			slices[way] = (start, len(refs))
+
+	# One vectorized lookup for every node, then one geometry per way
+	pos = store.lookup(np.frombuffer(refs, dtype=np.int64))
+	lat = store.lat[np.maximum(pos, 0)]
+	lon = store.lon[np.maximum(pos, 0)]
+	geometry = {}
+	for way, (start, end) in slices.items():
+		found = pos[start:end] >= 0
+		way_lat, way_lon = lat[start:end][found], lon[start:end][found]
+		bounds = ("", "", "", "")
+		if len(way_lat):
+			bounds = (float(way_lat.min()), float(way_lat.max()),
+					  float(way_lon.min()), float(way_lon.max()))
+		geometry[way] = ((end - start, end - start - int(found.sum())) +
+						 bounds + (linestring_wkt(way_lat, way_lon),))
+
+	missing = (0, 0, "", "", "", "", "")
+	for id, member_id, member_type, role, position in members():
+		if member_type == "way":
+			yield ((id, member_id, role, position) +
+				   geometry.get(int(member_id), missing))
+
+def main():
+	parser = argparse.ArgumentParser(description="Query a saved node store")
+	parser.add_argument("store", help="node store (.npz or directory) saved "
+						"by exploration.py")
+	parser.add_argument("--box", type=float, nargs=4,
+						metavar=("MIN_LAT", "MAX_LAT", "MIN_LON", "MAX_LON"))
+	parser.add_argument("--radius", type=float, nargs=3,
+						metavar=("LAT", "LON", "METERS"))
+	parser.add_argument("--ways", help="ways_nodes.csv to clip to --box")
+	parser.add_argument("--cell", type=float, default=0.005,
+						help="grid cell size in degrees")
+	args = parser.parse_args()
+
+	start = time()
+	index = GridIndex(NodeStore.load(args.store, mmap_mode='r'), args.cell)
+	print("Indexed {} nodes in {:.3f}s".format(len(index.store), time() - start))
+
+	if args.box:
+		start = time()
+		found = index.query_box(*args.box)
+		print("{} nodes in box ({:.2f} ms)".format(
+			len(found), (time() - start) * 1000))
+
+		if args.ways:
+			way_ids, node_ids = read_way_nodes(args.ways)
+			start = time()
+			ways, _ = clip_ways(index, way_ids, node_ids, args.box)
+			print("{} of {} ways touch the box ({:.2f} ms)".format(
+				len(ways), len(np.unique(way_ids)), (time() - start) * 1000))
+
+	if args.radius:
+		start = time()
+		found = index.query_radius(*args.radius)
+		print("{} nodes within radius ({:.2f} ms)".format(
+			len(found), (time() - start) * 1000))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,217 @@
+# Standard imports
+import bz2
+import gzip
+import lzma
+import os
+import re
+
+# My imports
+from collections import deque
+from multiprocessing import Pool
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+# Transparent (de)compression for the pipeline's input and output files,
+# picked by file extension: .gz, .bz2, .xz, and .zst when the zstandard
+# package is installed. Everything streams; the uncompressed data is never
+# written to disk or held in memory as a whole.
+#
+# bzip2 is the one format that can be decompressed in parallel, and only
+# when the file holds several streams back to back, as pbzip2 (and the
+# OSM planet dumps) write them. The blocks inside a single stream start
+# at arbitrary bit offsets, so a plain `bzip2` file is read serially.
+
+# Extensions accepted by --compress, without the dot
+FORMATS = ("gz", "bz2", "xz", "zst")
+
+# Start of a bzip2 stream: "BZh", the block size, then the magic number
+# of its first block (0x314159265359), all byte aligned
+BZ2_STREAM = re.compile(br'BZh[1-9]1AY&SY')
+
+# Compressed bytes handed to a worker at a time (about 10 MB decompressed)
+RANGE_SIZE = 1 << 20
+SCAN_SIZE = 1 << 22
+
+def open_zstd(path, mode='rb', **kwargs):
+	if zstandard is None:
+		raise ValueError("{} needs the zstandard package".format(path))
+	return zstandard.open(path, mode, **kwargs)
+
+OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open,
+		   ".zst": open_zstd}
+
+def compression(path):
+	"""Compressed extension of path (".gz", ...), None for a plain file"""
+
+	ext = os.path.splitext(path)[1].lower()
+	return ext if ext in OPENERS else None
+
+def open_stream(path, mode='rb', workers=1, **kwargs):
+	"""open() that compresses or decompresses by file extension. Text modes
+	need the "t" spelled out ('rt', 'wt'), as with gzip.open.
+
+	workers > 1 decompresses a multi-stream .bz2 file in a process pool.
+	"""
+
+	ext = compression(path)
+	if ext is None:
+		return open(path, mode, **kwargs)
+	if ext == ".bz2" and mode == 'rb' and workers > 1 and multi_stream(path):
+		return ParallelBz2Reader(path, workers)
+	if ext == ".gz" and 'w' in mode:
+		# zlib's default; gzip.open's 9 is several times slower for ~2% less
+		kwargs.setdefault("compresslevel", 6)
+	return OPENERS[ext](path, mode, **kwargs)
+
+def open_counted(path, workers=1):
+	"""open_stream(path, 'rb', workers), and a reader whose count is how
+	many bytes of path (compressed ones, for a compressed file) were read
+	so far. Both need closing."""
+
+	ext = compression(path)
+	if ext == ".bz2" and workers > 1 and multi_stream(path):
+		stream = ParallelBz2Reader(path, workers)
+		return stream, stream
+	raw = CountingReader(open(path, 'rb'))
+	if ext is None:
+		return raw, raw
+	return OPENERS[ext](raw, 'rb'), raw
+
+class CountingReader(object):
+	"""Binary reader that counts the bytes read through it"""
+
+	def __init__(self, raw):
+		self.raw = raw
+		self.count = 0
+
+	def read(self, size=-1):
+		data = self.raw.read(size)
+		self.count += len(data)
+		return data
+
+	def close(self):
+		self.raw.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+def temp_path(path):
+	"""Scratch file next to path with the same compression"""
+
+	ext = compression(path) or ""
+	return path[:len(path) - len(ext)] + ".tmp" + ext
+
+# Parallel bzip2
+
+def stream_starts(bz2_file, start=0, limit=None):
+	"""Yield the byte offsets of bzip2 stream headers in an open file"""
+
+	offset = start
+	while limit is None or offset < limit:
+		bz2_file.seek(offset)
+		# Overlap the chunks so a header split between two reads is found
+		data = bz2_file.read(SCAN_SIZE + 9)
+		for match in BZ2_STREAM.finditer(data):
+			if match.start() < SCAN_SIZE:
+				yield offset + match.start()
+		if len(data) <= SCAN_SIZE:
+			break
+		offset += SCAN_SIZE
+
+def multi_stream(path):
+	"""True if a second stream starts where a stream of the first one's
+	block size must have ended"""
+
+	with open(path, 'rb') as bz2_file:
+		header = bz2_file.read(4)
+		if not BZ2_STREAM.match(header + b'1AY&SY'):
+			return False
+		# A stream of one block is at most a little over its block size
+		limit = int(header[3:4]) * 100000 * 11 // 10 + 600
+		return next(stream_starts(bz2_file, 1, limit), None) is not None
+
+def stream_ranges(path, size=RANGE_SIZE):
+	"""Yield (start, end) byte ranges of at least size bytes that each
+	hold whole streams, scanning the file as they are needed"""
+
+	end = os.path.getsize(path)
+	with open(path, 'rb') as bz2_file:
+		start = 0
+		for offset in stream_starts(bz2_file, 1):
+			if offset - start >= size:
+				yield start, offset
+				start = offset
+	yield start, end
+
+def decompress_range(task):
+	"""Decompress the streams in one byte range. Runs in a worker"""
+
+	path, start, end = task
+	with open(path, 'rb') as bz2_file:
+		bz2_file.seek(start)
+		data = bz2_file.read(end - start)
+	parts = []
+	while data:
+		decompressor = bz2.BZ2Decompressor()
+		parts.append(decompressor.decompress(data))
+		if not decompressor.eof:
+			raise EOFError("{} ends inside a bzip2 stream".format(path))
+		data = decompressor.unused_data
+	return b''.join(parts)
+
+class ParallelBz2Reader(object):
+	"""Binary file-like reader of a multi-stream .bz2 file whose ranges
+	are decompressed by a pool of workers and read back in order. At most
+	a few ranges per worker are decompressed ahead of the reader.
+
+	count is the end of the last range handed to the reader, in bytes.
+	"""
+
+	def __init__(self, path, workers, ahead=2):
+		self.path = path
+		self.pool = Pool(workers)
+		self.ranges = stream_ranges(path)
+		self.pending = deque()
+		self.window = ahead * workers
+		self.data = b''
+		self.offset = 0
+		self.count = 0
+		self.fill()
+
+	def fill(self):
+		while len(self.pending) < self.window:
+			task = next(self.ranges, None)
+			if task is None:
+				break
+			self.pending.append((task[1], self.pool.apply_async(
+				decompress_range, ((self.path,) + task,))))
+
+	def read(self, size=-1):
+		if size is None or size < 0:
+			return b''.join(iter(lambda: self.read(RANGE_SIZE), b''))
+		while self.offset >= len(self.data):
+			if not self.pending:
+				return b''
+			self.count, result = self.pending.popleft()
+			self.data = result.get()
+			self.offset = 0
+			self.fill()
+		data = self.data[self.offset:self.offset + size]
+		self.offset += len(data)
+		return data
+
+	def close(self):
+		self.pool.terminate()
+		self.pool.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
@@ -0,0 +1,129 @@
+# Standard imports
+import random
+
+# My imports
+from xml.sax.saxutils import quoteattr
+
+# Synthetic OSM extracts for benchmarks: the shape of cambridge.xml
+# (nodes first, then ways referencing them) with addr values that hit
+# every branch of the address cleaning.
+
+# Box a little larger than the exploration box, so some nodes fall out
+BOX = (42.33, 42.43, -71.21, -71.01)
+
+ADDR_VALUES = ["Massachusetts Ave", "Massachusetts Ave.", "Main St",
+			   "Main St.", "Elm st", "Cambridge, MA", "Cambridge,MA",
+			   "Boston, MA-", "Arlington. MA", "Kendall Sq.", "Inman Sq",
+			   "Memorial Dr", "Fresh Pond Pkwy", "Broadway", "MIT Pl",
+			   "02139", "2139", "021390", "02139-4307", "33,", "1-B",
+			   "12", "12A", "3,5", "10-12", "40A-F", "Lomasney WAY,",
+			   "ROOF LEVEL", "DMSE, (Physics, floor 6", "O'Brien Hwy"]
+ADDR_KEYS = ["addr:street", "addr:postcode", "addr:housenumber",
+			 "addr:city", "addr:state"]
+# Streets spelled every way the word_transforms of exploration.py expect
+STREET_NAMES = ["Massachusetts", "Main", "Elm", "Cambridge", "Hampshire",
+				"Prospect", "Concord", "Huron", "Brattle", "Putnam", "Kirkland",
+				"Western", "River", "Harvard", "Beacon", "Oxford", "Garden",
+				"Walden", "Magazine", "Windsor"]
+STREET_TYPES = ["St", "ST", "St.", "st", "St,", "Ave", "Ave.", "Rd", "Dr",
+				"Pkwy", "Pl", "Sq", "Sq.", "Ct", "Hwy", "Street", "Avenue",
+				"Way", "Lane", "Road"]
+TAGS = [("amenity", "cafe"), ("building", "yes"), ("highway", "residential"),
+		("name", "Harvard Square"), ("tiger:county", "Middlesex, MA"),
+		("massgis:way_id", "1234"), ("source", "survey")]
+
+def node_xml(rng, node_id, users, tag_share, addr_share, messy_share=0.0,
+			 tags_per_element=(1, 3)):
+	"""One <node> element, with tags for about tag_share of the nodes"""
+
+	uid = rng.randrange(len(users))
+	attribs = ('id="{}" lat="{:.7f}" lon="{:.7f}" version="{}" '
+			   'timestamp="20{:02d}-0{}-1{}T0{}:00:00Z" changeset="{}" '
+			   'uid="{}" user={}').format(
+		node_id, rng.uniform(BOX[0], BOX[1]), rng.uniform(BOX[2], BOX[3]),
+		rng.randint(1, 6), rng.randint(7, 17), rng.randint(1, 9),
+		rng.randint(0, 9), rng.randint(0, 9), rng.randint(1, 10 ** 8),
+		uid, quoteattr(users[uid]))
+
+	if rng.random() >= tag_share:
+		return '  <node {}/>\n'.format(attribs)
+	return '  <node {}>\n{}  </node>\n'.format(
+		attribs, tags_xml(rng, addr_share, messy_share, tags_per_element))
+
+def messy_street(rng):
+	"""A street name with a random (often abbreviated) street type"""
+
+	return "{} {}".format(rng.choice(STREET_NAMES), rng.choice(STREET_TYPES))
+
+def tags_xml(rng, addr_share, messy_share=0.0, tags_per_element=(1, 3)):
+	"""Child <tag> elements, one to three by default. messy_share of the
+	addr tags are street values from messy_street()"""
+
+	lines = []
+	for _ in range(rng.randint(*tags_per_element)):
+		if rng.random() < addr_share:
+			if messy_share and rng.random() < messy_share:
+				key, value = "addr:street", messy_street(rng)
+			else:
+				key, value = rng.choice(ADDR_KEYS), rng.choice(ADDR_VALUES)
+		else:
+			key, value = rng.choice(TAGS)
+		lines.append('    <tag k={} v={}/>\n'.format(quoteattr(key),
+													 quoteattr(value)))
+	return "".join(lines)
+
+def generate_osm(path, nodes=10000, way_share=0.2, tag_share=0.3,
+				 addr_share=0.5, nds_per_way=(2, 10), users=500, seed=42,
+				 relation_share=0.0, members_per_relation=(2, 20),
+				 messy_share=0.0, tags_per_element=(1, 3)):
+	"""Write a synthetic OSM file with the given number of nodes,
+	way_share ways and relation_share relations per node to path.
+
+	tag_share of the nodes (and every way and relation) have
+	tags_per_element tags, addr_share of which are addr tags.
+	"""
+
+	rng = random.Random(seed)
+	user_names = ["user{}".format(i) for i in range(users)]
+
+	with open(path, 'w', encoding='utf-8') as out:
+		out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+				  '<osm version="0.6" generator="synthetic.py">\n')
+		out.write(' <bounds minlat="{}" maxlat="{}" minlon="{}" '
+				  'maxlon="{}"/>\n'.format(*BOX))
+
+		for node_id in range(1, nodes + 1):
+			out.write(node_xml(rng, node_id, user_names, tag_share,
+							   addr_share, messy_share, tags_per_element))
+
+		ways = int(nodes * way_share)
+		for way_id in range(nodes + 1, nodes + ways + 1):
+			uid = rng.randrange(users)
+			out.write('  <way id="{}" version="{}" timestamp="20{:02d}-01-01'
+					  'T00:00:00Z" changeset="{}" uid="{}" user={}>\n'.format(
+						way_id, rng.randint(1, 9), rng.randint(7, 17),
+						rng.randint(1, 10 ** 8), uid, quoteattr(user_names[uid])))
+			for _ in range(rng.randint(*nds_per_way)):
+				out.write('    <nd ref="{}"/>\n'.format(rng.randint(1, nodes)))
+			out.write(tags_xml(rng, addr_share, messy_share, tags_per_element))
+			out.write('  </way>\n')
+
+		first_relation = nodes + ways + 1
+		for relation_id in range(first_relation,
+								 first_relation + int(nodes * relation_share)):
+			uid = rng.randrange(users)
+			out.write('  <relation id="{}" version="{}" timestamp="20{:02d}-01-01'
+					  'T00:00:00Z" changeset="{}" uid="{}" user={}>\n'.format(
+						relation_id, rng.randint(1, 9), rng.randint(7, 17),
+						rng.randint(1, 10 ** 8), uid, quoteattr(user_names[uid])))
+			for _ in range(rng.randint(*members_per_relation)):
+				if ways and rng.random() < 0.5:
+					member = ("way", rng.randint(nodes + 1, nodes + ways), "outer")
+				else:
+					member = ("node", rng.randint(1, nodes), "")
+				out.write('    <member type="{}" ref="{}" role="{}"/>\n'.format(
+					*member))
+			out.write(tags_xml(rng, addr_share, messy_share, tags_per_element))
+			out.write('  </relation>\n')
+
+		out.write('</osm>\n')